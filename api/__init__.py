@@ -1,12 +1,4 @@
-import logging
-
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
-
-from api.auth import router as auth_router
-from api.route import router as route_router
-from api.config import settings
-from api.db import create_db
+from contextlib import asynccontextmanager
 
 tags_metadata = [
     {
@@ -17,38 +9,80 @@ tags_metadata = [
 ]
 
 
+@asynccontextmanager
+async def lifespan(app):
+    from api.access_log import start_access_log, stop_access_log
+    from api.config import settings
+    from api.hashing import hash_pool
+    from api.maintenance import build_scheduler
+
+    # start the access log writer thread
+    listener = start_access_log() if settings.access_log_file else None
+    # and the database housekeeping
+    scheduler = build_scheduler() if settings.maintenance_enabled else None
+    if scheduler is not None:
+        scheduler.start()
+    try:
+        yield
+    finally:
+        if scheduler is not None:
+            await scheduler.stop()
+        hash_pool.shutdown()
+        if listener is not None:
+            stop_access_log(listener)
+
+
 def create_app():
     """
-    API app loader
+    API app loader. Importing the package has no side effects, the routes are
+    imported here and the database schema is created by `python -m api.migrate`
     """
-    app = FastAPI(title=settings.app_name, openapi_tags=tags_metadata)
-    app.include_router(route_router)
-    app.include_router(auth_router)
-    create_db()
-    return app
-
+    from fastapi import FastAPI
+    from fastapi.responses import HTMLResponse
 
-app = create_app()
+    from api.access_log import AccessLogMiddleware
+    from api.auth import router as auth_router
+    from api.clients import router as clients_router
+    from api.config import settings
+    from api.metrics import MetricsMiddleware
+    from api.metrics import router as metrics_router
+    from api.route import router as route_router
+    from api.serialization import JSONResponse
 
+    app = FastAPI(
+        title=settings.app_name,
+        openapi_tags=tags_metadata,
+        lifespan=lifespan,
+        default_response_class=JSONResponse,
+    )
+    app.include_router(route_router)
+    app.include_router(auth_router)
+    app.include_router(clients_router)
+    if settings.metrics_enabled:
+        app.include_router(metrics_router)
+        app.add_middleware(MetricsMiddleware)
+    if settings.access_log_file:
+        app.add_middleware(AccessLogMiddleware)
 
-# start the logging (ref: https://github.com/tiangolo/fastapi/issues/1508)
-@app.on_event("startup")
-async def startup_event():
-    logger = logging.getLogger("uvicorn.access")
-    handler = logging.FileHandler("logfile.log")
-    handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-    logger.addHandler(handler)
+    @app.get("/", response_class=HTMLResponse)
+    async def index():
+        return """
+            <!DOCTYPE html>
+            <html>
+                <body>
+                    <h1>Authentication Server</h1>
+                    <h6><a href="/docs">API Docs</a><h6>
+                </body>
+            </html>
+        """
 
+    return app
 
 
-@app.get("/", response_class=HTMLResponse)
-async def index(request: Request):
-    return """
-        <!DOCTYPE html>
-        <html>
-            <body>
-                <h1>Authentication Server</h1>
-                <h6><a href="/docs">API Docs</a><h6>
-            </body>
-        </html>
-    """
\ No newline at end of file
+def __getattr__(name):
+    # `from api import app` builds the app on first use
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,194 @@
+"""
+Access logging that never writes to disk on the event loop.
+
+Request handling only puts a record on a bounded queue, a QueueListener thread
+formats the records and writes them to a file rotated by size and by time.
+"""
+import json
+import logging
+import os
+import queue
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from api.config import settings
+from api.metrics import Counter, registry
+
+LOG_FIELDS = ("client", "method", "path", "route", "status", "latency_ms")
+
+DROPPED = registry.register(
+    Counter("access_log_dropped_total", "Access log records dropped on a full queue")
+)
+
+logger = logging.getLogger("api.access")
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    QueueHandler with a queue of limited size, when the writer falls behind records
+    are dropped (policy "drop") or the request waits up to timeout seconds for room
+    before dropping (policy "block")
+    """
+
+    def __init__(
+        self, maxsize: int = 10000, policy: str = "drop", timeout: float = 0.1
+    ):
+        if policy not in ("drop", "block"):
+            raise ValueError(f"Unknown access log queue policy <{policy}>")
+        super().__init__(queue.Queue(maxsize))
+        self.policy = policy
+        self.timeout = timeout
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the listener runs in this process, so the record is formatted there
+        # instead of on the event loop (QueueHandler formats it here by default)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if self.policy == "block":
+                # bounded, this runs on the event loop and stalls every request
+                self.queue.put(record, timeout=self.timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc()
+
+
+class RotatingLogFileHandler(RotatingFileHandler):
+    """
+    Rotates once the file exceeds max_bytes or every interval seconds, whichever
+    comes first (0 turns either off), keeping numbered backups
+    """
+
+    def __init__(
+        self, filename: str, max_bytes: int = 0, interval: float = 0, backups: int = 5
+    ):
+        super().__init__(
+            filename, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True
+        )
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the request fields of access log records
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            if (value := getattr(record, field, None)) is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def build_formatter(fmt: str) -> logging.Formatter:
+    if fmt == "json":
+        return JsonFormatter()
+    if fmt == "text":
+        return logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    raise ValueError(f"Unknown access log format <{fmt}>")
+
+
+def start_access_log() -> QueueListener:
+    """
+    Route the access logger through a bounded queue to a rotating file,
+    returns the started listener, stop() it to flush the queue on shutdown.
+    A {pid} in the file name gives every worker process a file of its own.
+    """
+    file_handler = RotatingLogFileHandler(
+        settings.access_log_file.replace("{pid}", str(os.getpid())),
+        max_bytes=settings.access_log_max_bytes,
+        interval=settings.access_log_rotate_seconds,
+        backups=settings.access_log_backups,
+    )
+    file_handler.setFormatter(build_formatter(settings.access_log_format))
+    queue_handler = BoundedQueueHandler(
+        settings.access_log_queue_size,
+        settings.access_log_queue_policy,
+        settings.access_log_queue_timeout,
+    )
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(queue_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    listener = QueueListener(queue_handler.queue, file_handler)
+    listener.start()
+    return listener
+
+
+def stop_access_log(listener: QueueListener):
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+
+class AccessLogMiddleware:
+    """
+    ASGI middleware logging one record per request, including its latency
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            latency = (time.perf_counter() - started) * 1000
+            client = scope.get("client")
+            client = client[0] if client else "-"
+            method, path = scope["method"], scope["path"]
+            logger.info(
+                '%s - "%s %s" %s %.2fms',
+                client,
+                method,
+                path,
+                status,
+                latency,
+                extra={
+                    "client": client,
+                    "method": method,
+                    "path": path,
+                    "route": getattr(scope.get("route"), "path", None),
+                    "status": status,
+                    "latency_ms": round(latency, 3),
+                },
+            )
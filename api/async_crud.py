@@ -0,0 +1,278 @@
+"""
+Awaitable versions of api.crud for the request handlers.
+
+Each function takes either backend's session: an AsyncSession is queried natively,
+a sync Session is handed to the matching api.crud function on the threadpool.
+Either way no SQLite or bcrypt work runs on the event loop.
+"""
+
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Tuple
+
+from sqlalchemy.engine import Row
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from api import crud
+from api.cache import MISSING
+from api.db import AnySession
+from api.hashing import hash_pool
+from api.model import (
+    Client,
+    RefreshTokenFamily,
+    RevokedToken,
+    User,
+    UserCreate,
+    UserShow,
+)
+
+
+# Create
+async def create_user(
+    user: UserCreate, session: AnySession, hashed_password: str | None = None
+) -> UserShow:
+    if hashed_password is None:
+        hashed_password = await hash_pool.hash(user.password)
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(
+            crud.create_user, user, session, hashed_password
+        )
+
+    new_user = User(email=user.email, hashed_password=hashed_password)
+    session.add(new_user)
+    try:
+        await session.flush()
+        created = UserShow.from_orm(new_user)
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    crud.forget_users(created.email)
+    return created
+
+
+# Retrieve
+async def get_user(email: str, session: AnySession) -> User:
+    # cache hits skip the threadpool as well as the database
+    if (this_user := crud.user_cache.get(crud.normalize_email(email))) is not MISSING:
+        return this_user
+    version = crud.user_cache.version
+    this_user = await load_user(email=email, session=session)
+    crud.cache_user(email, this_user, version)
+    return this_user
+
+
+async def load_user(email: str, session: AnySession) -> User:
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(crud.load_user, email, session)
+
+    result = await session.exec(crud.user_by_email(email))
+    return result.first()
+
+
+async def get_all_users(session: AnySession) -> List[User]:
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(crud.get_all_users, session)
+
+    result = await session.exec(select(User))
+    return result.all()
+
+
+async def get_users_page(
+    session: AnySession, after: int | None = None, limit: int = 100
+) -> List[Row]:
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(crud.get_users_page, session, after, limit)
+
+    result = await session.execute(crud.user_page(after, limit))
+    return result.all()
+
+
+async def iter_users(
+    session: AnySession, after: int | None = None, chunk_size: int = 500
+) -> AsyncIterator[List[Row]]:
+    if not isinstance(session, AsyncSession):
+        async for rows in iterate_in_threadpool(
+            crud.iter_users(session, after, chunk_size)
+        ):
+            yield rows
+        return
+
+    result = await session.stream(crud.user_page(after))
+    async for rows in result.partitions(chunk_size):
+        yield rows
+
+
+# Update
+async def update_user(email: str, session: AnySession, **kwargs) -> User | None:
+    # hash a new password on the pool rather than in api.crud
+    if (password := kwargs.pop("password", None)) and not kwargs.get(
+        "hashed_password"
+    ):
+        kwargs["hashed_password"] = await hash_pool.hash(password)
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(
+            lambda: crud.update_user(email=email, session=session, **kwargs)
+        )
+
+    if not (values := crud.user_values(**kwargs)):
+        return await load_user(email=email, session=session)
+    dialect = crud.session_dialect(session)
+    try:
+        if crud.changes_credentials(**kwargs):
+            await session.execute(crud.token_family_revocation(email))
+        result = await session.execute(crud.user_update(email, values, dialect))
+        if dialect.full_returning:
+            row = result.first()
+        elif result.rowcount:
+            row = (await session.execute(crud.updated_user(email, values))).first()
+        else:
+            row = None
+        revoked = row is not None and crud.revokes_access(**kwargs)
+        if revoked:
+            await session.execute(crud.token_watermark(email, dialect))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    crud.forget_users(email, values.get("email", email))
+    if revoked:
+        crud.token_changes.bump()
+    return User(**row._mapping) if row else None
+
+
+async def upgrade_password_hash(
+    email: str, hashed_password: str, new_hash: str, session: AnySession
+) -> bool:
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(
+            crud.upgrade_password_hash, email, hashed_password, new_hash, session
+        )
+
+    try:
+        result = await session.execute(
+            crud.password_upgrade(email, hashed_password, new_hash)
+        )
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    crud.forget_users(email)
+    return result.rowcount == 1
+
+
+# Delete
+async def delete_user(email: str, session: AnySession) -> bool:
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(crud.delete_user, email, session)
+
+    try:
+        await session.execute(crud.token_family_revocation(email))
+        deleted = (await session.execute(crud.user_deletion(email))).rowcount == 1
+        if deleted:
+            dialect = crud.session_dialect(session)
+            await session.execute(crud.token_watermark(email, dialect))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    crud.forget_users(email)
+    if deleted:
+        crud.token_changes.bump()
+    return deleted
+
+
+# Refresh token families
+async def create_token_family(family: RefreshTokenFamily, session: AnySession):
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(crud.create_token_family, family, session)
+
+    session.add(family)
+    try:
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
+async def rotate_token_family(
+    family_id: str, jti: str, new_jti: str, expires: datetime, session: AnySession
+) -> bool:
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(
+            crud.rotate_token_family, family_id, jti, new_jti, expires, session
+        )
+
+    try:
+        result = await session.execute(
+            crud.token_rotation(family_id, jti, new_jti, expires)
+        )
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    return result.rowcount == 1
+
+
+async def revoke_token_family(family_id: str, session: AnySession):
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(crud.revoke_token_family, family_id, session)
+
+    try:
+        await session.execute(crud.token_family_revocation(family_id=family_id))
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+
+
+# Access token revocation
+async def revoke_access_token(
+    jti: str, email: str, expires: datetime, session: AnySession
+):
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(
+            crud.revoke_access_token, jti, email, expires, session
+        )
+
+    dialect = crud.session_dialect(session)
+    try:
+        await session.execute(
+            crud.insert_ignore(RevokedToken, dialect).values(
+                jti=jti, email=email, expires=expires
+            )
+        )
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    crud.token_changes.bump()
+
+
+async def is_token_revoked(jti: str, session: AnySession) -> bool:
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(crud.is_token_revoked, jti, session)
+
+    return await session.get(RevokedToken, jti) is not None
+
+
+async def get_active_revocations(
+    session: AnySession,
+) -> Tuple[List[str], Dict[str, float]]:
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(crud.get_active_revocations, session)
+
+    tokens, watermarks = crud.active_revocations()
+    return (
+        (await session.exec(tokens)).all(),
+        dict((await session.execute(watermarks)).all()),
+    )
+
+
+# Clients
+async def get_client(client_id: str, session: AnySession) -> Client | None:
+    if not isinstance(session, AsyncSession):
+        return await run_in_threadpool(crud.get_client, client_id, session)
+
+    return await session.get(Client, client_id)
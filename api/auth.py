@@ -1,80 +1,312 @@
+import hashlib
+import time
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-
-from fastapi import APIRouter, Depends, status
-from fastapi.exceptions import HTTPException
+from uuid import uuid4
+
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    Form,
+    Request,
+    Response,
+    status,
+)
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
+from jose.exceptions import JWKError
 
-from api import crud
+from api import async_crud as crud
+from api.cache import MISSING, TTLCache
 from api.config import settings
-from api.db import Session, get_session
-from api.exceptions import InvalidCredentialException
-from api.model import Token, TokenRefresh, User, UserIn, UserShow
+from api.db import AnySession, get_db
+from api.exceptions import (
+    InsufficientScopeException,
+    InvalidCredentialException,
+    InvalidTokenException,
+    NotAdminException,
+    ServiceBusyException,
+)
+from api.hashing import hash_pool
+from api.keys import key_manager
+from api.metrics import phase, track_cache
+from api.ratelimit import client_address, login_limiter
+from api.revocation import revocation_list
+from api.model import (
+    RefreshTokenFamily,
+    Token,
+    TokenIntrospection,
+    TokenRefresh,
+    User,
+    UserIn,
+)
+from api.serialization import JSONResponse, JSONRoute
 
 oauth_scheme = OAuth2PasswordBearer(tokenUrl="admin_token")
 
-router = APIRouter(tags=["Token"])
+# scope of the client tokens of resource servers calling /introspect/
+INTROSPECT_SCOPE = "introspect"
+
+# verified access token claims by token digest, each entry expires with its token
+claims_cache = TTLCache(settings.introspection_cache_size, ttl=0)
+track_cache(claims_cache, "claims")
+
+router = APIRouter(tags=["Token"], route_class=JSONRoute)
 
 
-def authenticate_user(user: UserIn, session: Session) -> User:
-    this_user = crud.get_user(email=user.email, session=session)
+async def authenticate_user(
+    user: UserIn,
+    session: AnySession,
+    background_tasks: BackgroundTasks | None = None,
+) -> User:
+    this_user = await crud.get_user(email=user.email, session=session)
 
     if not this_user:
         return False
 
-    if not settings.pwd_context.verify(user.password, this_user.hashed_password):
+    if not await hash_pool.verify(user.password, this_user.hashed_password):
         return False
 
+    # upgrade outdated hashes after the response has been sent
+    hashed_password = this_user.hashed_password
+    if background_tasks is not None and settings.pwd_context.needs_update(
+        hashed_password
+    ):
+        background_tasks.add_task(
+            rehash_password, this_user.email, user.password, hashed_password, session
+        )
+
+    return this_user
+
+
+async def login_user(
+    user: UserIn,
+    request: Request,
+    session: AnySession,
+    background_tasks: BackgroundTasks | None = None,
+) -> User:
+    """
+    authenticate_user behind the login rate limiter, throttled clients and locked
+    accounts are rejected with a 429 before the user is looked up or bcrypt runs
+    """
+    if login_limiter is None:
+        return await authenticate_user(user, session, background_tasks)
+
+    client = client_address(request)
+    await login_limiter.check(client, user.email)
+    this_user = await authenticate_user(user, session, background_tasks)
+    if this_user:
+        await login_limiter.succeeded(client, user.email)
+    else:
+        await login_limiter.failed(client, user.email)
     return this_user
 
 
+async def rehash_password(
+    email: str, password: str, hashed_password: str, session: AnySession
+):
+    try:
+        new_hash = await hash_pool.hash(password)
+    except ServiceBusyException:
+        # try again on a later login
+        return
+    await crud.upgrade_password_hash(email, hashed_password, new_hash, session=session)
+
+
 # JWT token
+def token_expiry(expires_minutes: int | None = None) -> datetime:
+    if expires_minutes:
+        return datetime.utcnow() + timedelta(minutes=expires_minutes)
+    return datetime.utcnow() + timedelta(minutes=15)
+
+
+def new_token_id() -> str:
+    return uuid4().hex
+
+
 def create_jwt_token(
     email: str,
-    secret: str,
+    secret,
     expires_minutes: int | None = None,
+    algorithm: str = "HS256",
+    headers: dict | None = None,
+    **claims,
 ):
-    payload = {"sub": email}
-    if expires_minutes:
-        expires = datetime.utcnow() + timedelta(minutes=expires_minutes)
-    else:
-        expires = datetime.utcnow() + timedelta(minutes=15)
+    payload = {"sub": email, **claims}
+    expires = token_expiry(expires_minutes)
 
     payload.update({"exp": expires})
-    encoded_jwt = jwt.encode(payload, secret, algorithm="HS256")
+    with phase("jwt_encode"):
+        encoded_jwt = jwt.encode(payload, secret, algorithm=algorithm, headers=headers)
     return encoded_jwt
 
 
-def create_access_token(email: str):
+def create_access_token(
+    email: str, is_admin: bool = False, expires_minutes: int | None = None, **claims
+):
+    # jti and iat (to the microsecond) make the token revocable, see api.revocation,
+    # adm is the role of the user when the token was issued
+    claims = {"jti": new_token_id(), "iat": time.time(), "adm": bool(is_admin), **claims}
+    expires_minutes = expires_minutes or settings.access_token_expiry
+    if settings.jwt_algorithm == "HS256":
+        return create_jwt_token(
+            email, settings.access_token_secret, expires_minutes, **claims
+        )
+
+    # signed with the current private key, resource servers verify it with the JWKS
+    key = key_manager.signing_key()
     return create_jwt_token(
-        email, settings.access_token_secret, settings.access_token_expiry
+        email,
+        key.signer,
+        expires_minutes,
+        algorithm=key.algorithm,
+        headers={"kid": key.kid},
+        **claims,
     )
 
 
-def create_refresh_token(email: str):
-    return create_jwt_token(
-        email, settings.refresh_token_secret, settings.refresh_token_expiry
-    )
+def decode_access_token(token: str) -> dict:
+    """
+    Verify an access token and return its claims, raises JWTError for invalid tokens.
+    A token seen before is answered from claims_cache without verifying it again.
+    """
+    digest = hashlib.sha256(token.encode()).digest()
+    if (claims := claims_cache.get(digest)) is not MISSING:
+        return claims
+
+    with phase("jwt_decode"):
+        if settings.jwt_algorithm == "HS256":
+            claims = jwt.decode(token, settings.access_token_secret, algorithms=["HS256"])
+        else:
+            try:
+                kid = jwt.get_unverified_header(token).get("kid")
+                key = key_manager.verification_key(kid)
+            except JWKError as error:
+                raise JWTError(error)
+            claims = jwt.decode(token, key.verifier, algorithms=[key.algorithm])
+    if exp := claims.get("exp"):
+        claims_cache.set(digest, claims, ttl=exp - time.time())
+    return claims
+
+
+async def verify_access_token(token: str, session: AnySession) -> dict:
+    """
+    decode_access_token that also rejects revoked tokens with a JWTError
+    """
+    claims = decode_access_token(token)
+    if await revocation_list.is_revoked(claims, session):
+        raise JWTError("Token has been revoked")
+    return claims
 
 
-def get_user_from_refresh_token(token: str, session: Session) -> UserShow:
+@dataclass(frozen=True)
+class Principal:
+    email: str
+    is_admin: bool
+    claims: dict
+
+
+async def current_principal(
+    request: Request,
+    token: str = Depends(oauth_scheme),
+    session: AnySession = Depends(get_db),
+) -> Principal:
+    """
+    The verified bearer of the request's access token. The token is verified
+    once per request, the principal is kept on request.state
+    """
+    if (principal := getattr(request.state, "principal", None)) is not None:
+        return principal
     try:
-        payload = jwt.decode(token, settings.refresh_token_secret, algorithms=["HS256"])
-        email = payload.get("sub")
+        claims = await verify_access_token(token, session)
+    except JWTError:
+        raise InvalidTokenException
+    principal = Principal(
+        email=claims["sub"], is_admin=bool(claims.get("adm")), claims=claims
+    )
+    request.state.principal = principal
+    return principal
+
+
+async def require_admin(principal: Principal = Depends(current_principal)) -> Principal:
+    # the role is a claim of the signed token, no user is loaded
+    if not principal.is_admin:
+        raise NotAdminException
+    return principal
+
+
+async def require_introspector(
+    principal: Principal = Depends(current_principal),
+) -> Principal:
+    # RFC 7662 2.1: the protected resource asking has to authenticate, with a
+    # client token (see api.clients) carrying the introspect scope, or an admin
+    scopes = (principal.claims.get("scope") or "").split()
+    if not (principal.is_admin or INTROSPECT_SCOPE in scopes):
+        raise InsufficientScopeException(INTROSPECT_SCOPE)
+    return principal
+
 
-        # if user does not exist
-        user = crud.get_user(email=email, session=session)
-        if not user:
-            raise InvalidCredentialException
+def create_refresh_token(email: str, family: str, jti: str):
+    return create_jwt_token(
+        email,
+        settings.refresh_token_secret,
+        settings.refresh_token_expiry,
+        fam=family,
+        jti=jti,
+    )
+
+
+async def issue_refresh_token(email: str, session: AnySession) -> str:
+    """
+    Start a new refresh token family for a login
+    """
+    family, jti = new_token_id(), new_token_id()
+    await crud.create_token_family(
+        RefreshTokenFamily(
+            id=family,
+            email=email,
+            jti=jti,
+            expires=token_expiry(settings.refresh_token_expiry),
+        ),
+        session=session,
+    )
+    return create_refresh_token(email, family, jti)
 
-        # if refresh tokens do not match
-        if user.refresh_token != token:
-            raise InvalidCredentialException
 
+async def rotate_refresh_token(token: str, session: AnySession) -> tuple[str, str]:
+    """
+    Exchange a refresh token for the next one of its family, returns (email, new token).
+    Replaying any earlier token of a family revokes the whole family.
+    """
+    try:
+        with phase("jwt_decode"):
+            payload = jwt.decode(token, settings.refresh_token_secret, algorithms=["HS256"])
     except JWTError:
         raise InvalidCredentialException
 
-    return email
+    email, family, jti = payload.get("sub"), payload.get("fam"), payload.get("jti")
+    if not (email and family and jti):
+        raise InvalidCredentialException
+
+    new_jti = new_token_id()
+    expires = token_expiry(settings.refresh_token_expiry)
+    if not await crud.rotate_token_family(family, jti, new_jti, expires, session):
+        await crud.revoke_token_family(family, session=session)
+        raise InvalidCredentialException
+
+    return email, create_refresh_token(email, family, new_jti)
+
+
+def token_response(access_token: str, refresh_token: str | None = None) -> JSONResponse:
+    # the body of Token, built here rather than validated against response_model
+    return JSONResponse(
+        {
+            "access_token": access_token,
+            "refresh_token": refresh_token,
+            "token_type": "bearer",
+        }
+    )
 
 
 @router.post(
@@ -83,21 +315,21 @@ def get_user_from_refresh_token(token: str, session: Session) -> UserShow:
     summary="Allow admin to login via webform and obtain an access token for this server",
 )
 async def admin_token(
+    request: Request,
+    background_tasks: BackgroundTasks,
     form: OAuth2PasswordRequestForm = Depends(),
-    session: Session = Depends(get_session),
+    session: AnySession = Depends(get_db),
 ):
     user_in = UserIn(email=form.username, password=form.password)
-    user = authenticate_user(user_in, session=session)
+    user = await login_user(user_in, request, session, background_tasks)
     if not user:
         raise InvalidCredentialException
 
     if not user.is_admin:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN, detail="Not an admin user"
-        )
+        raise NotAdminException
 
-    access_token = create_access_token(user.email)
-    return {"access_token": access_token, "token_type": "bearer"}
+    access_token = create_access_token(user.email, is_admin=True)
+    return token_response(access_token)
 
 
 @router.post(
@@ -107,41 +339,116 @@ async def admin_token(
 )
 async def access_token(
     user: UserIn,
-    session: Session = Depends(get_session),
+    request: Request,
+    background_tasks: BackgroundTasks,
+    session: AnySession = Depends(get_db),
 ):
     """
     Accept user email and password (UserIn) and generate an access token
     """
-    the_user = authenticate_user(user=user, session=session)
+    the_user = await login_user(user, request, session, background_tasks)
     if not the_user:
         raise InvalidCredentialException
-    access_token = create_access_token(the_user.email)  # access token expires in 15mins
-    refresh_token = create_refresh_token(
-        the_user.email
-    )  # refresh token expires in 24hrs
-
-    # save refresh token to db
-    crud.update_user(email=the_user.email, session=session, refresh_token=refresh_token)
-
-    return {
-        "access_token": access_token,
-        "token_type": "bearer",
-        "refresh_token": refresh_token,
-    }
+    # access token expires in 15mins
+    access_token = create_access_token(the_user.email, the_user.is_admin)
+    # refresh token expires in 3hrs, its family record is stored outside the user table
+    refresh_token = await issue_refresh_token(the_user.email, session=session)
+    return token_response(access_token, refresh_token)
 
 
 @router.post(
     "/refresh/",
     response_model=Token,
-    summary="Renew access_token using a valid refresh_token",
+    summary="Renew access_token and rotate refresh_token using a valid refresh_token",
 )
 async def renew_access_token(
     token: TokenRefresh,
-    session: Session = Depends(get_session),
+    session: AnySession = Depends(get_db),
 ):
     """
-    Accept a refresh token and generate an access token
+    Accept a refresh token and generate an access token plus the next refresh token
     """
-    user = get_user_from_refresh_token(token.refresh_token, session=session)
-    access_token = create_access_token(user)
-    return {"access_token": access_token, "token_type": "bearer"}
+    email, refresh_token = await rotate_refresh_token(
+        token.refresh_token, session=session
+    )
+    # the role may have changed since the login
+    if not (user := await crud.get_user(email=email, session=session)):
+        raise InvalidCredentialException
+    access_token = create_access_token(email, user.is_admin)
+    return token_response(access_token, refresh_token)
+
+
+@router.post(
+    "/introspect/",
+    response_model=TokenIntrospection,
+    response_model_exclude_none=True,
+    summary="Check whether an access_token is active and return its claims (RFC 7662)",
+)
+async def introspect(
+    token: str = Form(...),
+    token_type_hint: str | None = Form(None),
+    session: AnySession = Depends(get_db),
+    _=Depends(require_introspector),
+):
+    """
+    Accept an access token as form data, inactive tokens only return active=false.
+    The caller authenticates with a bearer token of a client with the introspect
+    scope, or of an admin
+    """
+    try:
+        claims = await verify_access_token(token, session)
+    except JWTError:
+        return {"active": False}
+    return {"active": True, "token_type": "access_token", **claims}
+
+
+@router.post(
+    "/revoke/",
+    summary="Revoke an access_token or the login of a refresh_token (RFC 7009)",
+)
+async def revoke(
+    token: str = Form(...),
+    token_type_hint: str | None = Form(None),
+    session: AnySession = Depends(get_db),
+):
+    """
+    Accept a token as form data, holding a token is enough to revoke it. Unknown
+    and invalid tokens are ignored, the response is the same either way
+    """
+    try:
+        claims = decode_access_token(token)
+    except JWTError:
+        claims = None
+    if claims is not None:
+        if jti := claims.get("jti"):
+            expires = datetime.utcfromtimestamp(claims["exp"])
+            await crud.revoke_access_token(jti, claims["sub"], expires, session)
+        return Response(status_code=status.HTTP_200_OK)
+
+    # otherwise the refresh token of a login, which ends the whole login
+    try:
+        with phase("jwt_decode"):
+            payload = jwt.decode(token, settings.refresh_token_secret, algorithms=["HS256"])
+    except JWTError:
+        return Response(status_code=status.HTTP_200_OK)
+    if family := payload.get("fam"):
+        await crud.revoke_token_family(family, session=session)
+    return Response(status_code=status.HTTP_200_OK)
+
+
+@router.get(
+    "/.well-known/jwks.json",
+    summary="Public keys that verify access_tokens signed with RS256 / ES256",
+)
+async def jwks(request: Request):
+    """
+    The JWK set is empty while access tokens are signed with the HS256 secret
+    """
+    body = key_manager.jwks() if key_manager else b'{"keys":[]}'
+    headers = {
+        "ETag": f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+        "Cache-Control": f"public, max-age={settings.jwks_max_age}",
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
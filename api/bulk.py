@@ -0,0 +1,265 @@
+"""
+Bulk user import and export.
+
+    python -m api.bulk import users.csv [--format csv] [--batch-size 1000] [--workers 8]
+    python -m api.bulk export [users.ndjson] [--format ndjson]
+
+Imports accept a JSON array, NDJSON or CSV (with a header row) of objects with
+`email`, either `password` or an existing bcrypt/argon2/pbkdf2 `hashed_password`
+(argon2 needs argon2-cffi installed), and optionally `is_admin`. Passwords are hashed across a process pool of
+their own from the command line, on the bounded hash pool of the server over
+HTTP, and the users are inserted in batches inside one transaction.
+Rows that fail validation or whose email already exists are reported without
+aborting the import.
+"""
+
+import argparse
+import csv
+import io
+import sys
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from pydantic import BaseModel, EmailStr, ValidationError, root_validator, validator
+from sqlalchemy import func
+from sqlalchemy.engine import Row
+from sqlmodel import Session, select
+
+from api import crud
+from api.config import settings
+from api.db import engine
+from api.hashing import can_verify, hash_many
+from api.model import BulkResult, BulkRowError, User
+from api.serialization import dumps, loads
+
+FORMATS = {
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "text/csv": "csv",
+}
+
+# keeps IN (...) lookups below the sqlite bound parameter limit
+LOOKUP_CHUNK = 500
+
+
+class BulkUser(BaseModel):
+    email: EmailStr
+    password: Optional[str] = None
+    # an existing bcrypt, argon2 or pbkdf2 hash is imported as it is
+    hashed_password: Optional[str] = None
+    is_admin: bool = False
+
+    @root_validator(skip_on_failure=True)
+    def password_or_hash(cls, values):
+        if bool(values.get("password")) == bool(values.get("hashed_password")):
+            raise ValueError("Provide either password or hashed_password")
+        return values
+
+    @validator("hashed_password")
+    def known_scheme(cls, value):
+        # hashes this server could not verify would lock the user out
+        if value and not can_verify(value):
+            raise ValueError("Unsupported password hash")
+        return value
+
+
+def read_rows(data: bytes | str, fmt: str) -> List[dict]:
+    """
+    Parse an upload into a list of row objects, raises ValueError if it is malformed
+    """
+    text = data.decode("utf-8-sig") if isinstance(data, bytes) else data
+    if fmt == "json":
+        rows = loads(text)
+        if not isinstance(rows, list):
+            raise ValueError("Expected a JSON array of users")
+        return rows
+    if fmt == "ndjson":
+        return [loads(line) for line in text.splitlines() if line.strip()]
+    if fmt == "csv":
+        # empty cells fall back to the defaults
+        return [
+            {key: value for key, value in row.items() if value not in ("", None)}
+            for row in csv.DictReader(io.StringIO(text))
+        ]
+    raise ValueError(f"Unknown format <{fmt}>")
+
+
+def existing_emails(emails: List[str], session: Session) -> set:
+    """
+    The normalized emails of the ones already registered
+    """
+    found = set()
+    normalized = [crud.normalize_email(email) for email in emails]
+    for start in range(0, len(normalized), LOOKUP_CHUNK):
+        chunk = normalized[start : start + LOOKUP_CHUNK]
+        lowered = func.lower(User.email)
+        found.update(session.exec(select(lowered).where(lowered.in_(chunk))))
+    return found
+
+
+def inserted_emails(batch: List[dict], session: Session) -> set:
+    """
+    The normalized emails of the batch that were inserted, when executemany
+    only reports how many: a row skipped for a concurrent registration holds
+    another hash than the one of the batch
+    """
+    hashes = {crud.normalize_email(row["email"]): row["hashed_password"] for row in batch}
+    emails = list(hashes)
+    inserted = set()
+    lowered = func.lower(User.email)
+    for start in range(0, len(emails), LOOKUP_CHUNK):
+        chunk = emails[start : start + LOOKUP_CHUNK]
+        rows = session.execute(
+            select(lowered, User.hashed_password).where(lowered.in_(chunk))
+        )
+        inserted.update(email for email, hashed in rows if hashes[email] == hashed)
+    return inserted
+
+
+def import_users(
+    rows: Iterable[dict],
+    session: Session,
+    batch_size: int | None = None,
+    workers: int | None = None,
+    hasher: Callable[[List[str]], Iterator[str]] | None = None,
+) -> BulkResult:
+    """
+    Passwords are hashed by hasher, a process pool of `workers` by default
+    """
+    batch_size = batch_size or settings.bulk_batch_size
+    result = BulkResult()
+
+    # validate and drop duplicates within the upload
+    users: List[tuple[int, BulkUser]] = []
+    seen = set()
+    for number, row in enumerate(rows, start=1):
+        try:
+            user = BulkUser.parse_obj(row)
+        except ValidationError as error:
+            email = row.get("email") if isinstance(row, dict) else None
+            result.errors.append(
+                BulkRowError(row=number, email=email, detail=str(error))
+            )
+            continue
+        if crud.normalize_email(user.email) in seen:
+            result.conflicts.append(
+                BulkRowError(
+                    row=number, email=user.email, detail="Duplicate in upload"
+                )
+            )
+            continue
+        seen.add(crud.normalize_email(user.email))
+        users.append((number, user))
+
+    with session:
+        # drop users that already exist before spending any time hashing
+        existing = existing_emails([user.email for _, user in users], session)
+        for number, user in users:
+            if crud.normalize_email(user.email) in existing:
+                result.conflicts.append(
+                    BulkRowError(
+                        row=number, email=user.email, detail="Already exists"
+                    )
+                )
+        users = [
+            (number, user)
+            for number, user in users
+            if crud.normalize_email(user.email) not in existing
+        ]
+
+        # only plain passwords need hashing
+        passwords = [user.password for _, user in users if not user.hashed_password]
+        if hasher is None:
+            hashes = hash_many(passwords, workers or settings.bulk_hash_workers)
+        else:
+            hashes = hasher(passwords)
+        # rows registered since the lookup above are skipped rather than failing
+        # the import, and reported as conflicts
+        dialect = crud.session_dialect(session)
+        statement = crud.insert_ignore(User, dialect)
+        if dialect.insert_executemany_returning:
+            statement = statement.returning(User.email)
+        for start in range(0, len(users), batch_size):
+            numbered = users[start : start + batch_size]
+            batch = [
+                {
+                    "email": user.email,
+                    "hashed_password": user.hashed_password or next(hashes),
+                    "is_admin": user.is_admin,
+                }
+                for _, user in numbered
+            ]
+            inserted = session.execute(statement, batch)
+            if dialect.insert_executemany_returning:
+                created = {crud.normalize_email(email) for email, in inserted}
+            elif inserted.rowcount == len(batch):
+                created = {crud.normalize_email(row["email"]) for row in batch}
+            else:
+                created = inserted_emails(batch, session)
+            result.created += len(created)
+            for number, user in numbered:
+                if crud.normalize_email(user.email) not in created:
+                    result.conflicts.append(
+                        BulkRowError(
+                            row=number, email=user.email, detail="Already exists"
+                        )
+                    )
+        session.commit()
+
+    crud.forget_users(*seen)
+    result.conflicts.sort(key=lambda conflict: conflict.row)
+    return result
+
+
+def format_users(rows: List[Row], fmt: str) -> str:
+    """
+    Render (id, email) rows as NDJSON or CSV lines
+    """
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        return buffer.getvalue()
+    # the configured encoder, the same bytes as the other responses
+    return "".join(
+        dumps({"id": id, "email": email}).decode() + "\n" for id, email in rows
+    )
+
+
+def export_users(session: Session, fmt: str = "ndjson") -> Iterator[str]:
+    if fmt == "csv":
+        yield "id,email\n"
+    # every user, from no lower id bound
+    for rows in crud.iter_users(session, after=None):
+        yield format_users(rows, fmt)
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(prog="python -m api.bulk")
+    commands = parser.add_subparsers(dest="command", required=True)
+    importer = commands.add_parser("import", help="create users from a file")
+    importer.add_argument("file")
+    importer.add_argument("--format", choices=["json", "ndjson", "csv"])
+    importer.add_argument("--batch-size", type=int)
+    importer.add_argument("--workers", type=int)
+    exporter = commands.add_parser("export", help="write every user as NDJSON or CSV")
+    exporter.add_argument("file", nargs="?", help="defaults to stdout")
+    exporter.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        fmt = args.format or args.file.rsplit(".", 1)[-1]
+        with open(args.file, "rb") as upload:
+            rows = read_rows(upload.read(), fmt)
+        result = import_users(rows, Session(engine), args.batch_size, args.workers)
+        print(result.json(indent=2))
+    else:
+        output = open(args.file, "w") if args.file else sys.stdout
+        try:
+            for chunk in export_users(Session(engine), args.format):
+                output.write(chunk)
+        finally:
+            if args.file:
+                output.close()
+
+
+if __name__ == "__main__":
+    main()
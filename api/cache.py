@@ -0,0 +1,175 @@
+import multiprocessing
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+# returned by TTLCache.get for keys it does not hold
+MISSING = object()
+
+
+class SharedGeneration:
+    """
+    Invalidation counter in shared memory. Worker processes forked after it was
+    created all see its increments, see TTLCache.share()
+    """
+
+    def __init__(self):
+        self._value = multiprocessing.RawValue("Q", 0)
+        self._lock = multiprocessing.Lock()
+
+    @property
+    def value(self) -> int:
+        return self._value.value
+
+    def bump(self) -> tuple[int, int]:
+        """
+        Increment the counter, returns the values before and after
+        """
+        with self._lock:
+            previous = self._value.value
+            self._value.value = previous + 1
+        return previous, previous + 1
+
+
+class ChangeCounter:
+    """
+    Number of writes to a table, the version in the ETags of responses built
+    from it. The epoch tells the counters of different server runs apart, and
+    share() makes worker processes forked afterwards count together
+    """
+
+    def __init__(self):
+        self.epoch = secrets.token_hex(4)
+        self.shared: SharedGeneration | None = None
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def share(self, generation: SharedGeneration | None = None):
+        # must be called before the workers are forked
+        self.shared = generation or SharedGeneration()
+
+    @property
+    def value(self) -> int:
+        return self.shared.value if self.shared is not None else self._value
+
+    def bump(self):
+        if self.shared is not None:
+            self.shared.bump()
+            return
+        with self._lock:
+            self._value += 1
+
+    def etag(self, version: int | None = None) -> str:
+        return f'"{self.epoch}-{self.value if version is None else version}"'
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache whose entries expire after a time to live.
+
+    None is a valid value, so unknown keys can be cached (negatively) as well.
+    A maxsize of 0 disables the cache.
+
+    `version` changes on every invalidation, passing the version read before a
+    lookup to set() keeps a value loaded before a concurrent write out of the cache.
+
+    A shared cache drops all its entries whenever another worker process
+    invalidates any of theirs.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.shared: SharedGeneration | None = None
+        self._generation = 0
+
+    def share(self, generation: SharedGeneration | None = None):
+        """
+        Invalidate together with the other processes forked from this one,
+        must be called before the workers are forked
+        """
+        with self._lock:
+            self.shared = generation or SharedGeneration()
+            self._generation = self.shared.value
+
+    def _sync(self):
+        # drop everything once another process has invalidated entries
+        if self.shared is not None and self.shared.value != self._generation:
+            # only local writes bump the shared counter, following another
+            # worker's bump here would have them invalidate each other forever
+            self._generation = self.shared.value
+            self.version += 1
+            self._data.clear()
+
+    def _invalidated(self):
+        if self.shared is not None:
+            previous, generation = self.shared.bump()
+            if previous != self._generation:
+                self._data.clear()
+            self._generation = generation
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        with self._lock:
+            self._sync()
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        ttl: float | None = None,
+        version: int | None = None,
+    ):
+        """
+        Store value for ttl seconds (defaults to the cache ttl)
+        """
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._sync()
+            if version is not None and version != self.version:
+                return
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, *keys: Hashable):
+        with self._lock:
+            self.version += 1
+            for key in keys:
+                self._data.pop(key, None)
+            self._invalidated()
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,249 @@
+"""
+OAuth2 client credentials grant (RFC 6749 4.4) for service to service tokens.
+
+    python -m api.clients create reports --scope "users:read"
+    python -m api.clients rotate reports
+    python -m api.clients delete reports
+    python -m api.clients list
+
+Clients are registered in the client table with a generated secret, printed
+once. Secrets are random 256 bit values rather than passwords, so they are
+stored as an HMAC-SHA256 keyed with CLIENT_SECRET_PEPPER instead of a slow
+password hash: a stolen table is useless without the pepper, and checking a
+secret takes microseconds. Guessing one is out of reach, the endpoint is not
+behind the login rate limiter.
+
+Tokens are scoped and cached per client and scope until shortly before they
+expire, a service restarting or asking again gets the cached token after the
+secret is checked, without touching the database or signing anything. Rotating
+the secret or deleting the client revokes its tokens (a watermark, see
+api.revocation), which the cache checks too.
+"""
+import argparse
+import hashlib
+import hmac
+import re
+import secrets
+import sys
+import time
+from dataclasses import dataclass
+from typing import List
+from urllib.parse import unquote_plus
+
+from fastapi import APIRouter, Depends, Form
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from sqlalchemy.exc import IntegrityError
+
+from api import async_crud as crud
+from api.auth import create_access_token, new_token_id
+from api.cache import MISSING, TTLCache
+from api.config import settings
+from api.db import AnySession, get_db
+from api.exceptions import InvalidClientException, InvalidGrantRequestException
+from api.metrics import Counter, registry, track_cache
+from api.model import Client, ClientToken
+from api.revocation import revocation_list
+from api.serialization import JSONResponse, JSONRoute
+
+CLIENT_ID = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._:-]{0,63}$")
+
+ISSUED = registry.register(
+    Counter(
+        "client_tokens_issued_total",
+        "Client credentials tokens answered from the cache or newly signed",
+        ["source"],
+    )
+)
+
+# (client_id, scope) -> CachedToken, each entry expires ahead of its token
+token_cache = TTLCache(settings.client_token_cache_size, ttl=0)
+track_cache(token_cache, "client_token")
+
+basic_auth = HTTPBasic(auto_error=False)
+
+router = APIRouter(tags=["Token"], route_class=JSONRoute)
+
+
+@dataclass(frozen=True)
+class CachedToken:
+    secret_hash: str  # of the secret the token was issued for
+    access_token: str
+    scope: str | None
+    claims: dict  # the ones api.revocation checks
+    expires: float  # unix time
+
+
+def validate_client_id(client_id: str) -> str:
+    # no "@", client ids share the sub claim with user emails
+    if not CLIENT_ID.match(client_id):
+        raise ValueError(f"Invalid client id <{client_id}>")
+    return client_id
+
+
+def new_client_secret() -> str:
+    return secrets.token_urlsafe(32)
+
+
+def hash_client_secret(secret: str) -> str:
+    if not settings.client_secret_pepper:
+        raise RuntimeError("CLIENT_SECRET_PEPPER is not set")
+    key = settings.client_secret_pepper.encode()
+    return hmac.new(key, secret.encode(), hashlib.sha256).hexdigest()
+
+
+def verify_client_secret(secret: str, secret_hash: str) -> bool:
+    return hmac.compare_digest(hash_client_secret(secret), secret_hash)
+
+
+def normalize_scope(scope: str | None) -> str | None:
+    # scopes are a set, "b a" and "a b a" ask for the same token
+    if not scope or not scope.split():
+        return None
+    return " ".join(sorted(set(scope.split())))
+
+
+def granted_scope(requested: str | None, allowed: str) -> str | None:
+    """
+    The scope of the token, every scope of the client when none is requested.
+    Raises invalid_scope for scopes the client may not request
+    """
+    if requested is None:
+        return normalize_scope(allowed)
+    if not set(requested.split()) <= set(allowed.split()):
+        raise InvalidGrantRequestException("invalid_scope")
+    return requested
+
+
+def token_body(token: CachedToken) -> dict:
+    return {
+        "access_token": token.access_token,
+        "token_type": "bearer",
+        "expires_in": max(0, int(token.expires - time.time())),
+        "scope": token.scope,
+    }
+
+
+def sign_client_token(client: Client, scope: str | None) -> CachedToken:
+    lifetime = settings.client_token_expiry * 60
+    claims = {"sub": client.client_id, "jti": new_token_id(), "iat": time.time()}
+    access_token = create_access_token(
+        client.client_id,
+        expires_minutes=settings.client_token_expiry,
+        jti=claims["jti"],
+        iat=claims["iat"],
+        scope=scope,
+        client_id=client.client_id,
+    )
+    return CachedToken(
+        client.secret_hash, access_token, scope, claims, claims["iat"] + lifetime
+    )
+
+
+async def issue_client_token(
+    client_id: str, secret: str, scope: str | None, session: AnySession
+) -> dict:
+    """
+    The token response for the client, from the cache while its token is not
+    about to expire. Raises invalid_client for unknown clients or wrong secrets
+    """
+    key = (client_id, normalize_scope(scope))
+    cached = token_cache.get(key)
+    if cached is not MISSING and verify_client_secret(secret, cached.secret_hash):
+        if not await revocation_list.is_revoked(cached.claims, session):
+            ISSUED.inc(source="cache")
+            return token_body(cached)
+
+    client = await crud.get_client(client_id, session)
+    if client is None or not verify_client_secret(secret, client.secret_hash):
+        raise InvalidClientException
+    token = sign_client_token(client, granted_scope(key[1], client.scopes))
+    ttl = token.expires - time.time() - settings.client_token_refresh_margin
+    if ttl > 0:
+        token_cache.set(key, token, ttl=ttl)
+    ISSUED.inc(source="signed")
+    return token_body(token)
+
+
+@router.post(
+    "/client_token/",
+    response_model=ClientToken,
+    summary="Obtain an access token for a service with the client credentials grant",
+)
+async def client_token(
+    grant_type: str = Form(...),
+    scope: str | None = Form(None),
+    client_id: str | None = Form(None),
+    client_secret: str | None = Form(None),
+    credentials: HTTPBasicCredentials | None = Depends(basic_auth),
+    session: AnySession = Depends(get_db),
+):
+    """
+    Accept the client credentials as HTTP Basic authentication or as the
+    client_id and client_secret form fields, and an optional space separated scope
+    """
+    if grant_type != "client_credentials":
+        raise InvalidGrantRequestException("unsupported_grant_type")
+    if credentials is not None:
+        # Basic credentials of a client are form encoded (RFC 6749 2.3.1)
+        client_id = unquote_plus(credentials.username)
+        client_secret = unquote_plus(credentials.password)
+    if not (client_id and client_secret):
+        raise InvalidClientException
+    body = await issue_client_token(client_id, client_secret, scope, session)
+    return JSONResponse(body, headers={"Cache-Control": "no-store", "Pragma": "no-cache"})
+
+
+def main(argv: List[str] | None = None):
+    from sqlmodel import Session
+
+    from api import crud as sync_crud
+    from api.db import engine
+
+    parser = argparse.ArgumentParser(prog="python -m api.clients")
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="register a client, prints its secret")
+    create.add_argument("client_id")
+    create.add_argument("--scope", default="", help="space separated scopes it may request")
+    rotate = commands.add_parser("rotate", help="replace the secret, revokes its tokens")
+    rotate.add_argument("client_id")
+    delete = commands.add_parser("delete", help="delete a client, revokes its tokens")
+    delete.add_argument("client_id")
+    commands.add_parser("list", help="show the clients and their scopes")
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        for client in sync_crud.get_clients(Session(engine)):
+            print(f"{client.client_id}\t{client.scopes}")
+        return
+
+    if args.command == "delete":
+        if not sync_crud.delete_client(args.client_id, Session(engine)):
+            sys.exit(f"No client <{args.client_id}>")
+        return
+
+    if not settings.client_secret_pepper:
+        sys.exit("CLIENT_SECRET_PEPPER is not set")
+    secret = new_client_secret()
+    if args.command == "rotate":
+        if not sync_crud.update_client_secret(
+            args.client_id, hash_client_secret(secret), Session(engine)
+        ):
+            sys.exit(f"No client <{args.client_id}>")
+    else:
+        try:
+            client = Client(
+                client_id=validate_client_id(args.client_id),
+                secret_hash=hash_client_secret(secret),
+                scopes=normalize_scope(args.scope) or "",
+            )
+            sync_crud.create_client(client, Session(engine))
+        except ValueError as error:
+            sys.exit(str(error))
+        except IntegrityError:
+            sys.exit(f"Client <{args.client_id}> already exists")
+    # the only time the secret is shown
+    print(secret)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,130 @@
-from typing import List
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Tuple
 
+from sqlalchemy import delete, func, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Dialect, Row
+from sqlalchemy.sql import Delete, Insert, Select, Update
 from sqlmodel import Session, select
 
+from api.cache import MISSING, ChangeCounter, TTLCache
 from api.config import settings
-from api.model import User, UserCreate, UserShow
+from api.hashing import hash_pool
+from api.metrics import track_cache
+from api.model import (
+    Client,
+    RefreshTokenFamily,
+    RevokedToken,
+    TokenWatermark,
+    User,
+    UserCreate,
+    UserShow,
+)
+
+# users by email, None for emails that are not registered
+user_cache = TTLCache(settings.user_cache_size, settings.user_cache_ttl)
+track_cache(user_cache, "user")
+# writes to the user table, the version of the ETags of api.http_cache
+user_changes = ChangeCounter()
+# access token revocations, api.revocation reloads them when this changes
+token_changes = ChangeCounter()
+
+
+# Dialects
+def session_dialect(session) -> Dialect:
+    # a sync Session or the one behind an AsyncSession
+    return getattr(session, "sync_session", session).get_bind().dialect
+
+
+def insert_ignore(model, dialect: Dialect) -> Insert:
+    """
+    INSERT skipping the rows that conflict with a unique constraint,
+    ON CONFLICT DO NOTHING on sqlite and postgresql
+    """
+    if dialect.name == "postgresql":
+        return postgresql.insert(model).on_conflict_do_nothing()
+    if dialect.name == "sqlite":
+        return sqlite.insert(model).on_conflict_do_nothing()
+    raise ValueError(f"Unsupported database <{dialect.name}>")
+
+
+def upsert(model, dialect: Dialect, keys: List[str], **values) -> Insert:
+    """
+    INSERT of one row, or UPDATE of the values of the row with the same keys
+    """
+    if dialect.name == "postgresql":
+        statement = postgresql.insert(model)
+    elif dialect.name == "sqlite":
+        statement = sqlite.insert(model)
+    else:
+        raise ValueError(f"Unsupported database <{dialect.name}>")
+    statement = statement.values(**values)
+    updates = {key: statement.excluded[key] for key in values if key not in keys}
+    return statement.on_conflict_do_update(index_elements=keys, set_=updates)
 
 
 # Create
-def create_user(user: UserCreate, session: Session) -> UserShow:
-    hashed_password = settings.pwd_context.hash(user.password)
+def create_user(
+    user: UserCreate, session: Session, hashed_password: str | None = None
+) -> UserShow:
+    """
+    Insert the user, raises IntegrityError when the email is already registered
+    """
+    # async callers hash through the pool beforehand and pass the result in
+    if hashed_password is None:
+        hashed_password = hash_pool.hash_sync(user.password)
     new_user = User(email=user.email, hashed_password=hashed_password)
     with session:
         session.add(new_user)
+        # the INSERT sets the id, so nothing is read back after the commit
+        session.flush()
+        created = UserShow.from_orm(new_user)
         session.commit()
-        session.refresh(new_user)
-    return UserShow.from_orm(new_user)
+    forget_users(created.email)
+    return created
 
 
 # Retrieve
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def user_by_email(email: str) -> Select:
+    # case-insensitive, served by the ix_user_email_lower index
+    return select(User).filter(func.lower(User.email) == normalize_email(email))
+
+
+def forget_users(*emails: str):
+    # after every write to the user table
+    user_cache.pop(*(normalize_email(email) for email in emails))
+    user_changes.bump()
+
+
+def cache_user(email: str, this_user: User | None, version: int):
+    # a detached copy so callers never share an instance bound to their session
+    email = normalize_email(email)
+    if this_user is None:
+        user_cache.set(email, None, settings.user_cache_negative_ttl, version)
+    else:
+        user_cache.set(email, User.from_orm(this_user), version=version)
+
+
 def get_user(email: str, session: Session) -> User:
-    statement = select(User).filter(User.email == email)
+    if (this_user := user_cache.get(normalize_email(email))) is not MISSING:
+        return this_user
+    version = user_cache.version
+    this_user = load_user(email=email, session=session)
+    cache_user(email, this_user, version)
+    return this_user
+
+
+def load_user(email: str, session: Session) -> User:
+    """
+    get_user without the cache, for callers that modify the user
+    """
     with session:
-        this_user = session.exec(statement).first()
+        this_user = session.exec(user_by_email(email)).first()
     return this_user
 
 
@@ -32,33 +135,412 @@ def get_all_users(session: Session) -> List[User]:
     return users
 
 
+def user_page(after: int | None = None, limit: int | None = None) -> Select:
+    # keyset on the primary key and only the public columns, the first page has
+    # no lower bound (ids start at 0)
+    statement = select(User.id, User.email).order_by(User.id)
+    if after is not None:
+        statement = statement.where(User.id > after)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+
+def get_users_page(
+    session: Session, after: int | None = None, limit: int = 100
+) -> List[Row]:
+    with session:
+        users = session.exec(user_page(after, limit)).all()
+    return users
+
+
+def iter_users(
+    session: Session, after: int | None = None, chunk_size: int = 500
+) -> Iterator[List[Row]]:
+    """
+    Yield (id, email) rows in chunks straight from the database cursor
+    """
+    with session:
+        result = session.execute(
+            user_page(after).execution_options(stream_results=True)
+        )
+        yield from result.partitions(chunk_size)
+
+
 # Update
-def update_user(email: str, session: Session, **kwargs) -> User:
-    this_user = get_user(email=email, session=session)
-    if this_user:
-        with session:
-            # update password
-            if password := kwargs.get("password"):
-                this_user.hashed_password = settings.pwd_context.hash(password)
-            # update email
-            if new_email := kwargs.get("new_email"):
-                this_user.email = new_email
-            # update any other possible atrributes
-            excluded_attrs = {"id", "email", "hashed_password"}
-            for key, value in kwargs.items():
-                if key in this_user.dict(exclude=excluded_attrs):
-                    setattr(this_user, key, value)
-
-            session.add(this_user)
-            session.commit()
-            session.refresh(this_user)
-        return this_user
+def user_values(**kwargs) -> dict:
+    """
+    The column values of a user update, a new password is hashed here
+    """
+    values = {}
+    if hashed_password := kwargs.get("hashed_password"):
+        values["hashed_password"] = hashed_password
+    elif password := kwargs.get("password"):
+        values["hashed_password"] = hash_pool.hash_sync(password)
+    if new_email := kwargs.get("new_email"):
+        values["email"] = new_email
+    # any other attribute of the user
+    excluded_attrs = {"id", "email", "hashed_password"}
+    for key, value in kwargs.items():
+        if key in User.__fields__ and key not in excluded_attrs:
+            values[key] = value
+    return values
+
+
+def user_update(email: str, values: dict, dialect: Dialect) -> Update:
+    # no instances are held across the statement, so none need synchronizing
+    statement = (
+        update(User)
+        .where(func.lower(User.email) == normalize_email(email))
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    if dialect.full_returning:
+        statement = statement.returning(*User.__table__.c)
+    return statement
+
+
+def updated_user(email: str, values: dict) -> Select:
+    # without RETURNING the row is read back in the transaction of the UPDATE
+    email = values.get("email", email)
+    return select(User.__table__).where(func.lower(User.email) == normalize_email(email))
+
+
+def password_upgrade(email: str, hashed_password: str, new_hash: str) -> Update:
+    # only replaces the hash that was verified, a concurrent password change wins
+    return (
+        update(User)
+        .where(User.email == email, User.hashed_password == hashed_password)
+        .values(hashed_password=new_hash)
+    )
+
+
+def upgrade_password_hash(
+    email: str, hashed_password: str, new_hash: str, session: Session
+) -> bool:
+    """
+    Swap a verified hash for one with the current scheme and cost, the user keeps
+    their password and logins
+    """
+    with session:
+        result = session.execute(password_upgrade(email, hashed_password, new_hash))
+        session.commit()
+    forget_users(email)
+    return result.rowcount == 1
+
+
+def changes_credentials(**kwargs) -> bool:
+    # a new password or email ends every login of the user
+    return any(kwargs.get(key) for key in ("password", "hashed_password", "new_email"))
+
+
+def revokes_access(**kwargs) -> bool:
+    # access tokens carry the role as a claim, a role change revokes them too
+    return changes_credentials(**kwargs) or kwargs.get("is_admin") is not None
+
+
+def update_user(email: str, session: Session, **kwargs) -> User | None:
+    """
+    Update the user with a single UPDATE, returns the updated user or None when
+    there is no user with the email. Raises IntegrityError when new_email is taken
+    """
+    if not (values := user_values(**kwargs)):
+        return load_user(email=email, session=session)
+    with session:
+        dialect = session_dialect(session)
+        if changes_credentials(**kwargs):
+            session.execute(token_family_revocation(email))
+        result = session.execute(user_update(email, values, dialect))
+        if dialect.full_returning:
+            row = result.first()
+        elif result.rowcount:
+            row = session.execute(updated_user(email, values)).first()
+        else:
+            row = None
+        revoked = row is not None and revokes_access(**kwargs)
+        if revoked:
+            session.execute(token_watermark(email, dialect))
+        session.commit()
+    forget_users(email, values.get("email", email))
+    if revoked:
+        token_changes.bump()
+    return User(**row._mapping) if row else None
 
 
 # Delete
-def delete_user(email: str, session: Session):
-    this_user = get_user(email=email, session=session)
-    if this_user:
-        with session:
-            session.delete(this_user)
-            session.commit()
+def user_deletion(email: str) -> Delete:
+    return (
+        delete(User)
+        .where(func.lower(User.email) == normalize_email(email))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def delete_user(email: str, session: Session) -> bool:
+    """
+    Delete the user and revoke its logins, returns False when there is no user
+    with the email
+    """
+    with session:
+        session.execute(token_family_revocation(email))
+        deleted = session.execute(user_deletion(email)).rowcount == 1
+        if deleted:
+            session.execute(token_watermark(email, session_dialect(session)))
+        session.commit()
+    forget_users(email)
+    if deleted:
+        token_changes.bump()
+    return deleted
+
+
+# Refresh token families
+def token_rotation(
+    family_id: str, jti: str, new_jti: str, expires: datetime
+) -> Update:
+    # only the current, unrevoked and unexpired token of a family can be rotated
+    return (
+        update(RefreshTokenFamily)
+        .where(
+            RefreshTokenFamily.id == family_id,
+            RefreshTokenFamily.jti == jti,
+            RefreshTokenFamily.revoked == False,  # noqa: E712
+            RefreshTokenFamily.expires > datetime.utcnow(),
+        )
+        .values(jti=new_jti, expires=expires)
+    )
+
+
+def token_family_revocation(
+    email: str | None = None, family_id: str | None = None
+) -> Update:
+    statement = (
+        update(RefreshTokenFamily)
+        .values(revoked=True)
+        .execution_options(synchronize_session=False)
+    )
+    if email is not None:
+        # the families of the user with the email in any case, so it has to run
+        # before the email changes or the user is deleted
+        users = select(User.email).where(func.lower(User.email) == normalize_email(email))
+        statement = statement.where(RefreshTokenFamily.email.in_(users))
+    if family_id is not None:
+        statement = statement.where(RefreshTokenFamily.id == family_id)
+    return statement
+
+
+def create_token_family(family: RefreshTokenFamily, session: Session):
+    with session:
+        session.add(family)
+        session.commit()
+
+
+def get_token_family(family_id: str, session: Session) -> RefreshTokenFamily:
+    with session:
+        return session.get(RefreshTokenFamily, family_id)
+
+
+def rotate_token_family(
+    family_id: str, jti: str, new_jti: str, expires: datetime, session: Session
+) -> bool:
+    with session:
+        result = session.execute(token_rotation(family_id, jti, new_jti, expires))
+        session.commit()
+    return result.rowcount == 1
+
+
+def revoke_token_family(family_id: str, session: Session):
+    with session:
+        session.execute(token_family_revocation(family_id=family_id))
+        session.commit()
+
+
+# Access token revocation
+def token_watermark(email: str, dialect: Dialect) -> Insert:
+    # revokes the access tokens issued to the email until now
+    return upsert(
+        TokenWatermark,
+        dialect,
+        ["email"],
+        email=normalize_email(email),
+        issued_before=time.time(),
+    )
+
+
+def revoke_access_token(jti: str, email: str, expires: datetime, session: Session):
+    with session:
+        session.execute(
+            insert_ignore(RevokedToken, session_dialect(session)).values(
+                jti=jti, email=email, expires=expires
+            )
+        )
+        session.commit()
+    token_changes.bump()
+
+
+def is_token_revoked(jti: str, session: Session) -> bool:
+    with session:
+        return session.get(RevokedToken, jti) is not None
+
+
+def active_revocations() -> Tuple[Select, Select]:
+    # revoked tokens that have not expired, watermarks younger than any token
+    now = datetime.utcnow()
+    oldest_token = time.time() - token_lifetime().total_seconds()
+    return (
+        select(RevokedToken.jti).where(RevokedToken.expires > now),
+        select(TokenWatermark.email, TokenWatermark.issued_before).where(
+            TokenWatermark.issued_before > oldest_token
+        ),
+    )
+
+
+def get_active_revocations(session: Session) -> Tuple[List[str], Dict[str, float]]:
+    """
+    The jtis of the revoked tokens and the watermarks by email that still matter
+    """
+    tokens, watermarks = active_revocations()
+    with session:
+        return (
+            session.exec(tokens).all(),
+            dict(session.execute(watermarks).all()),
+        )
+
+
+def token_lifetime() -> timedelta:
+    # of the longest lived access tokens, user or client ones
+    minutes = max(settings.access_token_expiry or 15, settings.client_token_expiry)
+    return timedelta(minutes=minutes)
+
+
+def prune_revocations(session: Session) -> int:
+    """
+    Delete the revoked tokens and watermarks that no token can match any more,
+    returns the rows deleted
+    """
+    oldest_token = time.time() - token_lifetime().total_seconds()
+    with session:
+        deleted = session.execute(
+            delete(RevokedToken)
+            .where(RevokedToken.expires <= datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        deleted += session.execute(
+            delete(TokenWatermark)
+            .where(TokenWatermark.issued_before <= oldest_token)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        session.commit()
+    return deleted
+
+
+def expired_token_families(limit: int) -> Delete:
+    # a batch of the refresh token families that can not be rotated any more
+    expired = (
+        select(RefreshTokenFamily.id)
+        .where(RefreshTokenFamily.expires <= datetime.utcnow())
+        .limit(limit)
+    )
+    return (
+        delete(RefreshTokenFamily)
+        .where(RefreshTokenFamily.id.in_(expired))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def prune_token_families(limit: int, session: Session) -> int:
+    """
+    Delete a batch of expired refresh token families, returns the rows deleted
+    """
+    with session:
+        deleted = session.execute(expired_token_families(limit)).rowcount
+        session.commit()
+    return deleted
+
+
+def stale_refresh_tokens(limit: int) -> Select:
+    # a batch of the refresh tokens logins used to store on the user, token
+    # families replaced them and none of them is accepted any more
+    return (
+        select(User.id, User.email)
+        .where(User.refresh_token.is_not(None))
+        .limit(limit)
+    )
+
+
+def clear_stale_refresh_tokens(limit: int, session: Session) -> int:
+    """
+    Clear a batch of stale refresh tokens, returns the users updated
+    """
+    with session:
+        stale = session.execute(stale_refresh_tokens(limit)).all()
+        if not stale:
+            return 0
+        session.execute(
+            update(User)
+            .where(User.id.in_([row.id for row in stale]))
+            .values(refresh_token=None)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+    forget_users(*(row.email for row in stale))
+    return len(stale)
+
+
+# Clients of the client credentials grant
+def create_client(client: Client, session: Session) -> Client:
+    """
+    Register a client, raises IntegrityError when the client_id is taken
+    """
+    with session:
+        session.add(client)
+        session.commit()
+        session.refresh(client)
+    return client
+
+
+def get_client(client_id: str, session: Session) -> Client | None:
+    with session:
+        return session.get(Client, client_id)
+
+
+def get_clients(session: Session) -> List[Client]:
+    with session:
+        return session.exec(select(Client).order_by(Client.client_id)).all()
+
+
+def update_client_secret(client_id: str, secret_hash: str, session: Session) -> bool:
+    """
+    Replace the secret of a client and revoke the tokens issued with the old
+    one, returns whether the client exists
+    """
+    with session:
+        updated = session.execute(
+            update(Client)
+            .where(Client.client_id == client_id)
+            .values(secret_hash=secret_hash)
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1
+        if updated:
+            session.execute(token_watermark(client_id, session_dialect(session)))
+        session.commit()
+    if updated:
+        token_changes.bump()
+    return updated
+
+
+def delete_client(client_id: str, session: Session) -> bool:
+    """
+    Delete a client and revoke its access tokens, returns whether it existed
+    """
+    with session:
+        deleted = session.execute(
+            delete(Client)
+            .where(Client.client_id == client_id)
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1
+        if deleted:
+            session.execute(token_watermark(client_id, session_dialect(session)))
+        session.commit()
+    if deleted:
+        token_changes.bump()
+    return deleted
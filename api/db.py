@@ -1,12 +1,117 @@
-from sqlmodel import Session, SQLModel, create_engine
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlmodel import Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from api.config import settings
+from api.metrics import instrument_engine
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Apply the sqlite connection profile from settings to a new pooled connection
+    """
+    cursor = dbapi_connection.cursor()
+    # only takes effect before the first table is created
+    cursor.execute(f"PRAGMA auto_vacuum={settings.sqlite_auto_vacuum}")
+    cursor.execute(f"PRAGMA journal_mode={settings.sqlite_journal_mode}")
+    cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout)}")
+    cursor.execute(f"PRAGMA cache_size={int(settings.sqlite_cache_size)}")
+    cursor.execute(f"PRAGMA mmap_size={int(settings.sqlite_mmap_size)}")
+    cursor.close()
+
+
+# drivers of the async engine for the database of a url
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+
+
+def database_url() -> URL:
+    """
+    The configured database, database_url or else the sqlite file database
+    """
+    return make_url(settings.database_url or f"sqlite:///{settings.database}")
+
+
+def async_database_url(url: URL) -> URL:
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver for <{backend}> databases")
+    return url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+
+
+def pool_options() -> dict:
+    return {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+    }
+
+
+def create_sqlite_engine(database: str):
+    """
+    Pooled engine for a sqlite file using the configured connection profile
+    """
+    engine = create_engine(
+        f"sqlite:///{database}",
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        **pool_options(),
+    )
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
 
-engine = create_engine(f"sqlite:///{settings.database}")
+def create_async_sqlite_engine(database: str):
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{database}",
+        poolclass=AsyncAdaptedQueuePool,
+        **pool_options(),
+    )
+    event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+    return engine
 
 
-def create_db():
-    SQLModel.metadata.create_all(engine)
+def create_db_engine(url: str | URL):
+    """
+    Pooled engine for a database url, sqlite files get the sqlite connection profile
+    """
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite":
+        return create_sqlite_engine(url.database)
+    return create_engine(url, **pool_options())
+
+
+def create_async_db_engine(url: str | URL):
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite":
+        return create_async_sqlite_engine(url.database)
+    return create_async_engine(async_database_url(url), **pool_options())
+
+
+engine = create_db_engine(database_url())
+async_engine = create_async_db_engine(database_url())
+instrument_engine(engine, "sync")
+instrument_engine(async_engine.sync_engine, "async")
+
+
+def dispose_after_fork():
+    # pooled connections of the parent must not be shared with a forked worker,
+    # the child drops them without closing them and opens its own
+    engine.dispose(close=False)
+    async_engine.sync_engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=dispose_after_fork)
+
+# either backend's session, see api.async_crud
+AnySession = Session | AsyncSession
 
 
 def get_session():
@@ -15,3 +120,12 @@ def get_session():
         yield session
     finally:
         session.close()
+
+
+async def get_async_session():
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+
+# session dependency of the configured backend ("sync" or "async")
+get_db = get_async_session if settings.db_backend == "async" else get_session
@@ -1,3 +1,5 @@
+import math
+
 from fastapi import status
 from fastapi.exceptions import HTTPException
 
@@ -11,3 +13,80 @@ class InvalidCredentialException(HTTPException):
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"}
         )
+
+
+class InvalidTokenException(HTTPException):
+    def __init__(self, *args, **kwargs):
+        super().__init__(
+            *args,
+            **kwargs,
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+
+class NotAdminException(HTTPException):
+    def __init__(self, *args, **kwargs):
+        super().__init__(
+            *args,
+            **kwargs,
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not an admin user",
+        )
+
+
+class InsufficientScopeException(HTTPException):
+    # RFC 6750 3.1, the token is valid but lacks the scope
+    def __init__(self, scope: str, *args, **kwargs):
+        super().__init__(
+            *args,
+            **kwargs,
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="insufficient_scope",
+            headers={"WWW-Authenticate": f'Bearer error="insufficient_scope", scope="{scope}"'}
+        )
+
+
+class InvalidClientException(HTTPException):
+    def __init__(self, *args, **kwargs):
+        super().__init__(
+            *args,
+            **kwargs,
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="invalid_client",
+            headers={"WWW-Authenticate": "Basic"}
+        )
+
+
+class InvalidGrantRequestException(HTTPException):
+    # error codes of RFC 6749 5.2 answered with a 400
+    def __init__(self, error: str, *args, **kwargs):
+        super().__init__(
+            *args,
+            **kwargs,
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=error,
+        )
+
+
+class ServiceBusyException(HTTPException):
+    def __init__(self, *args, **kwargs):
+        super().__init__(
+            *args,
+            **kwargs,
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, please try again later",
+            headers={"Retry-After": "1"}
+        )
+
+
+class TooManyRequestsException(HTTPException):
+    def __init__(self, retry_after: float = 1, *args, **kwargs):
+        super().__init__(
+            *args,
+            **kwargs,
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, please try again later",
+            headers={"Retry-After": str(max(1, math.ceil(min(retry_after, 86400))))}
+        )
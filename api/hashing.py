@@ -0,0 +1,201 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Iterator, List
+
+from passlib.exc import MissingBackendError
+
+from api.config import settings
+from api.exceptions import ServiceBusyException
+from api.metrics import HASH_POOL, HASH_REJECTED, PHASE_SECONDS, registry
+
+
+# worker side functions (module level so a process pool can pickle them)
+def _timed(func, *args):
+    started = time.monotonic()
+    result = func(*args)
+    return result, started, time.monotonic()
+
+
+def _hash(password: str) -> str:
+    return settings.pwd_context.hash(password)
+
+
+def _verify(password: str, hashed_password: str) -> bool:
+    try:
+        return settings.pwd_context.verify(password, hashed_password)
+    except (ValueError, MissingBackendError):
+        # a malformed hash, or one of a scheme without its library installed,
+        # is a failed login rather than an error
+        return False
+
+
+def can_verify(hashed_password: str) -> bool:
+    """
+    Whether the hash is of a known scheme whose backend is installed
+    """
+    scheme = settings.pwd_context.identify(hashed_password, required=False)
+    if scheme is None:
+        return False
+    handler = settings.pwd_context.handler(scheme)
+    # schemes implemented by passlib itself have no backends to check
+    return not hasattr(handler, "has_backend") or handler.has_backend()
+
+
+@dataclass
+class HashMetrics:
+    """
+    Running totals of the time spent queueing for and inside the pool
+    """
+
+    calls: int = 0
+    rejected: int = 0
+    wait_seconds: float = 0.0
+    wait_seconds_max: float = 0.0
+    hash_seconds: float = 0.0
+    hash_seconds_max: float = 0.0
+
+    def observe(self, wait: float, duration: float):
+        self.calls += 1
+        self.wait_seconds += wait
+        self.wait_seconds_max = max(self.wait_seconds_max, wait)
+        self.hash_seconds += duration
+        self.hash_seconds_max = max(self.hash_seconds_max, duration)
+
+
+class HashPool:
+    """
+    Bounded worker pool for password hashing so bcrypt never runs on the event loop.
+
+    At most `workers + queue_depth` jobs are accepted at a time, anything beyond
+    that is rejected straight away with a 503 instead of queueing without limit.
+    """
+
+    def __init__(self, kind: str = "thread", workers: int = 4, queue_depth: int = 32):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown hash pool kind <{kind}>")
+        self.kind = kind
+        self.workers = workers
+        self.max_pending = workers + queue_depth
+        self.pending = 0
+        self.metrics = HashMetrics()
+        self._lock = threading.Lock()
+        self._executor: Executor | None = None
+
+    @property
+    def executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.kind == "process":
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix="hash"
+                    )
+            return self._executor
+
+    def submit(self, func, *args) -> Future:
+        """
+        Queue func(*args) on the pool, the future resolves to (result, started, finished)
+        """
+        executor = self.executor
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.metrics.rejected += 1
+                raise ServiceBusyException
+            self.pending += 1
+        submitted = time.monotonic()
+        try:
+            future = executor.submit(_timed, func, *args)
+        except Exception:
+            with self._lock:
+                self.pending -= 1
+            raise
+        future.add_done_callback(partial(self._done, submitted))
+        return future
+
+    def _done(self, submitted: float, future: Future):
+        with self._lock:
+            self.pending -= 1
+            if not future.cancelled() and future.exception() is None:
+                _, started, finished = future.result()
+                wait, duration = max(started - submitted, 0.0), finished - started
+                self.metrics.observe(wait, duration)
+                PHASE_SECONDS.observe(wait, phase="hash_wait")
+                PHASE_SECONDS.observe(duration, phase="hash")
+
+    async def run(self, func, *args):
+        result, *_ = await asyncio.wrap_future(self.submit(func, *args))
+        return result
+
+    def run_sync(self, func, *args):
+        result, *_ = self.submit(func, *args).result()
+        return result
+
+    # async api for request handlers
+    async def hash(self, password: str) -> str:
+        return await self.run(_hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self.run(_verify, password, hashed_password)
+
+    # blocking api for code already running off the event loop
+    def hash_sync(self, password: str) -> str:
+        return self.run_sync(_hash, password)
+
+    def verify_sync(self, password: str, hashed_password: str) -> bool:
+        return self.run_sync(_verify, password, hashed_password)
+
+    def hash_many(self, passwords: List[str]) -> Iterator[str]:
+        """
+        Hash a batch of passwords in order with at most `workers` of them in the
+        pool at a time, so a bulk import shares the pool with the logins. Blocks,
+        and raises ServiceBusyException like any other job when the pool is full
+        """
+        pending: deque[Future] = deque()
+        for password in passwords:
+            if len(pending) >= self.workers:
+                yield pending.popleft().result()[0]
+            pending.append(self.submit(_hash, password))
+        while pending:
+            yield pending.popleft().result()[0]
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def hash_many(passwords: List[str], workers: int | None = None) -> Iterator[str]:
+    """
+    Hash a batch of passwords across a process pool of its own, for bulk imports
+    from the command line (the server uses hash_pool.hash_many). Hashes are
+    yielded in order while later ones are still being computed.
+    """
+    if not passwords:
+        return
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, min(64, len(passwords) // (workers * 4)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(_hash, passwords, chunksize=chunksize)
+
+
+hash_pool = HashPool(
+    kind=settings.hash_pool,
+    workers=settings.hash_pool_workers,
+    queue_depth=settings.hash_queue_depth,
+)
+
+
+@registry.add_collector
+def collect_hash_pool():
+    HASH_POOL.set(hash_pool.workers, state="workers")
+    HASH_POOL.set(hash_pool.pending, state="pending")
+    HASH_POOL.set(hash_pool.max_pending, state="max_pending")
+    HASH_REJECTED.set(hash_pool.metrics.rejected)
@@ -0,0 +1,79 @@
+"""
+Conditional GETs of the user endpoints.
+
+Responses carry a strong ETag made of the change counter of the user table,
+api.crud.user_changes, which every write through api.crud bumps, and of the
+current period of users_etag_seconds. A request whose If-None-Match holds the
+current ETag is answered with a 304 before the database is touched, and pages
+of GET /users/ are kept as serialized JSON until the next write. Writes that
+bypass this server's api.crud (python -m api.bulk, another host, the sqlite
+shell) are not counted, the ETag still changes with the period, so they show
+within users_etag_seconds.
+"""
+import time
+from typing import List, Tuple
+
+from fastapi import Request, Response, status
+from sqlalchemy.engine import Row
+
+from api.cache import TTLCache
+from api.config import settings
+from api.crud import user_changes
+from api.metrics import track_cache
+from api.model import User
+from api.serialization import dumps
+
+# (version, after, limit) -> (JSON body, Link header or None)
+page_cache = TTLCache(settings.users_page_cache_size, settings.user_cache_ttl)
+track_cache(page_cache, "users_page")
+
+
+def user_table_version() -> Tuple[Tuple[int, int], str]:
+    """
+    The current version of the user table and its ETag, read before the
+    database so a concurrent write can only make the response look older
+    """
+    version = user_changes.value
+    seconds = settings.users_etag_seconds
+    period = int(time.time() // seconds) if seconds > 0 else 0
+    return (version, period), f'"{user_changes.epoch}-{version}-{period}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    # If-None-Match uses the weak comparison, W/"x" matches "x"
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def cache_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": settings.users_cache_control}
+
+
+def not_modified(request: Request, etag: str) -> Response | None:
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers(etag)
+        )
+    return None
+
+
+def public_user(user: User | Row) -> dict:
+    # the UserShow fields of a row of the user table, the table is trusted and
+    # not validated again
+    return {"id": user.id, "email": user.email}
+
+
+def serialize_page(users: List[Row], limit: int) -> Tuple[bytes, str | None]:
+    """
+    The JSON body of a page of GET /users/ and the Link header of the next page
+    """
+    body = dumps([public_user(user) for user in users])
+    link = None
+    if len(users) == limit:
+        link = f'</users/?after={users[-1].id}&limit={limit}>; rel="next"'
+    return body, link
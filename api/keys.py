@@ -0,0 +1,272 @@
+"""
+Signing keys for asymmetric access tokens (RS256 / ES256).
+
+Keys are generated on demand and rotated after `rotation` seconds. A new key is
+published in the JWKS `publish_ahead` seconds (the JWKS max-age) before it signs
+anything, so resource servers holding a cached JWKS know it by then, and a
+replaced key is still published for `overlap` seconds so tokens it signed remain
+verifiable. A key's `created` time is when it starts signing. With a key
+directory the private keys are kept as `<kid>.pem` files, otherwise they only
+live in memory. Worker processes sharing a key directory rotate under a file
+lock and pick up each other's keys when the directory changes.
+"""
+
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from jose import jwk
+from jose.backends.base import Key
+from jose.exceptions import JWKError
+
+from api.config import settings
+
+ALGORITHMS = ("RS256", "ES256")
+
+
+def b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def jwk_thumbprint(public_jwk: dict) -> str:
+    """
+    RFC 7638 thumbprint of a public JWK, used as the key id
+    """
+    required = {"RSA": ("e", "kty", "n"), "EC": ("crv", "kty", "x", "y")}
+    members = {name: public_jwk[name] for name in required[public_jwk["kty"]]}
+    canonical = json.dumps(members, separators=(",", ":"), sort_keys=True)
+    return b64url(hashlib.sha256(canonical.encode()).digest())
+
+
+def generate_private_key(algorithm: str):
+    if algorithm == "RS256":
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    if algorithm == "ES256":
+        return ec.generate_private_key(ec.SECP256R1())
+    raise ValueError(f"Unsupported signing algorithm <{algorithm}>")
+
+
+def key_algorithm(private_key) -> str:
+    return "RS256" if isinstance(private_key, rsa.RSAPrivateKey) else "ES256"
+
+
+@dataclass
+class SigningKey:
+    kid: str
+    algorithm: str
+    private_pem: bytes
+    created: float
+    signer: Key = field(repr=False)
+    verifier: Key = field(repr=False)
+    public_jwk: dict = field(repr=False)
+
+    @classmethod
+    def from_pem(cls, private_pem: bytes, created: float) -> "SigningKey":
+        private_key = serialization.load_pem_private_key(private_pem, password=None)
+        algorithm = key_algorithm(private_key)
+        signer = jwk.construct(private_pem, algorithm)
+        verifier = signer.public_key()
+        public_jwk = {
+            name: value.decode() if isinstance(value, bytes) else value
+            for name, value in verifier.to_dict().items()
+        }
+        kid = jwk_thumbprint(public_jwk)
+        public_jwk.update({"kid": kid, "use": "sig", "alg": algorithm})
+        return cls(kid, algorithm, private_pem, created, signer, verifier, public_jwk)
+
+    @classmethod
+    def generate(cls, algorithm: str, created: float | None = None) -> "SigningKey":
+        private_pem = generate_private_key(algorithm).private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+        return cls.from_pem(private_pem, time.time() if created is None else created)
+
+
+class KeyManager:
+    def __init__(
+        self,
+        algorithm: str,
+        key_dir: str | None = None,
+        rotation: float = 30 * 24 * 3600,
+        overlap: float = 24 * 3600,
+        publish_ahead: float = 300,
+    ):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unsupported signing algorithm <{algorithm}>")
+        self.algorithm = algorithm
+        self.key_dir = Path(key_dir) if key_dir else None
+        self.rotation = rotation
+        self.overlap = overlap
+        self.publish_ahead = publish_ahead
+        self._keys: list[SigningKey] = []  # oldest first
+        self._jwks: bytes | None = None
+        self._loaded = False
+        self._dir_mtime: int | None = None
+        self._lock = threading.Lock()
+
+    def _stat_dir(self) -> int | None:
+        try:
+            return self.key_dir.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        """
+        Read the keys kept in the key directory
+        """
+        keys = []
+        if self.key_dir and self.key_dir.is_dir():
+            self._dir_mtime = self._stat_dir()
+            for path in self.key_dir.glob("*.pem"):
+                try:
+                    pem, created = path.read_bytes(), path.stat().st_mtime
+                except FileNotFoundError:
+                    continue  # retired by another process meanwhile
+                keys.append(SigningKey.from_pem(pem, created))
+        self._keys = sorted(keys, key=lambda key: key.created)
+        self._jwks = None
+        self._loaded = True
+
+    def _refresh(self):
+        # reload when another process added or retired keys
+        if not self._loaded or (self.key_dir and self._stat_dir() != self._dir_mtime):
+            self.load()
+
+    @contextmanager
+    def _dir_lock(self):
+        if not self.key_dir:
+            yield
+            return
+        self.key_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.key_dir / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _current(self) -> SigningKey | None:
+        # the newest key that has started signing, keys of another algorithm
+        # are only kept for verification
+        now = time.time()
+        for key in reversed(self._keys):
+            if key.created <= now:
+                return key if key.algorithm == self.algorithm else None
+        return None
+
+    def _rotation_due(self) -> bool:
+        current = self._current()
+        if current is None:
+            return True
+        # the successor is published publish_ahead seconds before the current
+        # key's lifetime is over, once
+        return (
+            self._keys[-1] is current
+            and current.created + self.rotation - self.publish_ahead <= time.time()
+        )
+
+    def rotate(self) -> SigningKey:
+        """
+        Publish a new key, it starts signing after publish_ahead seconds, or
+        right away when no key signs yet
+        """
+        with self._lock:
+            self._refresh()
+            return self._rotate(force=True)
+
+    def _rotate(self, force: bool = False) -> SigningKey:
+        with self._dir_lock():
+            if self.key_dir:
+                # another worker may have rotated while this one waited for the lock
+                self.load()
+                if not force and not self._rotation_due():
+                    return self._keys[-1]
+            # nothing has been published to resource servers that could sign now
+            ahead = self.publish_ahead if self._current() is not None else 0
+            key = SigningKey.generate(self.algorithm, time.time() + ahead)
+            if self.key_dir:
+                # written aside and renamed, so other workers never read half a key,
+                # the mtime is when it starts signing
+                temporary = self.key_dir / f".{key.kid}.tmp"
+                temporary.touch(mode=0o600)
+                temporary.write_bytes(key.private_pem)
+                os.utime(temporary, (key.created, key.created))
+                temporary.replace(self.key_dir / f"{key.kid}.pem")
+            self._keys.append(key)
+            self._jwks = None
+            self._retire()
+            return key
+
+    def _retire(self):
+        now = time.time()
+        keys = self._keys
+        # a key stays published until its successor has signed for `overlap` seconds
+        retired = [
+            key
+            for key, successor in zip(keys, keys[1:])
+            if successor.created + self.overlap < now
+        ]
+        for key in retired:
+            keys.remove(key)
+            if self.key_dir:
+                (self.key_dir / f"{key.kid}.pem").unlink(missing_ok=True)
+        if retired:
+            self._jwks = None
+
+    def signing_key(self) -> SigningKey:
+        """
+        The key signing now, publishes its successor when its lifetime is
+        about to end
+        """
+        with self._lock:
+            self._refresh()
+            self._retire()
+            if self._rotation_due():
+                self._rotate()
+            return self._current()
+
+    def verification_key(self, kid: str | None) -> SigningKey:
+        with self._lock:
+            self._refresh()
+            for key in self._keys:
+                if key.kid == kid:
+                    return key
+        raise JWKError(f"Unknown key id <{kid}>")
+
+    def jwks(self) -> bytes:
+        """
+        The serialized public JWK set of every published key
+        """
+        with self._lock:
+            self._refresh()
+            self._retire()
+            if self._jwks is None:
+                self._jwks = json.dumps(
+                    {"keys": [key.public_jwk for key in self._keys]},
+                    separators=(",", ":"),
+                ).encode()
+            return self._jwks
+
+
+key_manager = (
+    KeyManager(
+        settings.jwt_algorithm,
+        key_dir=settings.jwt_key_dir,
+        rotation=settings.jwt_key_rotation_minutes * 60,
+        overlap=settings.jwt_key_overlap_minutes * 60,
+        publish_ahead=settings.jwks_max_age,
+    )
+    if settings.jwt_algorithm in ALGORITHMS
+    else None
+)
@@ -0,0 +1,326 @@
+"""
+Database housekeeping in the background of the server.
+
+The app lifespan starts a scheduler that wakes up every maintenance_tick_seconds
+and runs the jobs that are due, one at a time on a worker thread:
+
+- prune: expired refresh token families, revocations no token can match and
+  refresh tokens left on user rows by older versions
+- checkpoint: a passive WAL checkpoint, so the WAL does not grow between the
+  automatic ones (sqlite)
+- optimize: PRAGMA optimize, ANALYZE of the tables whose statistics are stale
+  (all of them the first time), with analysis_limit keeping it short (sqlite)
+- vacuum: incremental vacuum of the free pages (sqlite files created with
+  auto_vacuum=incremental)
+
+optimize and vacuum wait for a low traffic window. Every job works in short
+transactions of maintenance_batch_size rows or pages and stops once it has run
+for maintenance_job_budget seconds, the rest is left to its next run, so the
+database is never locked for longer than a batch. With several workers on a
+host the one holding a lock next to the database file runs the jobs.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+
+from api import crud
+from api.config import settings
+from api.metrics import REQUESTS, Counter, Histogram, registry
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+JOB_SECONDS = registry.register(
+    Histogram(
+        "maintenance_job_duration_seconds",
+        "Duration of the runs of a background maintenance job",
+        ["job"],
+    )
+)
+JOB_RUNS = registry.register(
+    Counter(
+        "maintenance_job_runs_total",
+        "Background maintenance job runs by result (done, partial, error)",
+        ["job", "result"],
+    )
+)
+JOB_ITEMS = registry.register(
+    Counter(
+        "maintenance_job_items_total",
+        "Rows or pages a background maintenance job went through",
+        ["job"],
+    )
+)
+
+# (rows or pages done, whether the job finished within the budget)
+JobResult = Tuple[int, bool]
+
+
+def batches(
+    engine: Engine, run: Callable[[int, Session], int], deadline: float
+) -> JobResult:
+    """
+    Call run(limit, session), each batch in a transaction of its own, until a
+    batch comes back short or the deadline has passed
+    """
+    done = 0
+    while time.monotonic() < deadline:
+        with Session(engine) as session:
+            count = run(settings.maintenance_batch_size, session)
+        done += count
+        if count < settings.maintenance_batch_size:
+            return done, True
+    return done, False
+
+
+def prune(engine: Engine, deadline: float) -> JobResult:
+    with Session(engine) as session:
+        done = crud.prune_revocations(session)
+    for run in (crud.prune_token_families, crud.clear_stale_refresh_tokens):
+        count, finished = batches(engine, run, deadline)
+        done += count
+        if not finished:
+            return done, False
+    return done, True
+
+
+def checkpoint(engine: Engine, deadline: float) -> JobResult:
+    with engine.connect() as connection:
+        if connection.exec_driver_sql("PRAGMA journal_mode").scalar() != "wal":
+            return 0, True
+        # passive: copies what no reader needs, never waits for them
+        busy, _, copied = connection.exec_driver_sql(
+            "PRAGMA wal_checkpoint(PASSIVE)"
+        ).one()
+    return max(copied, 0), not busy
+
+
+def optimize(engine: Engine, deadline: float) -> JobResult:
+    with engine.connect() as connection:
+        analyzed = connection.exec_driver_sql(
+            "SELECT count(*) FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        ).scalar()
+        # rows sampled per index, bounds the time ANALYZE takes
+        connection.exec_driver_sql("PRAGMA analysis_limit=1000")
+        try:
+            # without any statistics yet optimize would not know what to analyze
+            connection.exec_driver_sql("PRAGMA optimize" if analyzed else "ANALYZE")
+        finally:
+            connection.exec_driver_sql("PRAGMA analysis_limit=0")
+    return 0, True
+
+
+def vacuum(engine: Engine, deadline: float) -> JobResult:
+    done = 0
+    with engine.connect() as connection:
+        # 2: incremental, files created before need a VACUUM to switch
+        if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+            return 0, True
+        while time.monotonic() < deadline:
+            free = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+            if not free:
+                return done, True
+            pages = min(free, settings.maintenance_batch_size)
+            connection.exec_driver_sql(f"PRAGMA incremental_vacuum({pages})")
+            done += pages
+    return done, False
+
+
+@dataclass
+class Job:
+    name: str
+    run: Callable[[Engine, float], JobResult]
+    interval: float  # seconds
+    quiet: bool = False  # only in a low traffic window
+    budget: float = field(default_factory=lambda: settings.maintenance_job_budget)
+    next_run: float = 0.0  # monotonic
+
+
+def default_jobs(engine: Engine) -> List[Job]:
+    jobs = [Job("prune", prune, settings.maintenance_prune_interval)]
+    if engine.dialect.name == "sqlite":
+        # the server of other databases looks after these itself
+        jobs += [
+            Job("checkpoint", checkpoint, settings.maintenance_checkpoint_interval),
+            Job("optimize", optimize, settings.maintenance_optimize_interval, quiet=True),
+            Job("vacuum", vacuum, settings.maintenance_vacuum_interval, quiet=True),
+        ]
+    return jobs
+
+
+def parse_hours(hours: str | None) -> Tuple[int, int] | None:
+    # "2-5": from 02:00 to 05:00 UTC, "22-4" wraps around midnight
+    if not hours:
+        return None
+    start, end = (int(hour) % 24 for hour in hours.split("-"))
+    return start, end
+
+
+def in_hours(hours: Tuple[int, int] | None, hour: int) -> bool:
+    if hours is None:
+        return True
+    start, end = hours
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def request_count() -> float:
+    return sum(value for _, _, value in REQUESTS.samples())
+
+
+class LeaderLock:
+    """
+    A non-blocking lock on a file next to the database, held by the worker
+    running the jobs until it exits
+    """
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self.file = None
+
+    def acquire(self) -> bool:
+        if self.file is not None or self.path is None or fcntl is None:
+            return True
+        file = open(self.path, "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        self.file = file
+        return True
+
+    def release(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Scheduler:
+    def __init__(
+        self,
+        engine: Engine,
+        jobs: List[Job],
+        tick: float | None = None,
+        lock: LeaderLock | None = None,
+    ):
+        self.engine = engine
+        self.jobs = jobs
+        self.tick = tick or settings.maintenance_tick_seconds
+        self.lock = lock or LeaderLock(None)
+        self.hours = parse_hours(settings.maintenance_quiet_hours)
+        self.rps = 0.0
+        self._requests = (time.monotonic(), request_count())
+        self._task: asyncio.Task | None = None
+        # the first runs wait for one interval, not to slow down the startup
+        now = time.monotonic()
+        for job in jobs:
+            job.next_run = job.next_run or now + job.interval
+
+    def sample_traffic(self):
+        now, count = time.monotonic(), request_count()
+        started, counted = self._requests
+        if now > started:
+            self.rps = (count - counted) / (now - started)
+        self._requests = (now, count)
+
+    def quiet(self) -> bool:
+        return (
+            in_hours(self.hours, datetime.utcnow().hour)
+            and self.rps <= settings.maintenance_quiet_rps
+        )
+
+    async def run_job(self, job: Job) -> JobResult | None:
+        started = time.perf_counter()
+        deadline = time.monotonic() + job.budget
+        try:
+            done, finished = await asyncio.to_thread(job.run, self.engine, deadline)
+        except Exception:
+            logger.exception("Maintenance job %s failed", job.name)
+            JOB_RUNS.inc(job=job.name, result="error")
+            return None
+        finally:
+            JOB_SECONDS.observe(time.perf_counter() - started, job=job.name)
+        JOB_ITEMS.inc(done, job=job.name)
+        JOB_RUNS.inc(job=job.name, result="done" if finished else "partial")
+        return done, finished
+
+    async def run_pending(self):
+        """
+        Run the jobs that are due, a job that used up its budget is due again
+        at the next tick
+        """
+        self.sample_traffic()
+        for job in self.jobs:
+            now = time.monotonic()
+            if now < job.next_run or (job.quiet and not self.quiet()):
+                continue
+            if not self.lock.acquire():
+                return
+            result = await self.run_job(job)
+            finished = result is None or result[1]
+            job.next_run = time.monotonic() + (job.interval if finished else self.tick)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            await self.run_pending()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.lock.release()
+
+
+def build_scheduler(engine: Engine | None = None) -> Scheduler:
+    """
+    The scheduler of the default jobs for the database (default: the configured one)
+    """
+    if engine is None:
+        from api.db import engine
+    database = engine.url.database if engine.dialect.name == "sqlite" else None
+    path = f"{database}.maintenance" if database and database != ":memory:" else None
+    return Scheduler(engine, default_jobs(engine), lock=LeaderLock(path))
+
+
+def main(argv: List[str] | None = None):
+    import argparse
+
+    from api.db import engine
+
+    jobs: Dict[str, Job] = {job.name: job for job in default_jobs(engine)}
+    parser = argparse.ArgumentParser(prog="python -m api.maintenance")
+    parser.add_argument("jobs", nargs="*", help=f"of {', '.join(jobs)} (default: all)")
+    parser.add_argument("--budget", type=float, default=600, help="seconds per job")
+    args = parser.parse_args(argv)
+    if unknown := set(args.jobs) - set(jobs):
+        parser.error(f"unknown jobs: {', '.join(sorted(unknown))}")
+
+    for name in args.jobs or jobs:
+        started = time.perf_counter()
+        done, finished = jobs[name].run(engine, time.monotonic() + args.budget)
+        state = "done" if finished else "out of budget"
+        print(f"{name}: {done} in {time.perf_counter() - started:.2f}s, {state}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+In-process metrics in the Prometheus text format, served at GET /metrics.
+
+Besides per-route request counts and latencies, the time of a request is broken
+down into phases (database, password hashing and JWT work), so a slow login can
+be attributed to sqlite, bcrypt or the event loop (whatever is left over).
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"' for name, value in labels.items())
+    return "{" + pairs + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set(self, value: float, **labels):
+        """
+        Set a value directly, also used for counters kept elsewhere (e.g. cache stats)
+        """
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(self.key(labels), 0)
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # label values -> [bucket counts..., sum]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self.key(labels))
+        return int(sum(series[:-1])) if series else 0
+
+    def sum(self, **labels) -> float:
+        series = self._series.get(self.key(labels))
+        return series[-1] if series else 0.0
+
+    def samples(self) -> Iterator[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+        for key, values in series:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": format_value(bound)}, cumulative
+            yield f"{self.name}_count", labels, cumulative
+            yield f"{self.name}_sum", labels, values[-1]
+
+
+class Registry:
+    """
+    The metrics of the process, collectors refresh gauges right before a scrape
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]):
+        self.collectors.append(collector)
+        return collector
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.register(
+    Counter("http_requests_total", "HTTP requests by route and status", ["method", "route", "status"])
+)
+REQUEST_SECONDS = registry.register(
+    Histogram("http_request_duration_seconds", "HTTP request latency by route", ["method", "route"])
+)
+# phases: db, hash_wait, hash, jwt_encode, jwt_decode
+PHASE_SECONDS = registry.register(
+    Histogram("phase_duration_seconds", "Time spent in one phase of request handling", ["phase"])
+)
+DB_POOL = registry.register(
+    Gauge("db_pool_connections", "Database pool connections by state", ["engine", "state"])
+)
+
+CACHE_ENTRIES = registry.register(
+    Gauge("cache_entries", "Entries held by an in-process cache", ["cache"])
+)
+CACHE_LOOKUPS = registry.register(
+    Counter("cache_lookups_total", "In-process cache lookups by result", ["cache", "result"])
+)
+HASH_POOL = registry.register(
+    Gauge("hash_pool_jobs", "Password hashing jobs by state", ["state"])
+)
+HASH_REJECTED = registry.register(
+    Counter("hash_pool_rejected_total", "Password hashing jobs rejected with a 503")
+)
+
+
+def phase(name: str):
+    """
+    Time a block as one phase, e.g. `with phase("jwt_encode"): ...`
+    """
+    return PHASE_SECONDS.time(phase=name)
+
+
+# the start time is kept on the execution context of the statement, nothing
+# is left behind on the pooled connection when a statement fails
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = context.query_started
+    PHASE_SECONDS.observe(time.perf_counter() - started, phase="db")
+
+
+def _handle_error(exception_context):
+    # failed statements (constraint violations, busy timeouts) took time too
+    context = exception_context.execution_context
+    if (started := getattr(context, "query_started", None)) is not None:
+        context.query_started = None
+        PHASE_SECONDS.observe(time.perf_counter() - started, phase="db")
+
+
+def instrument_engine(engine: Engine, name: str):
+    """
+    Time every statement run on engine as the db phase and report its pool usage
+    """
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+    def collect():
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            return
+        DB_POOL.set(pool.size(), engine=name, state="size")
+        DB_POOL.set(pool.checkedout(), engine=name, state="checked_out")
+        DB_POOL.set(pool.checkedin(), engine=name, state="idle")
+        DB_POOL.set(max(pool.overflow(), 0), engine=name, state="overflow")
+
+    registry.add_collector(collect)
+
+
+def track_cache(cache, name: str):
+    """
+    Report the size and hit rate of a TTLCache
+    """
+
+    def collect():
+        stats = cache.stats()
+        CACHE_ENTRIES.set(stats["size"], cache=name)
+        CACHE_LOOKUPS.set(stats["hits"], cache=name, result="hit")
+        CACHE_LOOKUPS.set(stats["misses"], cache=name, result="miss")
+
+    registry.add_collector(collect)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting and timing requests by route template, requests that
+    match no route share one "unmatched" series
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            REQUEST_SECONDS.observe(time.perf_counter() - started, method=method, route=route)
+            REQUESTS.inc(method=method, route=route, status=status)
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,224 @@
+"""
+Versioned database migrations, an explicit step before the server starts rather
+than a side effect of importing the app:
+
+    python -m api.migrate            # apply the pending migrations
+    python -m api.migrate --list     # show which ones are applied
+
+Every migration runs in a transaction of its own and is recorded in the
+schema_migration table. Migrations are append only: a schema change is a new
+function decorated with @migration and the next version number, never an edit
+to one that has shipped. A database created before migrations were versioned
+starts at version 1, so every migration after it must cope with a schema that
+already has its change (IF NOT EXISTS, see create_index()).
+"""
+import argparse
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, List
+
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    select,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateIndex
+from sqlmodel import SQLModel
+
+from api.model import Client, RefreshTokenFamily, RevokedToken, TokenWatermark, User
+
+
+class MigrationError(RuntimeError):
+    pass
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+migrations: Dict[int, Migration] = {}
+
+# kept out of SQLModel.metadata, so create_all never creates it on its own
+version_metadata = MetaData()
+schema_migration = Table(
+    "schema_migration",
+    version_metadata,
+    Column("version", Integer, primary_key=True, autoincrement=False),
+    Column("description", String, nullable=False),
+    Column("applied", DateTime, nullable=False),
+)
+
+
+def migration(version: int):
+    """
+    Register the decorated function as the migration to version, its docstring
+    is the description
+    """
+
+    def register(upgrade: Callable[[Connection], None]):
+        if version in migrations:
+            raise ValueError(f"Duplicate migration version <{version}>")
+        description = (upgrade.__doc__ or upgrade.__name__).strip().splitlines()[0]
+        migrations[version] = Migration(version, description, upgrade)
+        return upgrade
+
+    return register
+
+
+def create_index(connection: Connection, table, name: str):
+    """
+    Create an index of the model unless the database has it already. Reflection
+    misses expression indexes, so IF NOT EXISTS (sqlite and postgres) is used
+    instead of checkfirst
+    """
+    index = next(index for index in table.indexes if index.name == name)
+    ddl = str(CreateIndex(index).compile(dialect=connection.dialect))
+    connection.exec_driver_sql(ddl.replace("INDEX", "INDEX IF NOT EXISTS", 1))
+
+
+# the tables of version 1 as they shipped, frozen rather than taken from the
+# models, which later migrations change
+baseline_metadata = MetaData()
+Table(
+    "user",
+    baseline_metadata,
+    Column("email", String, unique=True),
+    Column("id", Integer, primary_key=True),
+    Column("hashed_password", String, nullable=False),
+    Column("refresh_token", String),
+    Column("is_admin", Boolean, nullable=False),
+)
+Table(
+    "refreshtokenfamily",
+    baseline_metadata,
+    Column("id", String, primary_key=True),
+    Column("email", String, nullable=False, index=True),
+    Column("jti", String, nullable=False),
+    Column("expires", DateTime, nullable=False),
+    Column("revoked", Boolean, nullable=False),
+)
+
+
+@migration(1)
+def initial_schema(connection: Connection):
+    """Create the user and refresh token family tables"""
+    baseline_metadata.create_all(connection)
+
+
+@migration(2)
+def email_lower_index(connection: Connection):
+    """Unique index on lower(email) for case-insensitive lookups"""
+    lowered = func.lower(User.__table__.c.email)
+    duplicates = connection.execute(
+        select(lowered).group_by(lowered).having(func.count() > 1)
+    ).scalars().all()
+    if duplicates:
+        raise MigrationError(
+            "Emails registered more than once in different case, merge or "
+            f"rename these accounts first: {', '.join(sorted(duplicates))}"
+        )
+    create_index(connection, User.__table__, "ix_user_email_lower")
+
+
+@migration(3)
+def token_family_expires_index(connection: Connection):
+    """Index on refresh token family expiry for pruning expired families"""
+    table = RefreshTokenFamily.__table__
+    create_index(connection, table, "ix_refreshtokenfamily_expires")
+
+
+@migration(4)
+def access_token_revocation(connection: Connection):
+    """Tables of revoked access tokens and per user revocation watermarks"""
+    SQLModel.metadata.create_all(
+        connection, tables=[RevokedToken.__table__, TokenWatermark.__table__]
+    )
+
+
+@migration(5)
+def client_registry(connection: Connection):
+    """Table of the clients of the client credentials grant"""
+    SQLModel.metadata.create_all(connection, tables=[Client.__table__])
+
+
+def applied_versions(connection: Connection) -> List[int]:
+    version_metadata.create_all(connection)
+    return list(
+        connection.execute(
+            select(schema_migration.c.version).order_by(schema_migration.c.version)
+        ).scalars()
+    )
+
+
+def pending(engine: Engine) -> List[Migration]:
+    with engine.begin() as connection:
+        applied = set(applied_versions(connection))
+    return [migrations[number] for number in sorted(migrations) if number not in applied]
+
+
+def migrate(engine: Engine | None = None) -> List[int]:
+    """
+    Apply the migrations missing from the database (default: the configured
+    one) in order, returns the versions applied
+    """
+    if engine is None:
+        from api.db import engine
+    done = []
+    for step in pending(engine):
+        with engine.begin() as connection:
+            step.upgrade(connection)
+            connection.execute(
+                schema_migration.insert().values(
+                    version=step.version,
+                    description=step.description,
+                    applied=datetime.utcnow(),
+                )
+            )
+        done.append(step.version)
+    return done
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(prog="python -m api.migrate")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--database", help="sqlite file (default: DATABASE_URL or DATABASE)")
+    target.add_argument("--url", help="database url, e.g. postgresql://user@host/auth")
+    parser.add_argument(
+        "--list", action="store_true", help="show the migrations instead of applying them"
+    )
+    args = parser.parse_args(argv)
+
+    if args.database:
+        from api.db import create_sqlite_engine
+
+        engine = create_sqlite_engine(args.database)
+    elif args.url:
+        from api.db import create_db_engine
+
+        engine = create_db_engine(args.url)
+    else:
+        from api.db import engine
+
+    if args.list:
+        waiting = {step.version for step in pending(engine)}
+        for version in sorted(migrations):
+            state = "pending" if version in waiting else "applied"
+            print(f"{version:4d} {state:8s} {migrations[version].description}")
+        return
+
+    for version in migrate(engine):
+        print(f"applied {version}: {migrations[version].description}")
+
+
+if __name__ == "__main__":
+    main()
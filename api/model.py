@@ -1,6 +1,8 @@
-from typing import Optional
+from datetime import datetime
+from typing import List, Optional
 
 from pydantic import BaseModel, EmailStr
+from sqlalchemy import Index, func
 from sqlmodel import Column, Field, SQLModel, String
 
 
@@ -12,6 +14,52 @@ class User(SQLModel, table=True):
     is_admin: bool = False
 
 
+# emails are unique and looked up regardless of case, see api.crud.user_by_email
+Index("ix_user_email_lower", func.lower(User.__table__.c.email), unique=True)
+
+
+class RefreshTokenFamily(SQLModel, table=True):
+    """
+    Rotation record of one login, only the latest refresh token (jti) of the family is valid
+    """
+
+    id: str = Field(primary_key=True)
+    email: str = Field(index=True)
+    jti: str
+    expires: datetime = Field(index=True)
+    revoked: bool = False
+
+
+class RevokedToken(SQLModel, table=True):
+    """
+    An access token revoked before it expires, pointless to keep after that
+    """
+
+    jti: str = Field(primary_key=True)
+    email: str = Field(index=True)
+    expires: datetime = Field(index=True)
+
+
+class TokenWatermark(SQLModel, table=True):
+    """
+    Access tokens of the user issued (iat) before issued_before are revoked
+    """
+
+    email: str = Field(primary_key=True)  # normalized, see api.crud.normalize_email
+    issued_before: float  # unix time
+
+
+class Client(SQLModel, table=True):
+    """
+    A service using the client credentials grant, see api.clients
+    """
+
+    client_id: str = Field(primary_key=True)
+    secret_hash: str  # HMAC-SHA256 of the secret with the server pepper
+    scopes: str = ""  # space separated scopes the client may request
+    created: datetime = Field(default_factory=datetime.utcnow)
+
+
 class UserCreate(SQLModel):
     email: EmailStr
     password: str
@@ -27,11 +75,42 @@ class UserShow(SQLModel):
     email: EmailStr
 
 
+class BulkRowError(BaseModel):
+    row: int
+    email: str | None = None
+    detail: str
+
+
+class BulkResult(BaseModel):
+    created: int = 0
+    conflicts: List[BulkRowError] = []
+    errors: List[BulkRowError] = []
+
+
 class Token(BaseModel):
     access_token: str
     refresh_token: str | None = None
     token_type: str
 
 
+class ClientToken(BaseModel):
+    access_token: str
+    token_type: str
+    expires_in: int
+    scope: str | None = None
+
+
+class TokenIntrospection(BaseModel):
+    active: bool
+    token_type: str | None = None
+    sub: str | None = None
+    exp: int | None = None
+    iat: float | None = None
+    jti: str | None = None
+    adm: bool | None = None
+    scope: str | None = None
+    client_id: str | None = None
+
+
 class TokenRefresh(BaseModel):
     refresh_token: str
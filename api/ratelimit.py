@@ -0,0 +1,367 @@
+"""
+Login rate limiting that runs before any database or bcrypt work.
+
+Every login attempt takes a token from the bucket of its client ip and of its
+account. Failed attempts count towards a lockout of the ip and the account that
+doubles with every further failure. Buckets live in a pluggable store: in memory
+for a single process, or in a sqlite file of their own shared by all workers on
+a host, from which idle buckets are deleted.
+
+Clients are told apart by the address of the connection, or behind the proxies
+listed in TRUSTED_PROXIES by the nearest X-Forwarded-For address none of them
+added. Otherwise every client of a proxy shares one bucket and one lockout.
+"""
+import ipaddress
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, List
+
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+from api.config import settings
+from api.exceptions import TooManyRequestsException
+from api.metrics import Counter, registry
+
+THROTTLED = registry.register(
+    Counter(
+        "login_throttled_total", "Login attempts rejected by the rate limiter", ["scope"]
+    )
+)
+
+
+@dataclass
+class Bucket:
+    tokens: float | None = None  # None is a full bucket
+    updated: float = 0.0
+    failures: int = 0
+    last_failure: float = 0.0
+    locked_until: float = 0.0
+
+
+@dataclass
+class Rule:
+    rate: float  # tokens added per second
+    burst: int  # bucket size
+
+
+@dataclass
+class Lockout:
+    threshold: int = 5  # failures before the first lockout
+    seconds: float = 1.0  # first lockout, doubles with each further failure
+    max_seconds: float = 900.0
+    window: float = 900.0  # failures older than this are forgotten
+
+
+def refill(bucket: Bucket, rule: Rule, now: float) -> float:
+    """
+    Top up the bucket, returns the seconds until an attempt is allowed (0 for now)
+    """
+    if bucket.locked_until > now:
+        return bucket.locked_until - now
+    if bucket.tokens is None:
+        bucket.tokens = float(rule.burst)
+    else:
+        elapsed = max(now - bucket.updated, 0.0)
+        bucket.tokens = min(float(rule.burst), bucket.tokens + elapsed * rule.rate)
+    bucket.updated = now
+    if bucket.tokens >= 1:
+        return 0.0
+    return (1 - bucket.tokens) / rule.rate if rule.rate > 0 else float("inf")
+
+
+def record_failure(bucket: Bucket, lockout: Lockout, now: float):
+    if now - bucket.last_failure > lockout.window:
+        bucket.failures = 0
+    bucket.failures += 1
+    bucket.last_failure = now
+    if bucket.failures >= lockout.threshold:
+        exponent = min(bucket.failures - lockout.threshold, 32)
+        duration = min(lockout.seconds * 2**exponent, lockout.max_seconds)
+        bucket.locked_until = max(bucket.locked_until, now + duration)
+
+
+def record_success(bucket: Bucket):
+    bucket.failures = 0
+    bucket.locked_until = 0.0
+
+
+class MemoryLimitStore:
+    """
+    Buckets of one process, the least recently used ones are forgotten beyond max_entries
+    """
+
+    blocking = False
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self._buckets: OrderedDict[str, Bucket] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def update(self, keys: List[str], func: Callable[[List[Bucket]], object]):
+        """
+        Apply func to the buckets of keys atomically and return its result
+        """
+        with self._lock:
+            buckets = []
+            for key in keys:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = Bucket()
+                else:
+                    self._buckets.move_to_end(key)
+                buckets.append(bucket)
+            result = func(buckets)
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteLimitStore:
+    """
+    Buckets in a sqlite table, shared by every worker process using the same file.
+    Each update is one IMMEDIATE transaction, so concurrent workers serialise on it.
+
+    Buckets untouched for expire_after seconds are back to full and their
+    failures forgotten, they are deleted every prune_interval seconds.
+    """
+
+    blocking = True
+
+    def __init__(
+        self,
+        database: str,
+        busy_timeout: float = 5.0,
+        expire_after: float = 900.0,
+        prune_interval: float = 60.0,
+    ):
+        self.database = database
+        self.busy_timeout = busy_timeout
+        self.expire_after = expire_after
+        self.prune_interval = prune_interval
+        self._pruned = 0.0
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.database, timeout=self.busy_timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=wal")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS login_limit ("
+                "key TEXT PRIMARY KEY, tokens REAL, updated REAL, failures INTEGER, "
+                "last_failure REAL, locked_until REAL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def update(self, keys: List[str], func: Callable[[List[Bucket]], object]):
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            buckets = []
+            for key in keys:
+                row = connection.execute(
+                    "SELECT tokens, updated, failures, last_failure, locked_until "
+                    "FROM login_limit WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                buckets.append(Bucket(*row) if row else Bucket())
+            result = func(buckets)
+            connection.executemany(
+                "INSERT OR REPLACE INTO login_limit VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        key,
+                        bucket.tokens,
+                        bucket.updated,
+                        bucket.failures,
+                        bucket.last_failure,
+                        bucket.locked_until,
+                    )
+                    for key, bucket in zip(keys, buckets)
+                ],
+            )
+            now = time.time()
+            if now - self._pruned >= self.prune_interval:
+                self._pruned = now
+                self._prune(connection, now)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return result
+
+    def _prune(self, connection: sqlite3.Connection, now: float) -> int:
+        before = now - self.expire_after
+        return connection.execute(
+            "DELETE FROM login_limit "
+            "WHERE updated < ? AND last_failure < ? AND locked_until < ?",
+            (before, before, now),
+        ).rowcount
+
+    def prune(self) -> int:
+        """
+        Delete the idle buckets, returns how many
+        """
+        return self._prune(self.connection, time.time())
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT count(*) FROM login_limit").fetchone()[0]
+
+    def clear(self):
+        self.connection.execute("DELETE FROM login_limit")
+
+
+class LoginLimiter:
+    def __init__(self, store, ip: Rule, account: Rule, lockout: Lockout):
+        self.store = store
+        self.ip = ip
+        self.account = account
+        self.lockout = lockout
+
+    @staticmethod
+    def keys(client: str | None, email: str) -> List[str]:
+        return [f"ip:{client or '-'}", f"user:{email.strip().lower()}"]
+
+    async def _update(self, keys: List[str], func):
+        if self.store.blocking:
+            return await run_in_threadpool(self.store.update, keys, func)
+        return self.store.update(keys, func)
+
+    async def check(self, client: str | None, email: str):
+        """
+        Take a token for the attempt, raises TooManyRequestsException while either
+        bucket is empty or locked out
+        """
+        now = time.time()
+
+        def take(buckets: List[Bucket]):
+            waits = [
+                refill(buckets[0], self.ip, now),
+                refill(buckets[1], self.account, now),
+            ]
+            if not any(waits):
+                for bucket in buckets:
+                    bucket.tokens -= 1
+            return waits
+
+        ip_wait, account_wait = await self._update(self.keys(client, email), take)
+        if ip_wait or account_wait:
+            THROTTLED.inc(scope="ip" if ip_wait >= account_wait else "account")
+            raise TooManyRequestsException(retry_after=max(ip_wait, account_wait))
+
+    async def failed(self, client: str | None, email: str):
+        now = time.time()
+
+        def fail(buckets: List[Bucket]):
+            for bucket in buckets:
+                record_failure(bucket, self.lockout, now)
+
+        await self._update(self.keys(client, email), fail)
+
+    async def succeeded(self, client: str | None, email: str):
+        # only the account is cleared, a valid login of their own must not
+        # reset the failures an ip collected against other accounts
+        await self._update(
+            self.keys(client, email)[1:], lambda buckets: record_success(buckets[0])
+        )
+
+
+def parse_networks(networks: str | None) -> List[ipaddress.IPv4Network | ipaddress.IPv6Network]:
+    # "10.0.0.1, 172.16.0.0/12"
+    return [
+        ipaddress.ip_network(network.strip(), strict=False)
+        for network in (networks or "").split(",")
+        if network.strip()
+    ]
+
+
+def trusted(address: str, proxies) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in proxies)
+
+
+def client_address(request: Request, proxies=None) -> str | None:
+    """
+    The address a login is counted against: the peer, or behind trusted proxies
+    the last X-Forwarded-For entry not added by one of them. Entries left of it
+    are set by the client and could be anything
+    """
+    proxies = trusted_proxies if proxies is None else proxies
+    peer = request.client.host if request.client else None
+    if peer is None or not proxies or not trusted(peer, proxies):
+        return peer
+    forwarded = ",".join(request.headers.getlist("x-forwarded-for"))
+    for address in reversed([entry.strip() for entry in forwarded.split(",")]):
+        if address and not trusted(address, proxies):
+            return address
+    return peer
+
+
+def idle_seconds() -> float:
+    """
+    After this long without an attempt every bucket is full and its failures
+    and lockout are over
+    """
+    refills = [
+        settings.login_ip_burst / settings.login_ip_rate if settings.login_ip_rate > 0 else 0,
+        settings.login_account_burst / settings.login_account_rate
+        if settings.login_account_rate > 0
+        else 0,
+    ]
+    return max(*refills, settings.login_failure_window)
+
+
+def build_limit_store(kind: str, workers: int = 1):
+    """
+    The store of a rate_limit_store setting, "auto" keeps the buckets in memory
+    for a single worker and in sqlite when several workers share them
+    """
+    if kind == "auto":
+        kind = "memory" if workers <= 1 else "sqlite"
+    if kind == "memory":
+        return MemoryLimitStore(settings.rate_limit_max_entries)
+    if kind == "sqlite":
+        # a file of its own, logins must not queue for the writer lock of the
+        # user database
+        return SQLiteLimitStore(
+            settings.rate_limit_database or f"{settings.database}.limits",
+            busy_timeout=settings.sqlite_busy_timeout / 1000,
+            expire_after=idle_seconds(),
+            prune_interval=settings.rate_limit_prune_interval,
+        )
+    raise ValueError(f"Unknown rate limit store <{kind}>")
+
+
+def build_login_limiter() -> LoginLimiter | None:
+    if settings.rate_limit_store in ("", "none"):
+        return None
+    return LoginLimiter(
+        build_limit_store(settings.rate_limit_store, settings.workers),
+        ip=Rule(settings.login_ip_rate, settings.login_ip_burst),
+        account=Rule(settings.login_account_rate, settings.login_account_burst),
+        lockout=Lockout(
+            threshold=settings.login_lockout_threshold,
+            seconds=settings.login_lockout_seconds,
+            max_seconds=settings.login_lockout_max_seconds,
+            window=settings.login_failure_window,
+        ),
+    )
+
+
+trusted_proxies = parse_networks(settings.trusted_proxies)
+login_limiter = build_login_limiter()
@@ -0,0 +1,123 @@
+"""
+Revocation of access tokens before they expire.
+
+Tokens are revoked one by one by jti (POST /revoke/), or all tokens of a user
+issued before a point in time (a watermark, set when the password or email
+changes or the user is deleted). Both are stored in the database, and every
+process keeps what is still active in memory: the watermarks by email and a
+Bloom filter of the revoked jtis. A token that is not revoked, the common case,
+is checked without touching the database. A jti in the filter is confirmed
+with a primary key lookup, the filter has false positives but no false negatives.
+
+Revocations through api.crud bump crud.token_changes, shared by the workers on
+a host. Processes reload after a bump and every revocation_sync_seconds, to see
+revocations of other hosts and drop the ones that expired.
+"""
+import hashlib
+import math
+import time
+from typing import Dict, Iterable
+
+from api import async_crud as crud
+from api.config import settings
+from api.crud import normalize_email, token_changes
+from api.db import AnySession
+from api.metrics import Counter, registry
+
+CHECKS = registry.register(
+    Counter(
+        "token_revocation_checks_total",
+        "Access token revocation checks by outcome",
+        ["result"],
+    )
+)
+
+
+class BloomFilter:
+    """
+    Set membership in a bit array, sized for capacity items at error_rate
+    false positives
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size / 8))
+        self.count = 0
+
+    def _positions(self, item: str) -> Iterable[int]:
+        # double hashing, k positions from two 64 bit halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class RevocationList:
+    def __init__(self, capacity: int, error_rate: float, sync_seconds: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_seconds = sync_seconds
+        self.filter = BloomFilter(capacity, error_rate)
+        self.watermarks: Dict[str, float] = {}
+        self.version: int | None = None  # of crud.token_changes, None to load
+        self.loaded = 0.0
+
+    def stale(self) -> bool:
+        return (
+            self.version != token_changes.value
+            or time.monotonic() - self.loaded > self.sync_seconds
+        )
+
+    async def load(self, session: AnySession):
+        """
+        Rebuild the filter and the watermarks from the active revocations
+        """
+        version = token_changes.value
+        jtis, watermarks = await crud.get_active_revocations(session)
+        bloom = BloomFilter(max(self.capacity, 2 * len(jtis)), self.error_rate)
+        for jti in jtis:
+            bloom.add(jti)
+        self.filter, self.watermarks = bloom, watermarks
+        self.version, self.loaded = version, time.monotonic()
+
+    async def is_revoked(self, claims: dict, session: AnySession) -> bool:
+        """
+        Whether the verified claims of an access token were revoked
+        """
+        if self.stale():
+            await self.load(session)
+        email = normalize_email(claims.get("sub") or "")
+        if (watermark := self.watermarks.get(email)) is not None:
+            # tokens from before revocation by watermark carry no iat
+            if claims.get("iat", 0) < watermark:
+                CHECKS.inc(result="watermark")
+                return True
+        jti = claims.get("jti")
+        if jti is None or jti not in self.filter:
+            CHECKS.inc(result="clear")
+            return False
+        if await crud.is_token_revoked(jti, session):
+            CHECKS.inc(result="revoked")
+            return True
+        CHECKS.inc(result="false_positive")
+        return False
+
+
+revocation_list = RevocationList(
+    settings.revocation_filter_capacity,
+    settings.revocation_filter_error_rate,
+    settings.revocation_sync_seconds,
+)
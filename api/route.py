@@ -1,16 +1,23 @@
-from typing import List
+from typing import AsyncIterator, List
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Query, Request, Response, status
 from fastapi.exceptions import HTTPException
+from fastapi.responses import RedirectResponse, StreamingResponse
 from pydantic import EmailStr
 from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
 
-from api import crud
-from api.auth import oauth_scheme
-from api.db import Session, get_session
-from api.model import UserCreate, UserShow
+from api import async_crud as crud
+from api import bulk, http_cache
+from api.auth import require_admin
+from api.cache import MISSING
+from api.config import settings
+from api.db import AnySession, Session, get_db, get_session
+from api.hashing import hash_pool
+from api.model import BulkResult, UserCreate, UserShow
+from api.serialization import JSONResponse, JSONRoute
 
-router = APIRouter(tags=["User"])
+router = APIRouter(tags=["User"], route_class=JSONRoute)
 
 
 # User CRUD enpoints
@@ -23,31 +30,125 @@ router = APIRouter(tags=["User"])
 )
 async def user_create(
     user: UserCreate,
-    session: Session = Depends(get_session),
-    _=Depends(oauth_scheme),
+    session: AnySession = Depends(get_db),
+    _=Depends(require_admin),
 ):
-    if the_user := crud.get_user(email=user.email, session=session):
+    # the unique email index decides, there is no lookup racing the insert
+    try:
+        new_user = await crud.create_user(user=user, session=session)
+    except IntegrityError:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
-            detail=f"User <{the_user.email}> already exists!",
+            detail=f"User <{user.email}> already exists!",
         )
+    # already a UserShow, not validated a second time
+    return JSONResponse(new_user, status_code=status.HTTP_201_CREATED)
+
 
-    new_user = crud.create_user(user=user, session=session)
-    return new_user
+@router.post(
+    "/users/bulk/",
+    response_model=BulkResult,
+    summary="Create users in bulk from a JSON array, NDJSON or CSV upload",
+)
+async def user_bulk_create(
+    request: Request,
+    session: Session = Depends(get_session),
+    _=Depends(require_admin),
+):
+    """
+    The Content-Type header selects the format, conflicting or invalid rows are
+    reported per row without aborting the import
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if not (fmt := bulk.FORMATS.get(content_type)):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Content-Type must be one of {', '.join(bulk.FORMATS)}",
+        )
+    try:
+        rows = bulk.read_rows(await request.body(), fmt)
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(error))
+
+    # hashing and inserting runs off the event loop on a sync session, the
+    # passwords go through the bounded hash pool and get a 503 when it is full
+    return await run_in_threadpool(
+        bulk.import_users, rows, session, hasher=hash_pool.hash_many
+    )
 
 
 # Retrieve
+async def formatted_users(
+    session: AnySession, after: int | None = None, fmt: str = "ndjson"
+) -> AsyncIterator[str]:
+    if fmt == "csv":
+        yield "id,email\n"
+    async for rows in crud.iter_users(session=session, after=after):
+        yield bulk.format_users(rows, fmt)
+
+
 @router.get(
     "/users/",
     response_model=List[UserShow],
-    summary="Retrieve all users",
+    summary="Retrieve users a page at a time, ordered by id",
 )
 async def user_get_all(
-    session: Session = Depends(get_session),
+    request: Request,
+    after: int | None = Query(
+        None, ge=0, description="Only return users with a greater id"
+    ),
+    limit: int = Query(settings.users_page_size, ge=1, le=settings.users_page_max),
+    stream: bool = Query(
+        False, description="Redirect to GET /users/export/ from `after` instead"
+    ),
+    session: AnySession = Depends(get_db),
 ):
-    users = crud.get_all_users(session=session)
-    show_users = [UserShow.from_orm(user) for user in users]
-    return show_users
+    """
+    A full page comes with a Link header pointing at the next page. Pages carry
+    an ETag, polling with If-None-Match gets a 304 until a user changes.
+    Streaming every user is GET /users/export/, for admins
+    """
+    if stream:
+        url = request.url_for("user_export")
+        if after is not None:
+            url = url.include_query_params(after=after)
+        return RedirectResponse(
+            str(url), status_code=status.HTTP_307_TEMPORARY_REDIRECT
+        )
+
+    version, etag = http_cache.user_table_version()
+    if not_modified := http_cache.not_modified(request, etag):
+        return not_modified
+    key = (version, after, limit)
+    if (page := http_cache.page_cache.get(key)) is MISSING:
+        users = await crud.get_users_page(session=session, after=after, limit=limit)
+        page = http_cache.serialize_page(users, limit)
+        http_cache.page_cache.set(key, page)
+    body, link = page
+    headers = http_cache.cache_headers(etag)
+    if link:
+        headers["Link"] = link
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@router.get(
+    "/users/export/",
+    summary="Export every user as NDJSON or CSV",
+)
+async def user_export(
+    fmt: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$"),
+    after: int | None = Query(
+        None, ge=0, description="Only export users with a greater id"
+    ),
+    session: AnySession = Depends(get_db),
+    _=Depends(require_admin),
+):
+    media_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        formatted_users(session, after=after, fmt=fmt),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="users.{fmt}"'},
+    )
 
 
 @router.get(
@@ -57,10 +158,16 @@ async def user_get_all(
 )
 async def user_get(
     email: EmailStr,
-    session: Session = Depends(get_session),
+    request: Request,
+    session: AnySession = Depends(get_db),
 ):
-    if user := crud.get_user(email=email, session=session):
-        return UserShow.from_orm(user)
+    _, etag = http_cache.user_table_version()
+    if not_modified := http_cache.not_modified(request, etag):
+        return not_modified
+    if user := await crud.get_user(email=email, session=session):
+        return JSONResponse(
+            http_cache.public_user(user), headers=http_cache.cache_headers(etag)
+        )
     else:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
@@ -75,24 +182,24 @@ async def user_update(
     email: EmailStr,
     password: str | None = None,
     new_email: EmailStr | None = None,
-    session: Session = Depends(get_session),
-    _=Depends(oauth_scheme),
+    session: AnySession = Depends(get_db),
+    _=Depends(require_admin),
 ):
-    if crud.get_user(email=email, session=session):
-        try:
-            return crud.update_user(
-                email=email,
-                password=password,
-                new_email=new_email,
-                session=session,
-            )
-        except IntegrityError:
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail=f"<{new_email}> already exists",
-            )
-    else:
+    try:
+        user = await crud.update_user(
+            email=email,
+            password=password,
+            new_email=new_email,
+            session=session,
+        )
+    except IntegrityError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"<{new_email}> already exists",
+        )
+    if user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return JSONResponse(http_cache.public_user(user))
 
 
 # Delete
@@ -103,10 +210,8 @@ async def user_update(
 )
 async def user_delete(
     email: EmailStr,
-    session: Session = Depends(get_session),
-    _=Depends(oauth_scheme),
+    session: AnySession = Depends(get_db),
+    _=Depends(require_admin),
 ):
-    if crud.get_user(email=email, session=session):
-        crud.delete_user(email=email, session=session)
-    else:
+    if not await crud.delete_user(email=email, session=session):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
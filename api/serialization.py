@@ -0,0 +1,89 @@
+"""
+JSON encoding of responses and decoding of request bodies.
+
+The encoder is chosen by settings.json_encoder: orjson (when installed) or the
+stdlib json module. JSONResponse is the default response class of the app, and
+handlers that already hold validated values return one directly, which skips
+FastAPI's second validation against response_model and jsonable_encoder. The
+routers use JSONRoute so request bodies are decoded by the same library.
+"""
+import json
+from typing import Any, Callable, Dict
+
+from fastapi import Request
+from fastapi.responses import JSONResponse as StarletteJSONResponse
+from fastapi.routing import APIRoute
+from pydantic.json import pydantic_encoder
+
+from api.config import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def json_dumps(content: Any) -> bytes:
+    # the same output as starlette's JSONResponse
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+        default=pydantic_encoder,
+    ).encode("utf-8")
+
+
+def orjson_dumps(content: Any) -> bytes:
+    return orjson.dumps(content, default=pydantic_encoder, option=orjson.OPT_NON_STR_KEYS)
+
+
+ENCODERS: Dict[str, Callable[[Any], bytes]] = {"json": json_dumps}
+DECODERS: Dict[str, Callable[[bytes | str], Any]] = {"json": json.loads}
+if orjson is not None:
+    ENCODERS["orjson"] = orjson_dumps
+    # orjson.JSONDecodeError is a json.JSONDecodeError
+    DECODERS["orjson"] = orjson.loads
+
+
+def encoder_name(name: str) -> str:
+    if name not in ("json", "orjson"):
+        raise ValueError(f"Unsupported JSON encoder <{name}>")
+    # orjson is optional, without it the stdlib is used
+    return name if name in ENCODERS else "json"
+
+
+encoder = encoder_name(settings.json_encoder)
+dumps = ENCODERS[encoder]
+loads = DECODERS[encoder]
+
+
+class JSONResponse(StarletteJSONResponse):
+    """
+    Renders pydantic models, datetimes and the usual JSON types with the
+    configured encoder
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class JSONRequest(Request):
+    async def json(self) -> Any:
+        if not hasattr(self, "_json"):
+            self._json = loads(await self.body())
+        return self._json
+
+
+class JSONRoute(APIRoute):
+    """
+    Route decoding JSON request bodies with the configured decoder
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def route_handler(request: Request):
+            return await handler(JSONRequest(request.scope, request.receive))
+
+        return route_handler
@@ -0,0 +1,74 @@
+"""
+Serve the app with one or several worker processes.
+
+Several workers run under gunicorn with uvicorn workers. The app is imported
+once in the gunicorn arbiter and the workers are forked from it, so they start
+with the schema created and the signing key generated. State that has to agree
+across workers moves to shared storage before the fork, see prepare_workers().
+"""
+import shutil
+import tempfile
+from pathlib import Path
+
+import uvicorn
+
+from api.config import settings
+from api.crud import token_changes, user_cache, user_changes
+from api.keys import key_manager
+from api.ratelimit import build_limit_store, login_limiter
+
+
+def prepare_workers(workers: int) -> list[Path]:
+    """
+    Share the per-process state between the workers forked from this process,
+    returns the temporary directories to remove on exit
+    """
+    temporary = []
+    # every worker invalidates the user caches of all of them
+    user_cache.share()
+    # and agree on the version of the user table in ETags
+    user_changes.share()
+    # a token revoked in one worker is reloaded by all of them
+    token_changes.share()
+    # one set of buckets, otherwise each worker would allow its own burst
+    if login_limiter is not None and settings.rate_limit_store == "auto":
+        login_limiter.store = build_limit_store("auto", workers)
+    # tokens signed by one worker must verify on the others, keys only kept in
+    # memory move to a private directory for the lifetime of the server
+    if key_manager is not None:
+        if key_manager.key_dir is None:
+            key_manager.key_dir = Path(tempfile.mkdtemp(prefix="auth-keys-"))
+            temporary.append(key_manager.key_dir)
+        key_manager.signing_key()
+    # one access log file per worker, rotating a shared file is not process safe
+    if settings.access_log_file and "{pid}" not in settings.access_log_file:
+        path = Path(settings.access_log_file)
+        settings.access_log_file = str(path.with_name(f"{path.stem}.{{pid}}{path.suffix}"))
+    return temporary
+
+
+def serve(app, host: str = "0.0.0.0", port: int = 80, workers: int | None = None):
+    workers = workers or settings.workers
+    if workers <= 1:
+        uvicorn.run(app, host=host, port=port)
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    temporary = prepare_workers(workers)
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
+            self.cfg.set("preload_app", True)
+
+        def load(self):
+            return app
+
+    try:
+        Server().run()
+    finally:
+        for path in temporary:
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,289 @@
+"""
+Load test of the token and user endpoints, reporting RPS and latency percentiles as JSON.
+
+    python -m benchmarks.seed --database bench.db --users 10000
+    python -m benchmarks.bench_api --database bench.db --concurrency 16 --requests 2000
+    python -m benchmarks.bench_api --database bench.db --server uvicorn --workers 2
+    python -m benchmarks.bench_api --url http://localhost:3000 --users 10000
+    python -m benchmarks.bench_api --database bench.db --endpoints create update delete
+
+The in-process target drives the ASGI app directly, `--server uvicorn` starts a
+local server for the database (main.py, with --workers forked by gunicorn), and `--url` targets a server that is already
+running (seeded with benchmarks.seed). Compare two result files with
+benchmarks.compare. The write endpoints create users of their own and delete
+them again, updates set a seeded user's email to itself.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
+import httpx
+
+from benchmarks.seed import ADMIN, CLIENT, PASSWORD, PEPPER, user_email
+
+ENDPOINTS = ("token", "refresh", "admin_token", "client_token", "user", "users")
+# admin writes to POST, PUT and DELETE /user/, only run when asked for
+WRITE_ENDPOINTS = ("create", "update", "delete")
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(endpoint: str, latencies: list, statuses: Counter, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "endpoint": endpoint,
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if status >= 400),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+    }
+
+
+async def login(client: httpx.AsyncClient, users: int) -> httpx.Response:
+    email = user_email(random.randint(1, users))
+    return await client.post("/token/", json={"email": email, "password": PASSWORD})
+
+
+async def admin_headers(client: httpx.AsyncClient) -> dict:
+    response = await client.post(
+        "/admin_token/", data={"username": ADMIN, "password": PASSWORD}
+    )
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def write(
+    client: httpx.AsyncClient, endpoint: str, headers: dict, users: int, created: list
+) -> httpx.Response:
+    if endpoint == "create":
+        email = f"bench-{len(created)}-{random.getrandbits(32)}@example.com"
+        created.append(email)
+        return await client.post(
+            "/user/", json={"email": email, "password": PASSWORD}, headers=headers
+        )
+    if endpoint == "update":
+        email = user_email(random.randint(1, users))
+        params = {"email": email, "new_email": email}
+        return await client.put("/user/", params=params, headers=headers)
+    # the users created before, unknown ones once they are gone
+    email = created.pop() if created else "bench-gone@example.com"
+    return await client.delete("/user/", params={"email": email}, headers=headers)
+
+
+async def run_endpoint(
+    client: httpx.AsyncClient,
+    endpoint: str,
+    concurrency: int,
+    requests: int,
+    users: int,
+    created: list | None = None,
+) -> dict:
+    latencies: list = []
+    statuses: Counter = Counter()
+    remaining = requests
+    headers = await admin_headers(client) if endpoint in WRITE_ENDPOINTS else {}
+    created = [] if created is None else created
+    # every refresh worker follows the rotation of its own login, set up untimed
+    refresh_tokens = []
+    if endpoint == "refresh":
+        logins = await asyncio.gather(*(login(client, users) for _ in range(concurrency)))
+        refresh_tokens = [response.json()["refresh_token"] for response in logins]
+
+    async def worker(number: int):
+        nonlocal remaining
+        refresh_token = refresh_tokens[number] if refresh_tokens else None
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            if endpoint == "token":
+                response = await login(client, users)
+            elif endpoint == "refresh":
+                response = await client.post(
+                    "/refresh/", json={"refresh_token": refresh_token}
+                )
+                refresh_token = response.json().get("refresh_token", refresh_token)
+            elif endpoint == "admin_token":
+                response = await client.post(
+                    "/admin_token/", data={"username": ADMIN, "password": PASSWORD}
+                )
+            elif endpoint == "client_token":
+                response = await client.post(
+                    "/client_token/",
+                    data={"grant_type": "client_credentials"},
+                    auth=(CLIENT, PASSWORD),
+                )
+            elif endpoint in WRITE_ENDPOINTS:
+                response = await write(client, endpoint, headers, users, created)
+            elif endpoint == "user":
+                params = {"email": user_email(random.randint(1, users))}
+                response = await client.get("/user/", params=params)
+            else:
+                params = {"after": random.randint(0, max(users - 100, 0)), "limit": 100}
+                response = await client.get("/users/", params=params)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(number) for number in range(concurrency)))
+    return summarize(endpoint, latencies, statuses, time.perf_counter() - started)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def uvicorn_server(workers: int):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "main.py", "--host", "127.0.0.1", "--port", str(port)]
+        + ["--workers", str(workers)],
+        env=os.environ.copy(),
+        stdout=subprocess.DEVNULL,  # uvicorn's own access log
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+            for _ in range(300):
+                try:
+                    await client.get("/")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            yield client
+    finally:
+        server.terminate()
+        server.wait()
+
+
+@asynccontextmanager
+async def target_client(args):
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=60) as client:
+            yield client
+    elif args.server == "uvicorn":
+        async with uvicorn_server(args.workers) as client:
+            yield client
+    else:
+        # the app binds its engine to DATABASE when it is imported
+        from api import app
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=60
+        ) as client:
+            yield client
+
+
+def configure_server(database: str):
+    """
+    Environment of the app under test, set before it is imported or started
+    """
+    os.environ["DATABASE"] = database
+    os.environ.setdefault("ACCESS_TOKEN_SECRET", "benchmark-access-secret")
+    os.environ.setdefault("REFRESH_TOKEN_SECRET", "benchmark-refresh-secret")
+    os.environ.setdefault("CLIENT_SECRET_PEPPER", PEPPER)
+    # every request comes from one client, measure the endpoints, not the limiter
+    os.environ.setdefault("RATE_LIMIT_STORE", "none")
+
+
+def count_users(database: str) -> int:
+    import sqlite3
+
+    with sqlite3.connect(database) as conn:
+        # the seeded admin is not one of the numbered users
+        return conn.execute("SELECT count(*) FROM user").fetchone()[0] - 1
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    results = []
+    created = []  # users created by the create endpoint, for delete
+    async with target_client(args) as client:
+        for endpoint in args.endpoints:
+            results.append(
+                await run_endpoint(
+                    client,
+                    endpoint,
+                    args.concurrency,
+                    args.requests,
+                    args.users,
+                    created,
+                )
+            )
+    return {
+        "commit": git_commit(),
+        "target": args.url or args.server,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--database", help="seeded database, see benchmarks.seed")
+    parser.add_argument("--users", type=int, help="seeded users (default: counted)")
+    parser.add_argument("--url", help="benchmark a running server instead")
+    parser.add_argument("--server", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--workers", type=int, default=1, help="server workers")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=1000, help="per endpoint")
+    parser.add_argument(
+        "--endpoints",
+        nargs="+",
+        choices=ENDPOINTS + WRITE_ENDPOINTS,
+        default=list(ENDPOINTS),
+    )
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    if not args.url:
+        if not args.database:
+            parser.error("--database is required unless --url is given")
+        configure_server(args.database)
+    if args.users is None:
+        if not args.database:
+            parser.error("--users is required with --url")
+        args.users = count_users(args.database)
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
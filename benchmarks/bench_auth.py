@@ -0,0 +1,85 @@
+"""
+Per call cost of authorising an admin request, the bearer header check alone
+against verifying the token and its role with require_admin.
+
+    python -m benchmarks.bench_auth --calls 20000
+
+Each case resolves the dependencies directly, without the HTTP stack, on a
+temporary migrated database: `bearer` only reads the Authorization header (the
+check the admin routes used to make), `admin` verifies a token seen before (the
+claims cache and the revocation list answer, the common case), `admin_cold` a
+new token every call (signature and claims checked) and `admin_reused` a second
+dependency of the same request (the principal on request.state).
+"""
+
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.bench_api import configure_server, percentile
+
+
+def request_scope(token: str) -> dict:
+    return {
+        "type": "http",
+        "method": "PUT",
+        "path": "/user/",
+        "headers": [(b"authorization", f"Bearer {token}".encode())],
+    }
+
+
+async def run(case: str, calls: int) -> dict:
+    from fastapi import Request
+    from sqlmodel import Session
+
+    from api.auth import create_access_token, current_principal, oauth_scheme, require_admin
+    from api.db import engine
+
+    admin = "admin@example.com"
+    tokens = [create_access_token(admin, is_admin=True)]
+    if case == "admin_cold":
+        tokens = [create_access_token(admin, is_admin=True) for _ in range(calls)]
+    latencies = []
+    with Session(engine) as session:
+        # the revocation list loads on the first check, untimed
+        await current_principal(Request(request_scope(tokens[0])), tokens[0], session)
+        for number in range(calls):
+            token = tokens[number % len(tokens)]
+            request = Request(request_scope(token))
+            if case == "admin_reused":
+                await current_principal(request, token, session)
+            started = time.perf_counter()
+            if case == "bearer":
+                await oauth_scheme(request)
+            else:
+                await require_admin(await current_principal(request, token, session))
+            latencies.append(time.perf_counter() - started)
+    ordered = sorted(latencies)
+    return {
+        "case": case,
+        "calls": calls,
+        "mean_us": round(sum(ordered) / len(ordered) * 1e6, 2),
+        "p50_us": round(percentile(ordered, 0.50) * 1e6, 2),
+        "p99_us": round(percentile(ordered, 0.99) * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        configure_server(str(Path(tmp, "bench.db")))
+        from api.migrate import migrate
+
+        migrate()
+        for case in ("bearer", "admin", "admin_cold", "admin_reused"):
+            print(json.dumps(asyncio.run(run(case, args.calls))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Throughput and latency of the hot crud statements on sqlite and PostgreSQL.
+
+    python -m benchmarks.bench_backends --postgres-url postgresql://postgres@localhost/bench
+
+Each backend is migrated and seeded, then threads run user lookups by email,
+refresh token rotations and user inserts for a fixed time each. The sqlite file
+is temporary, the PostgreSQL database should be an empty one (the tables are
+dropped afterwards). Without --postgres-url or BENCH_POSTGRES_URL only sqlite runs.
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import insert
+from sqlmodel import Session, SQLModel
+
+from api import crud
+from api.db import create_db_engine
+from api.migrate import migrate, version_metadata
+from api.model import RefreshTokenFamily, User
+from benchmarks.bench_api import percentile
+from benchmarks.seed import seed_users, user_email
+
+
+def seed(engine, users: int):
+    seed_users(engine, users, "x")
+    expires = datetime.utcnow() + timedelta(days=1)
+    with Session(engine) as session:
+        session.execute(
+            insert(RefreshTokenFamily),
+            [
+                {
+                    "id": f"family{number}",
+                    "email": user_email(number),
+                    "jti": "0",
+                    "expires": expires,
+                }
+                for number in range(1, users + 1)
+            ],
+        )
+        session.commit()
+
+
+def lookup(engine, worker: int, count: int, users: int):
+    with Session(engine) as session:
+        session.exec(crud.user_by_email(user_email(count % users + 1))).first()
+
+
+def rotation(engine, worker: int, count: int, users: int):
+    # the jti is compared with itself to rotate whatever the current one is
+    with Session(engine) as session:
+        session.execute(
+            crud.token_rotation(
+                f"family{random.randint(1, users)}",
+                jti=RefreshTokenFamily.jti,
+                new_jti=uuid.uuid4().hex,
+                expires=datetime.utcnow() + timedelta(days=1),
+            )
+        )
+        session.commit()
+
+
+def create(engine, worker: int, count: int, users: int):
+    with Session(engine) as session:
+        session.add(User(email=f"new{worker}-{count}@example.com", hashed_password="x"))
+        session.commit()
+
+
+OPERATIONS = {"lookup": lookup, "rotation": rotation, "create": create}
+
+
+def run(engine, operation, threads: int, seconds: float, users: int) -> dict:
+    latencies = [[] for _ in range(threads)]
+    errors = [0] * threads
+    deadline = time.monotonic() + seconds
+
+    def work(worker: int):
+        count = 0
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                operation(engine, worker, count, users)
+                latencies[worker].append(time.perf_counter() - started)
+            except Exception:
+                errors[worker] += 1
+            count += 1
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    ordered = sorted(latency for thread in latencies for latency in thread)
+    return {
+        "operations": len(ordered),
+        "ops_per_second": round(len(ordered) / seconds, 1),
+        "errors": sum(errors),
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+    }
+
+
+def bench(backend: str, url: str, args):
+    engine = create_db_engine(url)
+    try:
+        with engine.connect():
+            pass
+    except Exception as exc:
+        print(json.dumps({"backend": backend, "skipped": str(exc).splitlines()[0]}))
+        return
+    try:
+        migrate(engine)
+        seed(engine, args.users)
+        for name, operation in OPERATIONS.items():
+            result = run(engine, operation, args.threads, args.seconds, args.users)
+            print(
+                json.dumps(
+                    {"backend": backend, "operation": name, "threads": args.threads, **result}
+                )
+            )
+    finally:
+        SQLModel.metadata.drop_all(engine)
+        version_metadata.drop_all(engine)
+        engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--postgres-url", default=os.environ.get("BENCH_POSTGRES_URL"))
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--users", type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bench("sqlite", f"sqlite:///{Path(tmp, 'bench.db')}", args)
+    if args.postgres_url:
+        bench("postgresql", args.postgres_url, args)
+
+
+if __name__ == "__main__":
+    main()
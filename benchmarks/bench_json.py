@@ -0,0 +1,118 @@
+"""
+Serialization cost of a 10k user GET /users/ response and a /token/ response,
+FastAPI's response_model path against the encoders of api.serialization.
+
+    python -m benchmarks.bench_json --users 10000 --runs 20
+
+`response_model` validates the rows against the response model, runs
+jsonable_encoder and renders with the stdlib (what a handler returning the rows
+costs), `validated` is UserShow.from_orm per row with the stdlib (GET /users/
+before the rows were trusted), the other cases render plain dicts with each
+encoder available (json, orjson).
+"""
+
+import argparse
+import json
+import statistics
+import time
+from typing import List
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from sqlalchemy import insert
+from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.pool import StaticPool
+
+from api import crud
+from api.http_cache import public_user
+from api.model import Token, User, UserShow
+from api.serialization import ENCODERS
+
+
+def load_rows(users: int) -> list:
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.execute(
+            insert(User),
+            [{"email": f"user{i}@example.com", "hashed_password": "x"} for i in range(users)],
+        )
+        session.commit()
+        return session.execute(crud.user_page()).all()
+
+
+def completed(coroutine):
+    # serialize_response never awaits with is_coroutine=True, no event loop needed
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    raise RuntimeError("serialize_response awaited")
+
+
+def timed(render, runs: int) -> dict:
+    durations, size = [], 0
+    for _ in range(runs):
+        started = time.perf_counter()
+        size = len(render())
+        durations.append(time.perf_counter() - started)
+    return {
+        "bytes": size,
+        "mean_ms": round(statistics.mean(durations) * 1000, 3),
+        "min_ms": round(min(durations) * 1000, 3),
+    }
+
+
+def cases(payload: str, rows: list) -> dict:
+    if payload == "users":
+        field = create_response_field("Response_users", List[UserShow])
+        content = rows
+
+        def plain():
+            return [public_user(row) for row in rows]
+
+        def validated():
+            return JSONResponse([UserShow.from_orm(row).dict() for row in rows]).body
+
+    else:
+        field = create_response_field("Response_token", Token)
+        content = {
+            "access_token": "a" * 200,
+            "token_type": "bearer",
+            "refresh_token": "r" * 200,
+        }
+
+        def plain():
+            return {**content}
+
+        def validated():
+            return JSONResponse(Token(**content).dict()).body
+
+    def response_model():
+        serialized = completed(serialize_response(field=field, response_content=content))
+        return JSONResponse(serialized).body
+
+    renders = {"response_model": response_model, "validated": validated}
+    for name, dumps in ENCODERS.items():
+        renders[name] = lambda dumps=dumps: dumps(plain())
+    return renders
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = load_rows(args.users)
+    for payload in ("users", "token"):
+        # the token body is tiny, more runs for a stable mean
+        runs = args.runs if payload == "users" else args.runs * 100
+        for case, render in cases(payload, rows).items():
+            result = timed(render, runs)
+            print(json.dumps({"payload": payload, "case": case, "runs": runs, **result}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Write throughput of concurrent logins storing a refresh token, comparing the bare
+sqlite engine with the tuned connection profile from api.db.
+
+    python -m benchmarks.bench_sqlite --threads 8 --seconds 5
+"""
+
+import argparse
+import json
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from sqlalchemy import update
+from sqlmodel import Session, SQLModel, create_engine
+
+from api.db import create_sqlite_engine
+from api.model import User
+
+
+def seed(engine, users: int):
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(
+            User(email=f"user{i}@example.com", hashed_password="x") for i in range(users)
+        )
+        session.commit()
+
+
+def run(engine, threads: int, seconds: float, users: int) -> dict:
+    writes = [0] * threads
+    errors = [0] * threads
+    deadline = time.monotonic() + seconds
+
+    def login(worker: int):
+        user_id = worker % users + 1
+        while time.monotonic() < deadline:
+            try:
+                with Session(engine) as session:
+                    session.execute(
+                        update(User)
+                        .where(User.id == user_id)
+                        .values(refresh_token=uuid.uuid4().hex)
+                    )
+                    session.commit()
+                writes[worker] += 1
+            except Exception:
+                errors[worker] += 1
+
+    workers = [threading.Thread(target=login, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return {
+        "writes": sum(writes),
+        "writes_per_second": round(sum(writes) / seconds, 1),
+        "errors": sum(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        profiles = {
+            "bare": create_engine(f"sqlite:///{Path(tmp, 'bare.db')}"),
+            "tuned": create_sqlite_engine(str(Path(tmp, "tuned.db"))),
+        }
+        for name, engine in profiles.items():
+            seed(engine, args.users)
+            result = run(engine, args.threads, args.seconds, args.users)
+            print(json.dumps({"profile": name, "threads": args.threads, **result}))
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
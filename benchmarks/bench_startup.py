@@ -0,0 +1,132 @@
+"""
+Cold start of the server, each phase timed in fresh processes and reported as JSON.
+
+    python -m benchmarks.seed --database bench.db --users 1000
+    python -m benchmarks.bench_startup --database bench.db --runs 5
+
+Phases: starting the interpreter, `import api`, create_app(), the first request
+(GET /) and the first login (POST /token/, loads the hashing backend), plus the
+time from spawning main.py to its first response.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.bench_api import configure_server, free_port, git_commit
+from benchmarks.seed import PASSWORD, user_email
+
+# runs in a fresh interpreter, so nothing is imported or cached yet
+PHASES = f"""
+import asyncio, json, time
+started = time.perf_counter()
+import api
+imported = time.perf_counter()
+app = api.create_app()
+created = time.perf_counter()
+import httpx
+
+async def first_requests():
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        before = time.perf_counter()
+        await client.get("/")
+        between = time.perf_counter()
+        login = {{"email": "{user_email(1)}", "password": "{PASSWORD}"}}
+        await client.post("/token/", json=login)
+        return between - before, time.perf_counter() - between
+
+first_request, first_login = asyncio.run(first_requests())
+print(json.dumps({{
+    "import_api": imported - started,
+    "create_app": created - imported,
+    "first_request": first_request,
+    "first_login": first_login,
+}}))
+"""
+
+
+def timed_process(args: list) -> float:
+    started = time.perf_counter()
+    subprocess.run(args, check=True, env=os.environ.copy())
+    return time.perf_counter() - started
+
+
+def phases() -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", PHASES],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=os.environ.copy(),
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def time_to_first_response(timeout: float = 60) -> float:
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "main.py", "--host", "127.0.0.1", "--port", str(port)],
+        env=os.environ.copy(),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                httpx.get(f"http://127.0.0.1:{port}/", timeout=1)
+                return time.perf_counter() - started
+            except httpx.TransportError:
+                time.sleep(0.005)
+        raise TimeoutError("server did not respond")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run(runs: int) -> dict:
+    samples: dict = {"interpreter": [], "main_py_first_response": []}
+    for _ in range(runs):
+        samples["interpreter"].append(timed_process([sys.executable, "-c", "pass"]))
+        for phase, seconds in phases().items():
+            samples.setdefault(phase, []).append(seconds)
+        samples["main_py_first_response"].append(time_to_first_response())
+    return {
+        "commit": git_commit(),
+        "runs": runs,
+        "median_ms": {
+            phase: round(statistics.median(values) * 1000, 2)
+            for phase, values in samples.items()
+        },
+        "max_ms": {
+            phase: round(max(values) * 1000, 2) for phase, values in samples.items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--database", required=True, help="see benchmarks.seed")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    configure_server(args.database)
+    os.environ.setdefault("ACCESS_LOG_FILE", "")
+    report = json.dumps(run(args.runs), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
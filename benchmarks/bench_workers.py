@@ -0,0 +1,75 @@
+"""
+Throughput of /token/ by number of server worker processes, as JSON.
+
+    python -m benchmarks.seed --database bench.db --users 10000
+    python -m benchmarks.bench_workers --database bench.db --workers 1 2 4 --requests 400
+
+Login is bound by bcrypt, so its throughput should grow with the workers until
+they outnumber the cores. Each worker count gets a fresh server (main.py).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+
+from benchmarks.bench_api import (
+    configure_server,
+    count_users,
+    git_commit,
+    run_endpoint,
+    uvicorn_server,
+)
+
+
+async def run(args) -> dict:
+    results = []
+    for workers in args.workers:
+        async with uvicorn_server(workers) as client:
+            # warm up every worker before the timed run
+            await run_endpoint(client, "token", workers * 2, workers * 2, args.users)
+            result = await run_endpoint(
+                client, "token", args.concurrency, args.requests, args.users
+            )
+        result["workers"] = workers
+        results.append(result)
+
+    baseline = results[0]["rps"] / results[0]["workers"] if results else 0
+    for result in results:
+        speedup = result["rps"] / baseline if baseline else 0.0
+        result["speedup"] = round(speedup, 2)
+        result["efficiency"] = round(speedup / result["workers"], 2)
+    return {
+        "commit": git_commit(),
+        "cpus": os.cpu_count(),
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--database", required=True, help="see benchmarks.seed")
+    parser.add_argument("--users", type=int, help="seeded users (default: counted)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=400, help="per worker count")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    configure_server(args.database)
+    if args.users is None:
+        args.users = count_users(args.database)
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Compare two benchmark result files, e.g. of two commits.
+
+    python -m benchmarks.compare before.json after.json
+"""
+
+import argparse
+import json
+
+
+def change(before: float, after: float) -> str:
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before = {r["endpoint"]: r for r in json.load(before_file)["results"]}
+        after = {r["endpoint"]: r for r in json.load(after_file)["results"]}
+
+    print(f"{'endpoint':<12} {'rps':>18} {'p99 ms':>18} {'change':>16}")
+    for endpoint in [endpoint for endpoint in before if endpoint in after]:
+        old, new = before[endpoint], after[endpoint]
+        print(
+            f"{endpoint:<12} {old['rps']:>8} -> {new['rps']:<8} "
+            f"{old['p99_ms']:>8} -> {new['p99_ms']:<8} "
+            f"{change(old['rps'], new['rps']):>7} / {change(old['p99_ms'], new['p99_ms'])}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Seed a database with benchmark users.
+
+    python -m benchmarks.seed --database bench.db --users 100000
+    python -m benchmarks.seed --url postgresql://postgres@localhost/bench --users 100000
+
+Users are user<n>@example.com (n from 1) plus the admin admin@example.com, all
+with the same password. The password is hashed once with the configured
+scheme and cost, so logins cost the same as for real users while seeding a
+million rows takes seconds. The client `bench` of the client credentials grant
+has the password as its secret, keyed with CLIENT_SECRET_PEPPER (default:
+PEPPER, which benchmarks.bench_api configures the server with).
+"""
+
+import argparse
+import os
+import time
+
+from sqlalchemy import insert
+from sqlmodel import Session
+
+from api.migrate import migrate
+from api.model import Client, User
+
+PASSWORD = "benchmark-password"
+ADMIN = "admin@example.com"
+CLIENT = "bench"
+PEPPER = "benchmark-pepper"
+
+
+def user_email(number: int) -> str:
+    return f"user{number}@example.com"
+
+
+def seed_users(engine, count: int, hashed_password: str, batch_size: int = 10000):
+    migrate(engine)
+    with Session(engine) as session:
+        session.execute(
+            insert(User),
+            [{"email": ADMIN, "hashed_password": hashed_password, "is_admin": True}],
+        )
+        for start in range(1, count + 1, batch_size):
+            session.execute(
+                insert(User),
+                [
+                    {"email": user_email(number), "hashed_password": hashed_password}
+                    for number in range(start, min(start + batch_size, count + 1))
+                ],
+            )
+        session.commit()
+
+
+def seed_client(engine, secret: str = PASSWORD):
+    from api.clients import hash_client_secret
+
+    migrate(engine)
+    with Session(engine) as session:
+        session.add(Client(client_id=CLIENT, secret_hash=hash_client_secret(secret)))
+        session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--database", help="sqlite file")
+    target.add_argument("--url", help="database url")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--password", default=PASSWORD)
+    args = parser.parse_args()
+
+    # before the settings are loaded
+    os.environ.setdefault("CLIENT_SECRET_PEPPER", PEPPER)
+    from api.config import settings
+    from api.db import create_db_engine
+
+    engine = create_db_engine(args.url or f"sqlite:///{args.database}")
+    started = time.perf_counter()
+    seed_users(engine, args.users, settings.pwd_context.hash(args.password))
+    seed_client(engine, args.password)
+    print(f"Seeded {args.users} users in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,25 @@
-import uvicorn
+import argparse
 
-from api import app
+from api import create_app
+from api.config import settings
+
+# for `uvicorn main:app`, run `python -m api.migrate` first
+app = create_app()
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=80)
+    from api.migrate import migrate
+    from api.serve import serve
+
+    parser = argparse.ArgumentParser(description="Run the auth server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=settings.workers,
+        help="worker processes forked from the preloaded app (default: WORKERS or 1)",
+    )
+    args = parser.parse_args()
+    # once, before any worker starts
+    migrate()
+    serve(app, host=args.host, port=args.port, workers=args.workers)
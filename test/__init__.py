@@ -1,3 +1,5 @@
+import os
+
 from api import app
 from api.config import Settings
 from api.db import get_session
@@ -9,14 +11,19 @@ from sqlmodel.pool import StaticPool
 mock_settings = Settings(
     access_token_secret="aCcEsS_sEcRet",
     refresh_token_secret="ReFrEsH_sEcRet",
+    client_secret_pepper="ClIeNt_PePpEr",
 )
 
-# test database engine
-test_engine = create_engine(
-    url="sqlite://",
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
-)
+# test database engine, TEST_DATABASE_URL runs the tests against another
+# database (see test_postgres.py)
+if test_database_url := os.environ.get("TEST_DATABASE_URL"):
+    test_engine = create_engine(url=test_database_url)
+else:
+    test_engine = create_engine(
+        url="sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
 
 
 # override in app db connection dependancy
@@ -32,3 +39,16 @@ app.dependency_overrides[get_session] = override_get_session
 
 
 test_client = TestClient(app)
+
+
+def introspect(token: str, caller: str | None = None):
+    """
+    POST /introspect/ as a resource server holding a token with the introspect
+    scope, api.auth.settings must be mock_settings
+    """
+    from api.auth import INTROSPECT_SCOPE, create_access_token
+
+    caller = caller or create_access_token("resource-server", scope=INTROSPECT_SCOPE)
+    return test_client.post(
+        "/introspect/", data={"token": token}, headers={"Authorization": f"Bearer {caller}"}
+    )
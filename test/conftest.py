@@ -2,7 +2,9 @@ from dataclasses import dataclass
 from test import test_engine
 
 import pytest
-from api import crud
+from api import clients, crud
+from api.ratelimit import login_limiter
+from api.revocation import revocation_list
 from api.model import UserCreate
 from sqlmodel import Session, SQLModel
 
@@ -18,6 +20,11 @@ class FakeUser:
 # database session fixture
 @pytest.fixture()
 def db_session():
+    # start without users cached or logins counted by earlier tests
+    crud.user_cache.clear()
+    clients.token_cache.clear()
+    login_limiter.store.clear()
+    revocation_list.version = None
     # create all tables
     SQLModel.metadata.create_all(test_engine)
     # inject a couple of test users
@@ -32,5 +39,7 @@ def db_session():
     # clean up database
     # close session
     session.close()
+    # forget users cached from this database
+    crud.user_cache.clear()
     # delete all tables
     SQLModel.metadata.drop_all(test_engine)
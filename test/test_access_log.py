@@ -0,0 +1,71 @@
+import json
+import logging
+from test import test_client
+from unittest import mock
+
+from api import access_log
+from api.access_log import BoundedQueueHandler, JsonFormatter, RotatingLogFileHandler
+
+
+def make_record(message="hello", **extra):
+    record = logging.LogRecord("api.access", logging.INFO, __file__, 1, message, None, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_drop_policy():
+    handler = BoundedQueueHandler(maxsize=1, policy="drop")
+    before = access_log.DROPPED.value()
+    handler.handle(make_record())
+    handler.handle(make_record())
+    assert handler.queue.qsize() == 1
+    assert access_log.DROPPED.value() == before + 1
+
+
+def test_block_policy():
+    handler = BoundedQueueHandler(maxsize=1, policy="block", timeout=0.01)
+    before = access_log.DROPPED.value()
+    handler.handle(make_record())
+    # waits for room no longer than the timeout, then drops
+    handler.handle(make_record())
+    assert handler.queue.qsize() == 1
+    assert access_log.DROPPED.value() == before + 1
+
+
+def test_json_format():
+    line = JsonFormatter().format(make_record(method="GET", status=200, latency_ms=1.5))
+    entry = json.loads(line)
+    assert entry["message"] == "hello"
+    assert entry["method"] == "GET"
+    assert entry["status"] == 200
+    assert entry["latency_ms"] == 1.5
+    assert "client" not in entry
+
+
+def test_rotation(tmp_path):
+    path = tmp_path / "access.log"
+    handler = RotatingLogFileHandler(str(path), max_bytes=50, interval=60, backups=2)
+    with mock.patch("api.access_log.time.time", return_value=handler.rollover_at - 1):
+        handler.emit(make_record("x" * 40))
+        handler.emit(make_record("y" * 40))  # over max_bytes
+    assert (tmp_path / "access.log.1").read_text() == "x" * 40 + "\n"
+    with mock.patch("api.access_log.time.time", return_value=handler.rollover_at):
+        handler.emit(make_record("z"))  # interval elapsed
+    handler.close()
+    assert (tmp_path / "access.log.2").exists()
+    assert path.read_text() == "z\n"
+
+
+def test_access_log(db_session, tmp_path):
+    path = tmp_path / "access.log"
+    with mock.patch.object(access_log.settings, "access_log_file", str(path)):
+        listener = access_log.start_access_log()
+    test_client.get("/user/", params={"email": "fake_user@email.com"})
+    access_log.stop_access_log(listener)
+
+    entry = json.loads(path.read_text().splitlines()[-1])
+    assert entry["method"] == "GET"
+    assert entry["path"] == "/user/"  # query strings are not logged
+    assert entry["route"] == "/user/"
+    assert entry["status"] == 200
+    assert entry["latency_ms"] > 0
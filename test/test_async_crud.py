@@ -0,0 +1,107 @@
+import asyncio
+from datetime import datetime
+from unittest import mock
+
+import pytest
+from api import async_crud, crud
+from api.config import settings
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel.pool import StaticPool
+
+from .conftest import FakeUser
+
+
+async def run_with_async_session(check):
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    try:
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            await check(session)
+    finally:
+        await engine.dispose()
+        crud.user_cache.clear()
+
+
+def test_async_backend():
+    async def check(session: AsyncSession):
+        # create
+        created = await async_crud.create_user(FakeUser.user, session)
+        assert created.email == FakeUser.user.email
+        with pytest.raises(IntegrityError):
+            await async_crud.create_user(FakeUser.user, session)
+
+        # retrieve
+        user = await async_crud.get_user(FakeUser.user.email, session)
+        assert user.id == created.id
+        assert await async_crud.get_user("i@dont.exist", session) is None
+        await async_crud.create_user(FakeUser.admin, session)
+        users = await async_crud.get_all_users(session)
+        assert [u.email for u in users] == [FakeUser.user.email, FakeUser.admin.email]
+        page = await async_crud.get_users_page(session, after=1, limit=5)
+        assert [tuple(row) for row in page] == [(2, FakeUser.admin.email)]
+        chunks = [rows async for rows in async_crud.iter_users(session, chunk_size=1)]
+        assert [len(rows) for rows in chunks] == [1, 1]
+
+        # update
+        assert await async_crud.update_user("i@dont.exist", session) is None
+        updated = await async_crud.update_user(
+            FakeUser.user.email, session, password="1234", is_admin=1
+        )
+        assert updated.is_admin
+        assert settings.pwd_context.verify("1234", updated.hashed_password)
+        with pytest.raises(IntegrityError):
+            await async_crud.update_user(
+                FakeUser.user.email, session, new_email=FakeUser.admin.email
+            )
+
+        # delete
+        await async_crud.delete_user(FakeUser.user.email, session)
+        assert await async_crud.get_user(FakeUser.user.email, session) is None
+
+    asyncio.run(run_with_async_session(check))
+
+
+def test_async_rollback():
+    async def check(session: AsyncSession):
+        await async_crud.create_user(FakeUser.user, session)
+        expires = datetime.utcnow()
+        locked = OperationalError("COMMIT", {}, Exception("database is locked"))
+
+        # a failed commit rolls the writes back and leaves the session usable
+        with mock.patch.object(session, "commit", side_effect=locked):
+            with pytest.raises(OperationalError):
+                await async_crud.delete_user(FakeUser.user.email, session)
+            with pytest.raises(OperationalError):
+                await async_crud.revoke_access_token("jti", "a@b.com", expires, session)
+        assert await async_crud.load_user(FakeUser.user.email, session) is not None
+        assert not await async_crud.is_token_revoked("jti", session)
+        assert await async_crud.delete_user(FakeUser.user.email, session)
+
+    asyncio.run(run_with_async_session(check))
+
+
+def test_sync_backend(db_session: Session):
+    async def check():
+        user = await async_crud.get_user(FakeUser.user.email, db_session)
+        assert user.email == FakeUser.user.email
+        assert len(await async_crud.get_all_users(db_session)) == 2
+
+        created = await async_crud.create_user(FakeUser.new, db_session)
+        assert created.email == FakeUser.new.email
+        updated = await async_crud.update_user(
+            FakeUser.new.email, db_session, password="1234"
+        )
+        assert settings.pwd_context.verify("1234", updated.hashed_password)
+
+        await async_crud.delete_user(FakeUser.new.email, db_session)
+        assert await async_crud.get_user(FakeUser.new.email, db_session) is None
+
+    asyncio.run(check())
@@ -1,12 +1,16 @@
-from test import mock_settings, test_client
+import asyncio
+from datetime import datetime
+from test import introspect, mock_settings, test_client
 from unittest import mock
 
 import pytest
 from api import auth, crud
 from api.exceptions import InvalidCredentialException
-from api.model import Token, UserIn
+from api.config import build_pwd_context
+from api.model import Token, UserCreate, UserIn
 from jose import jwt
 from jose.exceptions import ExpiredSignatureError, JWTError
+from passlib.hash import pbkdf2_sha256
 from sqlmodel import Session
 
 from .conftest import FakeUser
@@ -31,23 +35,73 @@ def jwt_creator(
 
 def test_authenticate_user(db_session: Session):
     # failed non-existing
-    failed_user = auth.authenticate_user(
-        UserIn(email="any@email.com", password="anypass"), db_session
+    failed_user = asyncio.run(
+        auth.authenticate_user(
+            UserIn(email="any@email.com", password="anypass"), db_session
+        )
     )
     assert not failed_user
 
     # failed wrong password
-    failed_user = auth.authenticate_user(
-        UserIn(email=FakeUser.user.email, password="anypass"), db_session
+    failed_user = asyncio.run(
+        auth.authenticate_user(
+            UserIn(email=FakeUser.user.email, password="anypass"), db_session
+        )
     )
     assert not failed_user
 
     # successful
-    success_user = auth.authenticate_user(FakeUser.user, db_session)
+    success_user = asyncio.run(auth.authenticate_user(FakeUser.user, db_session))
     assert success_user is not None
     assert success_user.email == FakeUser.user.email
 
 
+@mock.patch("api.auth.settings", mock_settings)
+def test_rehash_on_login(db_session: Session):
+    # a user migrated with a pbkdf2 hash
+    migrated = UserCreate(email="migrated@email.com", password="migratedpass")
+    old_hash = pbkdf2_sha256.hash(migrated.password)
+    crud.create_user(migrated, db_session, hashed_password=old_hash)
+    assert mock_settings.pwd_context.needs_update(old_hash)
+
+    # the login succeeds and the hash is upgraded after the response
+    response = test_client.post("/token/", json=migrated.dict())
+    assert response.status_code == 200
+    new_hash = crud.load_user(migrated.email, db_session).hashed_password
+    assert new_hash != old_hash
+    assert mock_settings.pwd_context.identify(new_hash) == "bcrypt"
+    assert not mock_settings.pwd_context.needs_update(new_hash)
+
+    # the upgrade keeps the login's refresh token valid
+    refresh_token = response.json()["refresh_token"]
+    response = test_client.post("/refresh/", json={"refresh_token": refresh_token})
+    assert response.status_code == 200
+
+    # an upgrade is skipped when the hash changed in the meantime
+    assert not crud.upgrade_password_hash(migrated.email, old_hash, "x", db_session)
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_unverifiable_hash_login(db_session: Session):
+    # no argon2 backend installed here, or a hash no scheme recognizes
+    for email, hashed_password in [
+        ("argon2@email.com", "$argon2id$v=19$m=65536,t=3,p=4$c2FsdHNhbHQ$aGFzaGhhc2hoYXNo"),
+        ("garbage@email.com", "garbage"),
+    ]:
+        user = UserCreate(email=email, password="password")
+        crud.create_user(user, db_session, hashed_password=hashed_password)
+        response = test_client.post("/token/", json=user.dict())
+        assert response.status_code == 401
+
+
+def test_password_cost_upgrade():
+    context = build_pwd_context("bcrypt", rounds=5)
+    assert context.needs_update(build_pwd_context("bcrypt", rounds=4).hash("pw"))
+    assert not context.needs_update(context.hash("pw"))
+    with pytest.raises(ValueError):
+        build_pwd_context("md5_crypt")
+
+
 def test_create_jwt_token():
     secret = mock_settings.access_token_secret
     # token with default 15 mins expiry time
@@ -94,28 +148,40 @@ def test_create_refresh_token():
 
 
 @mock.patch("api.auth.settings", mock_settings)
-def test_get_user_from_refresh_token(db_session: Session):
-    # refresh token without email encoded
-    noemail_token = jwt_creator(email=None)
+def test_rotate_refresh_token(db_session: Session):
+    def rotate(token):
+        return asyncio.run(auth.rotate_refresh_token(token, db_session))
+
+    # not a refresh token
     with pytest.raises(InvalidCredentialException):
-        auth.get_user_from_refresh_token(noemail_token, db_session)
+        rotate("not.a.token")
 
-    # refresh token with non-existing user
-    nonuser_token = auth.create_refresh_token(email="random@email.com")
+    # refresh token without email or family encoded
     with pytest.raises(InvalidCredentialException):
-        auth.get_user_from_refresh_token(nonuser_token, db_session)
+        rotate(jwt_creator(email=None, secret=mock_settings.refresh_token_secret))
+    with pytest.raises(InvalidCredentialException):
+        rotate(
+            jwt_creator(FakeUser.user.email, secret=mock_settings.refresh_token_secret)
+        )
 
-    # a real user
-    user_token = auth.create_refresh_token(email=FakeUser.user.email)
-    # no stored refresh_token (logged out)
+    # a well formed token of a family that was never issued
+    unknown_token = auth.create_refresh_token(FakeUser.user.email, "nofamily", "nojti")
     with pytest.raises(InvalidCredentialException):
-        auth.get_user_from_refresh_token(user_token, db_session)
+        rotate(unknown_token)
+
+    # logged in user rotates its refresh token
+    user_token = asyncio.run(auth.issue_refresh_token(FakeUser.user.email, db_session))
+    email, next_token = rotate(user_token)
+    assert email == FakeUser.user.email
+    assert jwt_decoder(next_token, mock_settings.refresh_token_secret)["fam"] == (
+        jwt_decoder(user_token, mock_settings.refresh_token_secret)["fam"]
+    )
 
-    # logged in user has refresh_token
-    crud.update_user(FakeUser.user.email, db_session, refresh_token=user_token)
-    # get user
-    user = auth.get_user_from_refresh_token(user_token, db_session)
-    assert user == FakeUser.user.email
+    # replaying the used token revokes the family, next_token included
+    with pytest.raises(InvalidCredentialException):
+        rotate(user_token)
+    with pytest.raises(InvalidCredentialException):
+        rotate(next_token)
 
 
 @mock.patch("api.auth.settings", mock_settings)
@@ -154,6 +220,8 @@ def test_post_token(db_session):
     assert new_token.token_type == "bearer"
     assert new_token.access_token is not None
     assert new_token.refresh_token is not None
+    # the login does not write to the user table
+    assert crud.get_user(FakeUser.user.email, db_session).refresh_token is None
 
     # attempt to generate token for non-existing user
     response = test_client.post(
@@ -164,24 +232,145 @@ def test_post_token(db_session):
 
 @mock.patch("api.auth.settings", mock_settings)
 def test_post_refresh(db_session: Session):
-    # generate a refresh token and stored in mock db
-    test_client.post("/token/", json=FakeUser.user.dict())
+    # login for a refresh token
+    response = test_client.post("/token/", json=FakeUser.user.dict())
+    refresh_token = response.json()["refresh_token"]
 
-    # read the refresh token
-    user = crud.get_user(FakeUser.user.email, db_session)
-    # test the following endpoint wiht user.refresh_token
-    response = test_client.post("/refresh/", json={"refresh_token": user.refresh_token})
+    # renew the access token, this rotates the refresh token
+    response = test_client.post("/refresh/", json={"refresh_token": refresh_token})
     assert response.status_code == 200
-    new_access_token = Token(**response.json())
-    assert new_access_token.token_type == "bearer"
-    assert new_access_token.access_token is not None
+    new_token = Token(**response.json())
+    assert new_token.token_type == "bearer"
+    assert new_token.access_token is not None
+    assert new_token.refresh_token not in (None, refresh_token)
 
-    # attempt to use a "valid" refresh token but not the one saved in the db
-    # because the running time of this code is "too short" when using the same timedelta
-    # use a different timedelta to generate a token differs from the stored one
-    with mock.patch("api.auth.settings.refresh_token_expiry", 10):
-        valid_refresh_token = auth.create_refresh_token(FakeUser.user.email)
+    # a "valid" refresh token which was never issued by a login
+    valid_refresh_token = auth.create_refresh_token(
+        FakeUser.user.email, auth.new_token_id(), auth.new_token_id()
+    )
     response = test_client.post(
         "/refresh/", json={"refresh_token": valid_refresh_token}
     )
     assert response.status_code == 401
+
+    # replaying the rotated token is refused and ends the login
+    response = test_client.post("/refresh/", json={"refresh_token": refresh_token})
+    assert response.status_code == 401
+    response = test_client.post(
+        "/refresh/", json={"refresh_token": new_token.refresh_token}
+    )
+    assert response.status_code == 401
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_decode_access_token():
+    auth.claims_cache.clear()
+    token = auth.create_access_token(new_email)
+    assert auth.decode_access_token(token)["sub"] == new_email
+
+    # the second check is served from the cache without decoding
+    with mock.patch("api.auth.jwt.decode") as decode:
+        assert auth.decode_access_token(token)["sub"] == new_email
+        decode.assert_not_called()
+
+    # invalid tokens are never cached
+    with pytest.raises(JWTError):
+        auth.decode_access_token(jwt_creator(new_email, secret="WRONG_SECRET"))
+    with pytest.raises(ExpiredSignatureError):
+        auth.decode_access_token(jwt_creator(new_email, minutes=-5))
+    assert len(auth.claims_cache) == 1
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_post_introspect(db_session: Session):
+    token = auth.create_access_token(new_email)
+    response = introspect(token)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["active"] is True
+    assert data["sub"] == new_email
+    assert data["token_type"] == "access_token"
+    assert data["exp"] == jwt_decoder(token)["exp"]
+
+    # invalid and expired tokens are inactive
+    for token in ("not.a.token", jwt_creator(new_email, minutes=-5)):
+        response = introspect(token)
+        assert response.status_code == 200
+        assert response.json() == {"active": False}
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_introspect_caller(db_session: Session):
+    token = auth.create_access_token(new_email)
+    # the caller has to authenticate (RFC 7662 2.1)
+    response = test_client.post("/introspect/", data={"token": token})
+    assert response.status_code == 401
+    response = introspect(token, caller="not.a.token")
+    assert response.status_code == 401
+    # holding a token is not enough to ask about it
+    response = introspect(token, caller=token)
+    assert response.status_code == 403
+    assert response.json() == {"detail": "insufficient_scope"}
+    # admins may
+    admin = auth.create_access_token(FakeUser.admin.email, is_admin=True)
+    assert introspect(token, caller=admin).json()["active"] is True
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_require_admin(db_session: Session):
+    def create(token: str | None, email: str):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        return test_client.post(
+            "/user/", json={"email": email, "password": "pass"}, headers=headers
+        )
+
+    # no token, an invalid token
+    assert create(None, "a@example.com").status_code == 401
+    response = create("not.a.token", "a@example.com")
+    assert response.status_code == 401
+    assert response.headers["www-authenticate"] == "Bearer"
+
+    # the role comes from the token, not the user table
+    user_token = auth.create_access_token(FakeUser.user.email)
+    assert jwt_decoder(user_token)["adm"] is False
+    assert create(user_token, "a@example.com").status_code == 403
+    admin_token = auth.create_access_token(FakeUser.admin.email, is_admin=True)
+    assert create(admin_token, "a@example.com").status_code == 201
+
+    # a revoked admin token is refused
+    claims = jwt_decoder(admin_token)
+    expires = datetime.utcfromtimestamp(claims["exp"])
+    crud.revoke_access_token(claims["jti"], claims["sub"], expires, db_session)
+    assert create(admin_token, "b@example.com").status_code == 401
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_current_principal(db_session: Session):
+    request = mock.Mock(state=mock.Mock(spec=[]))
+    token = auth.create_access_token(FakeUser.admin.email, is_admin=True)
+
+    principal = asyncio.run(auth.current_principal(request, token, db_session))
+    assert principal.email == FakeUser.admin.email
+    assert principal.is_admin is True
+
+    # verified once per request, later dependencies reuse the principal
+    with mock.patch("api.auth.verify_access_token") as verify:
+        assert asyncio.run(auth.current_principal(request, token, db_session)) is principal
+        verify.assert_not_called()
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_role_change(db_session: Session):
+    response = test_client.post("/token/", json=FakeUser.user.dict())
+    tokens = response.json()
+    assert jwt_decoder(tokens["access_token"])["adm"] is False
+
+    # promoting the user revokes its access tokens, the refresh picks up the role
+    crud.update_user(FakeUser.user.email, db_session, is_admin=True)
+    response = introspect(tokens["access_token"])
+    assert response.json() == {"active": False}
+    response = test_client.post(
+        "/refresh/", json={"refresh_token": tokens["refresh_token"]}
+    )
+    assert response.status_code == 200
+    assert jwt_decoder(response.json()["access_token"])["adm"] is True
@@ -0,0 +1,190 @@
+import json
+from test import test_client, test_engine
+from unittest import mock
+
+import pytest
+from api import app, bulk, crud, hashing
+from api.auth import require_admin
+from api.config import settings
+from api.exceptions import ServiceBusyException
+from api.hashing import HashPool
+from api.model import User
+from passlib.hash import pbkdf2_sha256
+from sqlalchemy import func, select
+from sqlmodel import Session
+
+from .conftest import FakeUser
+
+# only verifiable with argon2-cffi installed
+ARGON2_HASH = "$argon2id$v=19$m=65536,t=3,p=4$c2FsdHNhbHQ$aGFzaGhhc2hoYXNo"
+
+rows = [
+    {"email": "bulk1@example.com", "password": "pass1"},
+    {"email": FakeUser.user.email, "password": "taken"},
+    {"email": "not-an-email", "password": "pass"},
+    {"email": "bulk2@example.com", "password": "pass2", "is_admin": True},
+    {"email": "bulk1@example.com", "password": "again"},
+]
+
+
+def test_read_rows():
+    expected = [{"email": "a@example.com", "password": "pw"}]
+    assert bulk.read_rows(json.dumps(expected).encode(), "json") == expected
+    assert bulk.read_rows(json.dumps(expected[0]) + "\n\n", "ndjson") == expected
+    # empty cells are left out
+    csv_rows = bulk.read_rows("email,password,is_admin\na@example.com,pw,\n", "csv")
+    assert csv_rows == expected
+
+    with pytest.raises(ValueError):
+        bulk.read_rows(b'{"email": "a@example.com"}', "json")
+    with pytest.raises(ValueError):
+        bulk.read_rows(b"[", "json")
+
+
+def test_import_users(db_session: Session):
+    # cached as unknown before the import
+    assert crud.get_user("bulk1@example.com", db_session) is None
+
+    result = bulk.import_users(rows, db_session, batch_size=1, workers=2)
+    assert result.created == 2
+    assert [(c.row, c.detail) for c in result.conflicts] == [
+        (2, "Already exists"),
+        (5, "Duplicate in upload"),
+    ]
+    assert [(e.row, e.email) for e in result.errors] == [(3, "not-an-email")]
+
+    user = crud.get_user("bulk1@example.com", db_session)
+    assert settings.pwd_context.verify("pass1", user.hashed_password)
+    assert crud.get_user("bulk2@example.com", db_session).is_admin
+
+    # importing again only reports conflicts
+    result = bulk.import_users(rows[:2], db_session, workers=1)
+    assert result.created == 0
+    assert len(result.conflicts) == 2
+
+
+def test_import_hashed_passwords(db_session: Session):
+    hashed_password = pbkdf2_sha256.hash("migrated")
+    result = bulk.import_users(
+        [
+            {"email": "hashed@example.com", "hashed_password": hashed_password},
+            {"email": "unknown@example.com", "hashed_password": "$unknown$hash"},
+            {"email": "neither@example.com"},
+            {"email": "argon2@example.com", "hashed_password": ARGON2_HASH},
+        ],
+        db_session,
+        workers=1,
+    )
+    assert result.created == 1 + hashing.can_verify(ARGON2_HASH)
+    expected = [2, 3] if hashing.can_verify(ARGON2_HASH) else [2, 3, 4]
+    assert [error.row for error in result.errors] == expected
+    # stored as it is and verifiable
+    user = crud.get_user("hashed@example.com", db_session)
+    assert user.hashed_password == hashed_password
+    assert settings.pwd_context.verify("migrated", user.hashed_password)
+
+
+def test_import_race(db_session: Session):
+    # registered after the lookup: skipped by the insert, still a conflict
+    upload = [rows[0], rows[1], rows[3]]
+    with mock.patch("api.bulk.existing_emails", return_value=set()):
+        result = bulk.import_users(upload, db_session, workers=1)
+    assert result.created == 2
+    assert [(c.row, c.email, c.detail) for c in result.conflicts] == [
+        (2, FakeUser.user.email, "Already exists")
+    ]
+    assert crud.get_user(FakeUser.user.email, db_session).hashed_password != "taken"
+
+
+def test_import_hash_pool(db_session: Session):
+    pool = HashPool(workers=1, queue_depth=1)
+    result = bulk.import_users(rows[:1] + rows[3:4], db_session, hasher=pool.hash_many)
+    assert result.created == 2
+    assert pool.metrics.calls == 2
+    pool.shutdown()
+
+
+def test_export_users(db_session: Session):
+    assert "".join(bulk.export_users(db_session, "csv")) == (
+        f"id,email\n1,{FakeUser.user.email}\n2,{FakeUser.admin.email}\n"
+    )
+    lines = "".join(bulk.export_users(db_session)).splitlines()
+    assert json.loads(lines[1]) == {"id": 2, "email": FakeUser.admin.email}
+
+
+@mock.patch("api.bulk.engine", test_engine)
+def test_export_every_user(db_session: Session, tmp_path):
+    # ids start at 0, like the admin of the shipped database
+    db_session.add(User(id=0, email="zero@example.com", hashed_password="x"))
+    db_session.commit()
+    # SELECT count(*) FROM user
+    users = db_session.execute(select(func.count()).select_from(User)).scalar()
+
+    assert len("".join(bulk.export_users(db_session)).splitlines()) == users
+    export = tmp_path / "export.csv"
+    bulk.main(["export", str(export), "--format", "csv"])
+    assert len(export.read_text().splitlines()) == users + 1  # header
+
+    app.dependency_overrides[require_admin] = lambda: None
+    try:
+        response = test_client.get("/users/export/")
+    finally:
+        app.dependency_overrides.pop(require_admin)
+    assert len(response.text.splitlines()) == users
+
+
+@mock.patch("api.bulk.engine", test_engine)
+def test_cli(db_session: Session, tmp_path, capsys):
+    upload = tmp_path / "users.ndjson"
+    upload.write_text("\n".join(json.dumps(row) for row in rows[:2]))
+    bulk.main(["import", str(upload), "--workers", "1"])
+    assert json.loads(capsys.readouterr().out)["created"] == 1
+
+    export = tmp_path / "export.csv"
+    bulk.main(["export", str(export), "--format", "csv"])
+    assert export.read_text().splitlines()[-1] == "3,bulk1@example.com"
+
+
+def test_post_users_bulk(db_session: Session):
+    csv_upload = "email,password\nbulk1@example.com,pass1\nfake_user@email.com,x\n"
+    # requires authentication
+    response = test_client.post(
+        "/users/bulk/", content=csv_upload, headers={"Content-Type": "text/csv"}
+    )
+    assert response.status_code == 401
+
+    app.dependency_overrides[require_admin] = lambda: None
+    response = test_client.post(
+        "/users/bulk/", content=csv_upload, headers={"Content-Type": "text/csv"}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["created"] == 1
+    assert data["conflicts"][0]["email"] == FakeUser.user.email
+
+    # hashed on the bounded pool of the server, a full pool is a 503
+    with mock.patch("api.route.hash_pool.submit", side_effect=ServiceBusyException):
+        response = test_client.post(
+            "/users/bulk/",
+            content="email,password\nbulk3@example.com,pass3\n",
+            headers={"Content-Type": "text/csv"},
+        )
+    assert response.status_code == 503
+    assert crud.get_user("bulk3@example.com", db_session) is None
+
+    # unsupported or malformed uploads
+    response = test_client.post(
+        "/users/bulk/", content="x", headers={"Content-Type": "text/plain"}
+    )
+    assert response.status_code == 415
+    response = test_client.post(
+        "/users/bulk/", content="[", headers={"Content-Type": "application/json"}
+    )
+    assert response.status_code == 400
+
+    # export as csv
+    response = test_client.get("/users/export/?format=csv")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.text.splitlines()[-1] == "3,bulk1@example.com"
+    app.dependency_overrides.pop(require_admin)
@@ -0,0 +1,112 @@
+from unittest import mock
+
+from api.cache import MISSING, ChangeCounter, SharedGeneration, TTLCache
+
+
+def test_get_and_set():
+    cache = TTLCache(maxsize=2, ttl=60)
+    assert cache.get("a") is MISSING
+    assert cache.get("a", "default") == "default"
+    cache.set("a", 1)
+    cache.set("b", None)  # negative entries are values too
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 2, "misses": 2}
+
+
+def test_lru_eviction():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")  # b is now the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_expiry():
+    cache = TTLCache(maxsize=10, ttl=60)
+    with mock.patch("api.cache.time.monotonic", return_value=1000):
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=5)
+    with mock.patch("api.cache.time.monotonic", return_value=1010):
+        assert cache.get("a") == 1
+        assert cache.get("b") is MISSING
+    with mock.patch("api.cache.time.monotonic", return_value=1061):
+        assert cache.get("a") is MISSING
+    assert len(cache) == 0
+
+
+def test_invalidation():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    version = cache.version
+    cache.pop("a", "unknown")
+    assert cache.get("a") is MISSING
+    assert cache.get("b") == 2
+
+    # a value read before the invalidation is not stored
+    cache.set("a", "stale", version=version)
+    assert cache.get("a") is MISSING
+    cache.set("a", "fresh", version=cache.version)
+    assert cache.get("a") == "fresh"
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_disabled():
+    cache = TTLCache(maxsize=0, ttl=60)
+    cache.set("a", 1)
+    assert cache.get("a") is MISSING
+
+
+def test_shared_invalidation():
+    # two worker processes forked after the generation was created
+    generation = SharedGeneration()
+    first, second = TTLCache(maxsize=10, ttl=60), TTLCache(maxsize=10, ttl=60)
+    first.share(generation)
+    second.share(generation)
+    first.set("a", 1)
+    second.set("a", 1)
+    second.set("b", 2)
+
+    version = second.version
+    first.pop("a")
+    assert first.get("a") is MISSING
+    # any invalidation elsewhere drops every entry and the version
+    assert second.get("b") is MISSING
+    assert second.version != version
+    second.set("b", 2)
+    assert second.get("b") == 2
+
+    # catching up does not invalidate the others again
+    first.set("a", 1)
+    assert first.get("a") == 1
+    assert second.get("b") == 2
+    hits = first.hits
+    first.set("c", 3)
+    second.set("d", 4)
+    assert first.get("c") == 3 and first.hits == hits + 1
+    assert generation.value == 1
+
+
+def test_change_counter():
+    counter = ChangeCounter()
+    etag = counter.etag()
+    counter.bump()
+    assert counter.etag() != etag
+    assert counter.etag(0) == etag
+    # another server run never reuses the ETags of this one
+    assert ChangeCounter().etag(0) != etag
+
+    # workers forked after share() count together
+    generation = SharedGeneration()
+    first, second = ChangeCounter(), ChangeCounter()
+    first.share(generation)
+    second.share(generation)
+    first.bump()
+    assert second.value == first.value == 1
@@ -0,0 +1,182 @@
+import base64
+from test import introspect, mock_settings, test_client, test_engine
+from unittest import mock
+
+import pytest
+from api import clients, crud
+from api.exceptions import InvalidGrantRequestException
+from api.model import Client
+from jose import jwt
+from sqlmodel import Session
+
+
+@pytest.fixture()
+def client_session(db_session: Session):
+    with mock.patch("api.auth.settings", mock_settings), mock.patch(
+        "api.clients.settings", mock_settings
+    ):
+        yield db_session
+
+
+def register(session: Session, client_id: str = "reports", scopes: str = "a b") -> str:
+    secret = clients.new_client_secret()
+    crud.create_client(
+        Client(
+            client_id=client_id,
+            secret_hash=clients.hash_client_secret(secret),
+            scopes=scopes,
+        ),
+        session,
+    )
+    return secret
+
+
+def request_token(secret: str, client_id: str = "reports", **form) -> dict:
+    data = {"grant_type": "client_credentials", **form}
+    credentials = base64.b64encode(f"{client_id}:{secret}".encode()).decode()
+    return test_client.post(
+        "/client_token/", data=data, headers={"Authorization": f"Basic {credentials}"}
+    )
+
+
+def claims(token: str) -> dict:
+    return jwt.decode(token, mock_settings.access_token_secret, algorithms=["HS256"])
+
+
+def test_client_secret_hash(client_session: Session):
+    secret = clients.new_client_secret()
+    secret_hash = clients.hash_client_secret(secret)
+    assert clients.verify_client_secret(secret, secret_hash)
+    assert not clients.verify_client_secret(secret + "x", secret_hash)
+
+    # the pepper keys the hash, without it there is nothing to compare with
+    with mock.patch.object(mock_settings, "client_secret_pepper", "other"):
+        assert not clients.verify_client_secret(secret, secret_hash)
+    with mock.patch.object(mock_settings, "client_secret_pepper", None):
+        with pytest.raises(RuntimeError):
+            clients.hash_client_secret(secret)
+
+
+def test_scopes():
+    assert clients.normalize_scope(" b a b ") == "a b"
+    assert clients.normalize_scope("  ") is None
+    assert clients.granted_scope(None, "b a") == "a b"
+    assert clients.granted_scope("a", "a b") == "a"
+    with pytest.raises(InvalidGrantRequestException):
+        clients.granted_scope("c", "a b")
+
+    with pytest.raises(ValueError):
+        clients.validate_client_id("service@example.com")
+
+
+def test_client_token(client_session: Session):
+    secret = register(client_session)
+
+    response = request_token(secret, scope="b a")
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "no-store"
+    body = response.json()
+    assert body["token_type"] == "bearer"
+    assert body["scope"] == "a b"
+    assert 0 < body["expires_in"] <= mock_settings.client_token_expiry * 60
+    token_claims = claims(body["access_token"])
+    assert token_claims["sub"] == token_claims["client_id"] == "reports"
+    assert token_claims["adm"] is False
+
+    # the same client and scope get the cached token, no database or signing
+    with mock.patch("api.clients.crud.get_client") as get_client:
+        response = request_token(secret, scope="a b")
+        get_client.assert_not_called()
+    assert response.json()["access_token"] == body["access_token"]
+
+    # credentials as form fields, another scope is another token
+    response = test_client.post(
+        "/client_token/",
+        data={
+            "grant_type": "client_credentials",
+            "client_id": "reports",
+            "client_secret": secret,
+            "scope": "a",
+        },
+    )
+    assert response.status_code == 200
+    assert response.json()["access_token"] != body["access_token"]
+
+    # the token is active and carries its scope, but is no admin
+    response = introspect(body["access_token"])
+    assert response.json()["scope"] == "a b"
+    # a resource server asks with a token of its own
+    resource_secret = register(client_session, "resource", "introspect")
+    caller = request_token(resource_secret, client_id="resource").json()["access_token"]
+    response = introspect(body["access_token"], caller=caller)
+    assert response.json()["client_id"] == "reports"
+    response = test_client.post(
+        "/user/",
+        json={"email": "a@example.com", "password": "x"},
+        headers={"Authorization": f"Bearer {body['access_token']}"},
+    )
+    assert response.status_code == 403
+
+
+def test_client_token_errors(client_session: Session):
+    secret = register(client_session)
+    assert request_token(secret + "x").status_code == 401
+    assert request_token(secret, client_id="unknown").status_code == 401
+    response = request_token(secret, scope="c")
+    assert response.status_code == 400
+    assert response.json() == {"detail": "invalid_scope"}
+    response = test_client.post(
+        "/client_token/", data={"grant_type": "password", "client_id": "reports"}
+    )
+    assert response.json() == {"detail": "unsupported_grant_type"}
+    response = test_client.post("/client_token/", data={"grant_type": "client_credentials"})
+    assert response.status_code == 401
+
+    # a cached token is not served for a wrong secret
+    request_token(secret)
+    assert request_token(secret + "x").status_code == 401
+
+
+def test_rotate_and_delete_client(client_session: Session):
+    secret = register(client_session)
+    token = request_token(secret).json()["access_token"]
+
+    # rotating the secret revokes the cached token and the old secret
+    new_secret = clients.new_client_secret()
+    assert crud.update_client_secret(
+        "reports", clients.hash_client_secret(new_secret), client_session
+    )
+    assert request_token(secret).status_code == 401
+    response = introspect(token)
+    assert response.json() == {"active": False}
+    assert request_token(new_secret).json()["access_token"] != token
+
+    assert crud.delete_client("reports", client_session)
+    assert request_token(new_secret).status_code == 401
+    assert not crud.delete_client("reports", client_session)
+
+
+def test_clients_cli(client_session: Session, capsys):
+    with mock.patch("api.db.engine", test_engine):
+        clients.main(["create", "billing", "--scope", "users:read"])
+        secret = capsys.readouterr().out.strip()
+        clients.main(["list"])
+        assert capsys.readouterr().out == "billing\tusers:read\n"
+        with pytest.raises(SystemExit):
+            clients.main(["create", "billing"])
+        clients.main(["rotate", "billing"])
+        new_secret = capsys.readouterr().out.strip()
+        clients.main(["delete", "billing"])
+        with pytest.raises(SystemExit):
+            clients.main(["delete", "billing"])
+
+    assert secret != new_secret
+    assert crud.get_clients(client_session) == []
+
+
+def test_clients_cli_without_pepper(client_session: Session):
+    with mock.patch.object(clients.settings, "client_secret_pepper", None):
+        for command in (["create", "billing"], ["rotate", "billing"]):
+            with pytest.raises(SystemExit, match="CLIENT_SECRET_PEPPER is not set"):
+                clients.main(command)
+    assert crud.get_clients(client_session) == []
@@ -4,9 +4,12 @@ So temporarily created data can be properly removed (by the tests) before
 starting the next testing file
 """
 
+from datetime import datetime, timedelta
+
 import pytest
 from sqlmodel import Session
 from api import crud
+from api.model import RefreshTokenFamily
 from sqlalchemy.exc import IntegrityError
 from api.config import settings
 
@@ -23,6 +26,37 @@ def test_crud_get_single_user(db_session: Session):
     assert user_notexist is None
 
 
+def test_crud_email_case_insensitive(db_session: Session):
+    user = crud.get_user(" " + FakeUser.user.email.upper(), db_session)
+    assert user.email == FakeUser.user.email
+    # the same address in other case is already registered
+    with pytest.raises(IntegrityError):
+        crud.create_user(
+            FakeUser.user.copy(update={"email": FakeUser.user.email.title()}), db_session
+        )
+    db_session.rollback()
+
+
+def test_crud_user_cache(db_session: Session):
+    user = crud.get_user(FakeUser.user.email, db_session)
+    hits = crud.user_cache.hits
+    # served from the cache as a detached copy
+    assert crud.get_user(FakeUser.user.email, db_session) == user
+    assert crud.user_cache.hits == hits + 1
+
+    # unknown emails are cached too, until the user is created
+    assert crud.get_user(FakeUser.new.email, db_session) is None
+    assert crud.user_cache.get(FakeUser.new.email) is None
+    crud.create_user(FakeUser.new, db_session)
+    assert crud.get_user(FakeUser.new.email, db_session).email == FakeUser.new.email
+
+    # writes invalidate the cached user
+    crud.update_user(FakeUser.new.email, db_session, is_admin=1)
+    assert crud.get_user(FakeUser.new.email, db_session).is_admin
+    crud.delete_user(FakeUser.new.email, db_session)
+    assert crud.get_user(FakeUser.new.email, db_session) is None
+
+
 def test_crud_get_all_users(db_session: Session):
     users = crud.get_all_users(db_session)
     assert users is not None
@@ -30,6 +64,19 @@ def test_crud_get_all_users(db_session: Session):
     assert users[1].email == FakeUser.admin.email
 
 
+def test_crud_get_users_page(db_session: Session):
+    page = crud.get_users_page(db_session, after=0, limit=1)
+    assert [tuple(row) for row in page] == [(1, FakeUser.user.email)]
+    page = crud.get_users_page(db_session, after=1, limit=10)
+    assert [tuple(row) for row in page] == [(2, FakeUser.admin.email)]
+
+    chunks = list(crud.iter_users(db_session, chunk_size=1))
+    assert [[tuple(row) for row in rows] for rows in chunks] == [
+        [(1, FakeUser.user.email)],
+        [(2, FakeUser.admin.email)],
+    ]
+
+
 def test_crud_create_user(db_session: Session):
     # create new user
     user_created = crud.create_user(FakeUser.new, db_session)
@@ -79,7 +126,44 @@ def test_update_user(db_session: Session):
 
 def test_crud_delete_user(db_session: Session):
     # delete user and get_user to check
-    crud.delete_user(FakeUser.new.email, db_session)
+    crud.create_user(FakeUser.new, db_session)
+    assert crud.delete_user(FakeUser.new.email.upper(), db_session)
     user_deleted = crud.get_user(FakeUser.new.email, db_session)
 
     assert user_deleted is None
+    # nothing to delete
+    assert not crud.delete_user(FakeUser.new.email, db_session)
+
+
+def test_token_family(db_session: Session):
+    expires = datetime.utcnow() + timedelta(minutes=5)
+    family = RefreshTokenFamily(
+        id="family", email=FakeUser.user.email, jti="first", expires=expires
+    )
+    crud.create_token_family(family, db_session)
+
+    # only the current token rotates
+    assert crud.rotate_token_family("family", "first", "second", expires, db_session)
+    assert not crud.rotate_token_family("family", "first", "third", expires, db_session)
+    assert crud.get_token_family("family", db_session).jti == "second"
+
+    # a password change revokes the logins of the user
+    crud.update_user(FakeUser.user.email, db_session, hashed_password="changed")
+    assert crud.get_token_family("family", db_session).revoked
+    assert not crud.rotate_token_family("family", "second", "third", expires, db_session)
+
+    # expired families do not rotate either
+    crud.create_token_family(
+        RefreshTokenFamily(
+            id="expired",
+            email=FakeUser.user.email,
+            jti="first",
+            expires=datetime.utcnow() - timedelta(minutes=1),
+        ),
+        db_session,
+    )
+    assert not crud.rotate_token_family("expired", "first", "second", expires, db_session)
+
+    # deleting the user revokes its families
+    crud.delete_user(FakeUser.user.email, db_session)
+    assert crud.get_token_family("expired", db_session).revoked
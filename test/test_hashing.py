@@ -0,0 +1,56 @@
+import asyncio
+import threading
+
+import pytest
+from api.config import settings
+from api.exceptions import ServiceBusyException
+from api.hashing import HashPool
+
+
+def test_hash_and_verify():
+    pool = HashPool(workers=2, queue_depth=2)
+    hashed = pool.hash_sync("secret")
+    assert settings.pwd_context.verify("secret", hashed)
+    assert pool.verify_sync("secret", hashed)
+    assert not asyncio.run(pool.verify("wrong", hashed))
+    assert settings.pwd_context.verify("other", asyncio.run(pool.hash("other")))
+    # waits for the bookkeeping callbacks as well as the jobs
+    pool.shutdown()
+
+    # every finished job is recorded
+    assert pool.metrics.calls == 4
+    assert pool.metrics.hash_seconds > 0
+    assert pool.metrics.hash_seconds_max <= pool.metrics.hash_seconds
+    assert pool.pending == 0
+
+
+def test_process_pool():
+    pool = HashPool(kind="process", workers=1, queue_depth=1)
+    hashed = pool.hash_sync("secret")
+    assert pool.verify_sync("secret", hashed)
+    pool.shutdown()
+    assert pool.metrics.calls == 2
+
+
+def test_unknown_pool_kind():
+    with pytest.raises(ValueError):
+        HashPool(kind="fibre")
+
+
+def test_saturated_pool():
+    pool = HashPool(workers=1, queue_depth=1)
+    release = threading.Event()
+    # one job running and one queued fills the pool
+    running = pool.submit(release.wait)
+    queued = pool.submit(release.wait)
+    with pytest.raises(ServiceBusyException) as excinfo:
+        pool.hash_sync("secret")
+    assert excinfo.value.status_code == 503
+    assert pool.metrics.rejected == 1
+
+    release.set()
+    pool.shutdown()
+    assert running.done() and queued.done()
+    # capacity is back once the jobs finish
+    assert pool.verify_sync("secret", pool.hash_sync("secret"))
+    pool.shutdown()
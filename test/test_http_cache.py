@@ -0,0 +1,82 @@
+from test import test_client
+from unittest import mock
+
+from api import crud, http_cache
+from api.http_cache import etag_matches
+from api.model import User
+from sqlmodel import Session
+
+from .conftest import FakeUser
+
+
+def test_etag_matches():
+    assert etag_matches('"a-1"', '"a-1"')
+    assert etag_matches('"a-0", W/"a-1"', '"a-1"')
+    assert etag_matches("*", '"a-1"')
+    assert not etag_matches('"a-0"', '"a-1"')
+    assert not etag_matches(None, '"a-1"')
+
+
+def test_get_users_not_modified(db_session: Session):
+    response = test_client.get("/users/")
+    etag = response.headers["etag"]
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "no-cache"
+
+    # unchanged, answered from the ETag alone
+    response = test_client.get("/users/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+    # the serialized page is reused without asking for the ETag
+    hits = http_cache.page_cache.hits
+    assert len(test_client.get("/users/").json()) == 2
+    assert http_cache.page_cache.hits == hits + 1
+
+    # a write changes the ETag and the page
+    crud.create_user(FakeUser.new, db_session)
+    response = test_client.get("/users/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert [user["email"] for user in response.json()][-1] == FakeUser.new.email
+
+
+def test_etag_expires(db_session: Session):
+    with mock.patch("api.http_cache.time.time", return_value=1020):
+        etag = test_client.get("/users/").headers["etag"]
+    # a write elsewhere is not counted
+    with Session(db_session.get_bind()) as session:
+        session.add(User(email="elsewhere@example.com", hashed_password="x"))
+        session.commit()
+    with mock.patch("api.http_cache.time.time", return_value=1049):
+        response = test_client.get("/users/", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+    # but shows once the period is over
+    with mock.patch("api.http_cache.time.time", return_value=1050):
+        response = test_client.get("/users/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()[-1]["email"] == "elsewhere@example.com"
+
+
+def test_get_users_link_cached(db_session: Session):
+    first = test_client.get("/users/?limit=1")
+    second = test_client.get("/users/?limit=1")
+    assert first.headers["link"] == second.headers["link"]
+    assert second.headers["link"] == '</users/?after=1&limit=1>; rel="next"'
+
+
+def test_get_user_not_modified(db_session: Session):
+    response = test_client.get(f"/user/?email={FakeUser.user.email}")
+    etag = response.headers["etag"]
+    response = test_client.get(
+        f"/user/?email={FakeUser.user.email}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+    crud.update_user(FakeUser.user.email, db_session, is_admin=True)
+    response = test_client.get(
+        f"/user/?email={FakeUser.user.email}", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.json()["email"] == FakeUser.user.email
@@ -0,0 +1,171 @@
+import json
+import time
+from test import mock_settings, test_client
+from unittest import mock
+
+import pytest
+from api import auth
+from api.config import Settings
+from api.keys import KeyManager, SigningKey, jwk_thumbprint
+from jose import jwt
+from jose.exceptions import JWKError, JWTError
+from pydantic import ValidationError
+
+rsa_settings = mock_settings.copy(update={"jwt_algorithm": "RS256"})
+
+
+def test_jwk_thumbprint():
+    # example key of RFC 7638 section 3.1
+    public_jwk = {
+        "kty": "RSA",
+        "n": "0vx7agoebGcQSuuPiLJXZptN9nndrQmbXEps2aiAFbWhM78LhWx4cbbfAAtVT86zwu1RK7aPFFxuhDR1L6tSoc_BJECPebWKRXjBZCiFV4n3oknjhMstn64tZ_2W-5JsGY4Hc5n9yBXArwl93lqt7_RN5w6Cf0h4QyQ5v-65YGjQR0_FDW2QvzqY368QQMicAtaSqzs8KJZgnYb9c7d0zgdAZHzu6qMQvRL5hajrn1n91CbOpbISD08qNLyrdkt-bFTWhAI4vMQFh6WeZu0fM4lFd2NcRwr3XPksINHaQ-G_xBniIqbw0Ls1jF44-csFCur-kEgU8awapJzKnqDKgw",
+        "e": "AQAB",
+        "alg": "RS256",
+    }
+    assert jwk_thumbprint(public_jwk) == "NzbLsXh8uDCcd-6MNwXF4W_7noWXFZAfHkxZsRGC9Xs"
+
+
+@pytest.mark.parametrize("algorithm", ["RS256", "ES256"])
+def test_sign_and_verify(algorithm):
+    manager = KeyManager(algorithm)
+    key = manager.signing_key()
+    assert manager.signing_key() is key
+    token = jwt.encode({"sub": "me"}, key.signer, algorithm, headers={"kid": key.kid})
+    assert jwt.get_unverified_header(token)["kid"] == key.kid
+    verifier = manager.verification_key(key.kid).verifier
+    assert jwt.decode(token, verifier, algorithms=[algorithm])["sub"] == "me"
+
+    with pytest.raises(JWKError):
+        manager.verification_key("unknown")
+    with pytest.raises(ValueError):
+        KeyManager("EdDSA")
+
+
+def test_unsupported_jwt_algorithm():
+    # refused with the settings, not by the first login
+    with pytest.raises(ValidationError):
+        Settings(jwt_algorithm="HS512")
+
+
+def test_rotation_and_overlap(tmp_path):
+    manager = KeyManager(
+        "ES256", key_dir=str(tmp_path), rotation=60, overlap=30, publish_ahead=10
+    )
+    now = time.time()
+    first = manager.signing_key()
+    assert (tmp_path / f"{first.kid}.pem").exists()
+
+    def published():
+        return [key["kid"] for key in json.loads(manager.jwks())["keys"]]
+
+    # the successor is published ahead of its first token
+    with mock.patch("api.keys.time.time", return_value=now + 51):
+        assert manager.signing_key().kid == first.kid
+        assert len(published()) == 2
+        second = manager._keys[-1]
+    assert second.created == pytest.approx(now + 61)
+    with mock.patch("api.keys.time.time", return_value=now + 60):
+        assert manager.signing_key().kid == first.kid
+    # and signs once the cached JWKS of resource servers have expired
+    with mock.patch("api.keys.time.time", return_value=now + 61):
+        assert manager.signing_key().kid == second.kid
+        assert published() == [first.kid, second.kid]
+
+    # another manager on the same directory loads both keys
+    loaded = KeyManager("ES256", key_dir=str(tmp_path), rotation=60, overlap=30)
+    assert loaded.verification_key(first.kid).public_jwk == first.public_jwk
+    assert loaded.verification_key(second.kid).created == second.created
+
+    # the replaced key is retired once the overlap window has passed
+    with mock.patch("api.keys.time.time", return_value=now + 61 + 31):
+        assert published() == [second.kid]
+    assert not (tmp_path / f"{first.kid}.pem").exists()
+
+
+def test_rotate_publishes_first():
+    manager = KeyManager("RS256", publish_ahead=300)
+    # nothing was published before the first key, it signs right away
+    first = manager.rotate()
+    assert manager.signing_key() is first
+    second = manager.rotate()
+    assert manager.signing_key() is first
+    assert second.created >= first.created + 300
+
+
+def test_signing_key_from_pem():
+    key = SigningKey.generate("RS256")
+    loaded = SigningKey.from_pem(key.private_pem, key.created)
+    assert loaded.kid == key.kid
+    assert loaded.public_jwk["use"] == "sig"
+    assert "d" not in loaded.public_jwk  # no private members are published
+
+
+@mock.patch("api.auth.settings", rsa_settings)
+@mock.patch("api.auth.key_manager", KeyManager("RS256"))
+def test_asymmetric_access_token():
+    auth.claims_cache.clear()
+    token = auth.create_access_token("me@example.com")
+    assert jwt.get_unverified_header(token)["alg"] == "RS256"
+    assert auth.decode_access_token(token)["sub"] == "me@example.com"
+
+    # verifiable offline with the published JWKS
+    response = test_client.get("/.well-known/jwks.json")
+    assert response.status_code == 200
+    claims = jwt.decode(token, response.json(), algorithms=["RS256"])
+    assert claims["sub"] == "me@example.com"
+
+    # HS256 tokens or unknown keys are refused
+    with pytest.raises(JWTError):
+        auth.decode_access_token(
+            auth.create_jwt_token("me@example.com", mock_settings.access_token_secret)
+        )
+    other = KeyManager("RS256").signing_key()
+    with pytest.raises(JWTError):
+        auth.decode_access_token(
+            auth.create_jwt_token(
+                "me@example.com",
+                other.signer,
+                algorithm="RS256",
+                headers={"kid": other.kid},
+            )
+        )
+
+
+@mock.patch("api.auth.key_manager", KeyManager("ES256"))
+def test_get_jwks():
+    response = test_client.get("/.well-known/jwks.json")
+    assert response.status_code == 200
+    assert response.json() == {"keys": []}
+    assert response.headers["cache-control"].startswith("public, max-age=")
+
+    auth.key_manager.signing_key()
+    response = test_client.get("/.well-known/jwks.json")
+    etag = response.headers["etag"]
+    assert [key["alg"] for key in response.json()["keys"]] == ["ES256"]
+
+    # unchanged key set
+    response = test_client.get(
+        "/.well-known/jwks.json", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+
+def test_shared_key_dir(tmp_path):
+    # two worker processes with the same key directory
+    options = {"key_dir": str(tmp_path), "rotation": 60, "overlap": 30, "publish_ahead": 10}
+    first, second = KeyManager("ES256", **options), KeyManager("ES256", **options)
+    key = first.signing_key()
+    assert second.signing_key().kid == key.kid
+
+    # a rotation by one worker is picked up instead of rotating again
+    now = time.time()
+    with mock.patch("api.keys.time.time", return_value=now + 51):
+        first.signing_key()
+        second.signing_key()
+    with mock.patch("api.keys.time.time", return_value=now + 61):
+        rotated = first.signing_key()
+        assert rotated.kid != key.kid
+        assert second.signing_key().kid == rotated.kid
+    assert second.verification_key(rotated.kid).public_jwk == rotated.public_jwk
+    assert len(list(tmp_path.glob("*.pem"))) == 2
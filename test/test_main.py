@@ -1,7 +1,32 @@
+import os
+import subprocess
+import sys
 from test import test_client
 
+from api.config import LazySettings, Settings
+
 
 def test_root():
     response = test_client.get("/")
     assert response.status_code == 200
     assert "<!DOCTYPE html>" in response.text
+
+
+def test_import_has_no_side_effects(tmp_path):
+    # a fresh interpreter, the test session has long imported everything
+    code = (
+        "import sys, api, api.config\n"
+        "assert api.config.settings._settings is None\n"
+        "assert 'fastapi' not in sys.modules and 'api.db' not in sys.modules\n"
+    )
+    env = {**os.environ, "DATABASE": str(tmp_path / "untouched.db")}
+    subprocess.run([sys.executable, "-c", code], check=True, env=env)
+    assert not (tmp_path / "untouched.db").exists()
+
+
+def test_lazy_settings():
+    settings = LazySettings(lambda: Settings(password_scheme="pbkdf2_sha256"))
+    assert settings._settings is None
+    assert settings.pwd_context.identify(settings.pwd_context.hash("pw")) == "pbkdf2_sha256"
+    settings.app_name = "changed"
+    assert settings.load().app_name == "changed"
@@ -0,0 +1,197 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+from api import crud, maintenance
+from api.cache import MISSING
+from api.config import settings
+from api.http_cache import user_table_version
+from api.db import create_sqlite_engine
+from api.migrate import migrate
+from api.model import RefreshTokenFamily, RevokedToken, User
+from sqlalchemy import func, insert
+from sqlmodel import Session, select
+
+
+@pytest.fixture()
+def engine(tmp_path):
+    engine = create_sqlite_engine(str(tmp_path / "maintenance.db"))
+    migrate(engine)
+    yield engine
+    engine.dispose()
+
+
+def pragma(engine, name: str):
+    with engine.connect() as connection:
+        return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+
+def seed(engine, rows: int):
+    now = datetime.utcnow()
+    with Session(engine) as session:
+        session.execute(
+            insert(User),
+            [
+                {"email": f"user{i}@example.com", "hashed_password": "x", "refresh_token": "old"}
+                for i in range(rows)
+            ],
+        )
+        session.execute(
+            insert(RefreshTokenFamily),
+            [
+                {
+                    "id": f"family{i}",
+                    "email": f"user{i}@example.com",
+                    "jti": "0",
+                    # every other family has expired
+                    "expires": now + timedelta(days=1 if i % 2 else -1),
+                }
+                for i in range(rows)
+            ],
+        )
+        session.add(RevokedToken(jti="expired", email="a@b.com", expires=now))
+        session.commit()
+
+
+def count(engine, statement) -> int:
+    with Session(engine) as session:
+        return session.execute(statement).scalar()
+
+
+def test_new_database_auto_vacuum(engine):
+    assert pragma(engine, "auto_vacuum") == 2  # incremental
+    assert pragma(engine, "journal_mode") == "wal"
+
+
+def test_prune(engine):
+    seed(engine, 10)
+    with mock.patch.object(settings, "maintenance_batch_size", 3):
+        # out of budget right away, only the revocations go
+        assert maintenance.prune(engine, time.monotonic()) == (1, False)
+        assert maintenance.prune(engine, time.monotonic() + 60) == (15, True)
+
+    families = select(func.count()).select_from(RefreshTokenFamily)
+    assert count(engine, families) == 5
+    stale = select(func.count()).where(User.refresh_token.is_not(None))
+    assert count(engine, stale) == 0
+    assert maintenance.prune(engine, time.monotonic() + 60) == (0, True)
+    # every batch gave its connection back
+    assert engine.pool.checkedout() == 0
+
+
+def test_prune_forgets_users(engine):
+    seed(engine, 2)
+    with Session(engine) as session:
+        cached = session.exec(select(User).where(User.email == "user0@example.com")).one()
+        crud.cache_user(cached.email, cached, crud.user_cache.version)
+    assert crud.user_cache.get("user0@example.com").refresh_token == "old"
+    _, etag = user_table_version()
+
+    maintenance.prune(engine, time.monotonic() + 60)
+    # cached rows and ETags do not keep the cleared refresh token
+    assert crud.user_cache.get("user0@example.com") is MISSING
+    assert user_table_version()[1] != etag
+
+
+def test_sqlite_jobs(engine):
+    seed(engine, 2000)
+    with Session(engine) as session:
+        session.execute(RefreshTokenFamily.__table__.delete())
+        session.commit()
+    deadline = time.monotonic() + 60
+
+    assert maintenance.checkpoint(engine, deadline)[1]
+    assert maintenance.optimize(engine, deadline) == (0, True)
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT count(*) FROM sqlite_stat1").scalar()
+
+    assert pragma(engine, "freelist_count") > 0
+    with mock.patch.object(settings, "maintenance_batch_size", 2):
+        # a page at a time until the budget is gone
+        done, finished = maintenance.vacuum(engine, time.monotonic())
+        assert (done, finished) == (0, False)
+    done, finished = maintenance.vacuum(engine, deadline)
+    assert finished and done > 0
+    assert pragma(engine, "freelist_count") == 0
+
+
+def test_quiet_hours():
+    assert maintenance.parse_hours("") is None
+    assert maintenance.in_hours(None, 12)
+    window = maintenance.parse_hours("2-5")
+    assert [hour for hour in range(24) if maintenance.in_hours(window, hour)] == [2, 3, 4]
+    window = maintenance.parse_hours("22-2")
+    assert [hour for hour in range(24) if maintenance.in_hours(window, hour)] == [0, 1, 22, 23]
+
+
+def test_scheduler(engine):
+    runs = []
+
+    def job(name: str, finished: bool = True):
+        def run(engine, deadline):
+            runs.append(name)
+            if name == "broken":
+                raise RuntimeError("broken")
+            return 2, finished
+
+        return run
+
+    jobs = [
+        maintenance.Job("often", job("often"), interval=0, next_run=-1),
+        maintenance.Job("later", job("later"), interval=3600),
+        maintenance.Job("quiet", job("quiet"), interval=0, quiet=True, next_run=-1),
+        maintenance.Job("partial", job("partial", False), interval=3600, next_run=-1),
+        maintenance.Job("broken", job("broken"), interval=3600, next_run=-1),
+    ]
+    scheduler = maintenance.Scheduler(engine, jobs, tick=0.01)
+
+    # busy: the quiet job waits
+    with mock.patch.object(settings, "maintenance_quiet_rps", -1):
+        asyncio.run(scheduler.run_pending())
+    assert runs == ["often", "partial", "broken"]
+    # a partial job goes on at the next tick, the others wait for their interval
+    assert jobs[3].next_run < time.monotonic() + 1
+    assert jobs[4].next_run > time.monotonic() + 3000
+
+    runs.clear()
+    time.sleep(0.02)
+    asyncio.run(scheduler.run_pending())
+    assert runs == ["often", "quiet", "partial"]
+
+    def samples(job):
+        return maintenance.JOB_SECONDS.count(job=job), maintenance.JOB_ITEMS.value(job=job)
+
+    assert samples("often") == (2, 4)
+    assert maintenance.JOB_RUNS.value(job="partial", result="partial") >= 2
+    assert maintenance.JOB_RUNS.value(job="broken", result="error") >= 1
+
+
+def test_scheduler_start_stop(engine):
+    jobs = [maintenance.Job("prune", maintenance.prune, interval=3600, next_run=-1)]
+
+    async def serve():
+        scheduler = maintenance.Scheduler(engine, jobs, tick=0.01)
+        scheduler.start()
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+
+    before = maintenance.JOB_RUNS.value(job="prune", result="done")
+    asyncio.run(serve())
+    assert maintenance.JOB_RUNS.value(job="prune", result="done") == before + 1
+
+
+def test_leader_lock(tmp_path):
+    path = str(tmp_path / "user.db.maintenance")
+    leader, follower = maintenance.LeaderLock(path), maintenance.LeaderLock(path)
+    assert leader.acquire()
+    assert not follower.acquire()
+    leader.release()
+    assert follower.acquire()
+    follower.release()
+
+    # sqlite files get a lock, other databases run the jobs everywhere
+    scheduler = maintenance.build_scheduler(create_sqlite_engine(str(tmp_path / "x.db")))
+    assert scheduler.lock.path == str(tmp_path / "x.db.maintenance")
+    assert [job.name for job in scheduler.jobs] == ["prune", "checkpoint", "optimize", "vacuum"]
@@ -0,0 +1,73 @@
+from test import test_client
+
+import pytest
+from api.metrics import PHASE_SECONDS, REQUESTS, Counter, Histogram, instrument_engine, registry
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlmodel import create_engine
+
+
+def test_counter_render():
+    counter = Counter("logins_total", "Logins", ["result"])
+    counter.inc(result="ok")
+    counter.inc(2, result="ok")
+    counter.inc(result='bad "quote"')
+    assert counter.render() == [
+        "# HELP logins_total Logins",
+        "# TYPE logins_total counter",
+        'logins_total{result="ok"} 3',
+        'logins_total{result="bad \\"quote\\""} 1',
+    ]
+
+
+def test_histogram_buckets():
+    histogram = Histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0):
+        histogram.observe(value)
+    assert histogram.count() == 4
+    assert histogram.sum() == 4.05
+    assert histogram.render()[2:] == [
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_count 4",
+        "latency_seconds_sum 4.05",
+    ]
+
+
+def test_engine_statements_timed():
+    engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=QueuePool
+    )
+    instrument_engine(engine, "metrics_test")
+    before = PHASE_SECONDS.count(phase="db")
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        connection.execute(text("SELECT 2"))
+    assert PHASE_SECONDS.count(phase="db") == before + 2
+
+    # failed statements are timed as well and leave nothing on the connection
+    with engine.connect() as connection:
+        for _ in range(3):
+            with pytest.raises(OperationalError):
+                connection.execute(text("SELECT * FROM missing"))
+        connection.execute(text("SELECT 3"))
+        assert "query_started" not in connection.connection.info
+    assert PHASE_SECONDS.count(phase="db") == before + 6
+    assert 'db_pool_connections{engine="metrics_test",state="checked_out"} 0' in registry.render()
+
+
+def test_metrics_endpoint(db_session):
+    before = REQUESTS.value(method="GET", route="/user/", status=200)
+    test_client.get("/user/", params={"email": "fake_user@email.com"})
+    test_client.get("/no/such/path/")
+    assert REQUESTS.value(method="GET", route="/user/", status=200) == before + 1
+    assert REQUESTS.value(method="GET", route="unmatched", status=404) >= 1
+
+    response = test_client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'http_request_duration_seconds_count{method="GET",route="/user/"}' in response.text
+    assert 'cache_lookups_total{cache="user",result="miss"}' in response.text
+    assert 'hash_pool_jobs{state="workers"}' in response.text
@@ -0,0 +1,129 @@
+from datetime import datetime
+
+import pytest
+from api import crud
+from api.db import create_sqlite_engine
+from api.migrate import MigrationError, initial_schema, main, migrate, migrations
+from sqlalchemy import inspect, text
+from sqlalchemy.dialects.sqlite import dialect as SQLiteDialect
+from sqlmodel import SQLModel
+
+sqlite_dialect = SQLiteDialect()
+
+
+@pytest.fixture()
+def engine(tmp_path):
+    return create_sqlite_engine(str(tmp_path / "new.db"))
+
+
+def test_migrate(tmp_path):
+    database = str(tmp_path / "new.db")
+    main(["--database", database])
+    tables = inspect(create_sqlite_engine(database)).get_table_names()
+    assert {"user", "refreshtokenfamily", "schema_migration"} <= set(tables)
+    # running it again is harmless
+    main(["--database", database])
+
+
+def test_migrate_records_versions(engine):
+    assert migrate(engine) == sorted(migrations)
+    assert migrate(engine) == []
+    with engine.connect() as connection:
+        versions = connection.execute(text("SELECT version FROM schema_migration"))
+        assert sorted(versions.scalars()) == sorted(migrations)
+
+
+def schema(engine) -> dict:
+    with engine.connect() as connection:
+        return {
+            (kind, name, table): {
+                row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info('{name}')")
+            }
+            for kind, name, table in connection.exec_driver_sql(
+                "SELECT type, name, tbl_name FROM sqlite_master "
+                "WHERE name NOT IN ('schema_migration', 'sqlite_sequence')"
+            )
+        }
+
+
+def test_migrate_matches_models(engine, tmp_path):
+    # version 1 is frozen, later migrations bring it up to the models
+    with engine.begin() as connection:
+        initial_schema(connection)
+    assert ("index", "ix_user_email_lower", "user") not in schema(engine)
+    migrate(engine)
+    created = create_sqlite_engine(str(tmp_path / "created.db"))
+    SQLModel.metadata.create_all(created)
+    assert schema(engine) == schema(created)
+
+
+def test_migrate_unversioned_database(engine):
+    # a database created before migrations were versioned, without the new indexes
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE TABLE user (id INTEGER PRIMARY KEY, email VARCHAR UNIQUE, "
+                "hashed_password VARCHAR, refresh_token VARCHAR, is_admin BOOLEAN)"
+            )
+        )
+        connection.execute(text("INSERT INTO user (email) VALUES ('Someone@Mail.com')"))
+    migrate(engine)
+    with engine.connect() as connection:
+        indexes = connection.execute(
+            text("SELECT name FROM sqlite_master WHERE type = 'index'")
+        ).scalars()
+        assert {"ix_user_email_lower", "ix_refreshtokenfamily_expires"} <= set(indexes)
+
+
+def test_migrate_case_duplicates(engine):
+    migrate(engine)
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_user_email_lower"))
+        connection.execute(text("DELETE FROM schema_migration WHERE version >= 2"))
+        connection.execute(
+            text(
+                "INSERT INTO user (email, hashed_password, is_admin) "
+                "VALUES ('a@b.com', '', 0), ('A@b.com', '', 0)"
+            )
+        )
+    with pytest.raises(MigrationError, match="a@b.com"):
+        migrate(engine)
+
+
+def query_plan(engine, statement) -> str:
+    compiled = statement.compile(dialect=engine.dialect)
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params)
+        return "\n".join(row[-1] for row in rows)
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        crud.user_by_email("Fake_User@Email.com"),
+        crud.user_page(after=10, limit=100),
+        crud.password_upgrade("fake_user@email.com", "old hash", "new hash"),
+        crud.user_update("Fake_User@Email.com", {"is_admin": True}, sqlite_dialect),
+        crud.user_deletion("Fake_User@Email.com"),
+        crud.token_rotation("family", "jti", "new jti", datetime.utcnow()),
+        crud.token_family_revocation(email="fake_user@email.com"),
+        crud.token_family_revocation(family_id="family"),
+        crud.expired_token_families(500),
+    ],
+    ids=[
+        "user_by_email",
+        "user_page",
+        "password_upgrade",
+        "user_update",
+        "user_deletion",
+        "token_rotation",
+        "revoke_user_families",
+        "revoke_family",
+        "prune_families",
+    ],
+)
+def test_hot_queries_use_indexes(engine, statement):
+    migrate(engine)
+    plan = query_plan(engine, statement)
+    assert "SCAN" not in plan, plan
@@ -0,0 +1,72 @@
+"""
+Runs test_crud.py and test_route.py once more against PostgreSQL, with
+TEST_POSTGRES_URL or a throwaway cluster started with initdb/pg_ctl from PATH.
+Skipped when neither is available.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+MATRIX = ["test/test_crud.py", "test/test_route.py"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def postgres_url(tmp_path_factory):
+    pytest.importorskip("psycopg2")
+    if url := os.environ.get("TEST_POSTGRES_URL"):
+        yield url
+        return
+    if not (shutil.which("initdb") and shutil.which("pg_ctl")):
+        pytest.skip("PostgreSQL is not installed, set TEST_POSTGRES_URL to use a server")
+
+    data = tmp_path_factory.mktemp("postgres")
+    port = free_port()
+    subprocess.run(
+        ["initdb", "-D", str(data / "db"), "-U", "postgres", "--auth=trust"],
+        check=True,
+        capture_output=True,
+    )
+    subprocess.run(
+        [
+            "pg_ctl",
+            "start",
+            "--wait",
+            "-D",
+            str(data / "db"),
+            "-l",
+            str(data / "server.log"),
+            "-o",
+            f"-h 127.0.0.1 -p {port} -k {data}",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    try:
+        yield f"postgresql://postgres@127.0.0.1:{port}/postgres"
+    finally:
+        subprocess.run(
+            ["pg_ctl", "stop", "-D", str(data / "db"), "-m", "fast"], capture_output=True
+        )
+
+
+def test_postgres_matrix(postgres_url):
+    root = Path(__file__).parent.parent
+    result = subprocess.run(
+        [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider", *MATRIX],
+        cwd=root,
+        env={**os.environ, "TEST_DATABASE_URL": postgres_url},
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stdout[-5000:]
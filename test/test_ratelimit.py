@@ -0,0 +1,146 @@
+import asyncio
+from test import mock_settings, test_client
+from unittest import mock
+
+import pytest
+from api import auth
+from api.exceptions import TooManyRequestsException
+from api.ratelimit import (
+    Bucket,
+    LoginLimiter,
+    Lockout,
+    MemoryLimitStore,
+    Rule,
+    SQLiteLimitStore,
+    client_address,
+    parse_networks,
+    record_failure,
+    refill,
+)
+from starlette.requests import Request
+
+from .conftest import FakeUser
+
+
+def test_token_bucket():
+    bucket, rule = Bucket(), Rule(rate=1, burst=2)
+    for _ in range(2):
+        assert refill(bucket, rule, now=100) == 0
+        bucket.tokens -= 1
+    assert refill(bucket, rule, now=100) == 1
+    assert refill(bucket, rule, now=100.5) == 0.5
+    assert refill(bucket, rule, now=101) == 0
+
+
+def test_exponential_lockout():
+    bucket, lockout = Bucket(), Lockout(threshold=3, seconds=1, max_seconds=8, window=60)
+    durations = []
+    for now in range(100, 107):
+        record_failure(bucket, lockout, now)
+        durations.append(max(bucket.locked_until - now, 0))
+    assert durations == [0, 0, 1, 2, 4, 8, 8]
+    assert refill(bucket, Rule(1, 10), now=110) == 4  # locked until 114
+
+    # failures outside the window start over
+    record_failure(bucket, lockout, 200)
+    assert bucket.failures == 1
+
+
+@pytest.mark.parametrize("store", ["memory", "sqlite"])
+def test_limiter(store, tmp_path):
+    memory_store = MemoryLimitStore()
+
+    def make_limiter():
+        # with sqlite every worker process opens its own store on the same file
+        if store == "memory":
+            limit_store = memory_store
+        else:
+            limit_store = SQLiteLimitStore(str(tmp_path / "limits.db"))
+        return LoginLimiter(limit_store, Rule(1, 3), Rule(1, 3), Lockout(threshold=2))
+
+    first, second = make_limiter(), make_limiter()
+
+    async def attempts():
+        with mock.patch("api.ratelimit.time.time", return_value=1000):
+            await first.check("10.0.0.1", "a@example.com")
+            await second.check("10.0.0.1", "A@example.com")
+            await first.failed("10.0.0.1", "a@example.com")
+            await second.failed("10.0.0.1", "a@example.com")  # locked for 1s
+            with pytest.raises(TooManyRequestsException) as error:
+                await first.check("10.0.0.2", "a@example.com")
+            assert error.value.headers["Retry-After"] == "1"
+            # the ip is locked for other accounts too
+            with pytest.raises(TooManyRequestsException):
+                await second.check("10.0.0.1", "b@example.com")
+        with mock.patch("api.ratelimit.time.time", return_value=1002):
+            await first.check("10.0.0.2", "a@example.com")
+            await first.succeeded("10.0.0.2", "a@example.com")
+            await second.check("10.0.0.3", "a@example.com")
+
+    asyncio.run(attempts())
+
+
+def test_sqlite_store_expiry(tmp_path):
+    store = SQLiteLimitStore(str(tmp_path / "limits.db"), expire_after=60, prune_interval=30)
+    lockout = Lockout(threshold=2, seconds=300, max_seconds=600)
+    limiter = LoginLimiter(store, Rule(1, 3), Rule(1, 3), lockout)
+
+    async def attempts():
+        with mock.patch("api.ratelimit.time.time", return_value=1000):
+            for number in range(3):
+                await limiter.check(f"10.0.0.{number}", f"user{number}@example.com")
+            # locked out until 1600, longer than the buckets take to expire
+            for _ in range(3):
+                await limiter.failed("10.0.1.1", "locked@example.com")
+        assert len(store) == 8
+        # refilled after 60s, deleted at the next prune
+        with mock.patch("api.ratelimit.time.time", return_value=1061):
+            await limiter.check("10.0.2.1", "new@example.com")
+        assert len(store) == 4
+        with mock.patch("api.ratelimit.time.time", return_value=1100):
+            assert store.prune() == 0
+        with mock.patch("api.ratelimit.time.time", return_value=1601):
+            assert store.prune() == 4
+
+    asyncio.run(attempts())
+
+
+def test_client_address():
+    def request(peer: str, *forwarded: str) -> Request:
+        headers = [(b"x-forwarded-for", value.encode()) for value in forwarded]
+        return Request({"type": "http", "client": (peer, 1234), "headers": headers})
+
+    proxies = parse_networks("10.0.0.1, 172.16.0.0/12")
+    # not behind a proxy, the header is anyone's to set
+    assert client_address(request("1.2.3.4", "5.6.7.8"), proxies) == "1.2.3.4"
+    assert client_address(request("10.0.0.1", "5.6.7.8"), []) == "10.0.0.1"
+    # the nearest address no trusted proxy added
+    assert client_address(request("10.0.0.1", "5.6.7.8"), proxies) == "5.6.7.8"
+    assert (
+        client_address(request("10.0.0.1", "9.9.9.9, 5.6.7.8", "172.16.0.3"), proxies)
+        == "5.6.7.8"
+    )
+    assert client_address(request("10.0.0.1", "garbage"), proxies) == "garbage"
+    assert client_address(request("10.0.0.1"), proxies) == "10.0.0.1"
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_login_locked_before_lookup(db_session):
+    # failed logins of the account from elsewhere
+    for _ in range(auth.login_limiter.lockout.threshold):
+        asyncio.run(auth.login_limiter.failed("10.0.0.1", FakeUser.user.email))
+
+    with mock.patch("api.auth.authenticate_user") as authenticate_user:
+        response = test_client.post("/token/", json=FakeUser.user.dict())
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    authenticate_user.assert_not_called()
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_failed_logins_lock_account(db_session):
+    wrong = {"email": FakeUser.user.email, "password": "wrong"}
+    for _ in range(auth.login_limiter.lockout.threshold):
+        assert test_client.post("/token/", json=wrong).status_code == 401
+    response = test_client.post("/token/", json=FakeUser.user.dict())
+    assert response.status_code == 429
@@ -0,0 +1,110 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from test import introspect, mock_settings, test_client
+from unittest import mock
+
+from api import auth, crud
+from api.model import RevokedToken
+from api.revocation import BloomFilter, revocation_list
+from sqlmodel import Session
+
+from .conftest import FakeUser
+
+
+def active(token: str) -> bool:
+    return introspect(token).json()["active"]
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(capacity=10000, error_rate=0.01)
+    members = [f"member{i}" for i in range(10000)]
+    for member in members:
+        bloom.add(member)
+    # no false negatives, false positives close to the error rate
+    assert all(member in bloom for member in members)
+    false_positives = sum(f"other{i}" in bloom for i in range(10000))
+    assert false_positives < 200
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_revoke_access_token(db_session: Session):
+    token = auth.create_access_token(FakeUser.user.email)
+    other = auth.create_access_token(FakeUser.user.email)
+    assert active(token)
+
+    response = test_client.post("/revoke/", data={"token": token})
+    assert response.status_code == 200
+    assert not active(token)
+    assert active(other)
+    # revoking again, or an invalid token, is not an error
+    assert test_client.post("/revoke/", data={"token": token}).status_code == 200
+    assert test_client.post("/revoke/", data={"token": "x.y.z"}).status_code == 200
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_tokens_not_revoked_skip_the_database(db_session: Session):
+    token = auth.create_access_token(FakeUser.user.email)
+    assert active(token)  # loads the revocations
+    with mock.patch("api.revocation.crud.is_token_revoked") as lookup:
+        assert active(token)
+        lookup.assert_not_called()
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_revoke_refresh_token(db_session: Session):
+    response = test_client.post("/token/", json=FakeUser.user.dict())
+    refresh_token = response.json()["refresh_token"]
+    assert test_client.post("/revoke/", data={"token": refresh_token}).status_code == 200
+    response = test_client.post("/refresh/", json={"refresh_token": refresh_token})
+    assert response.status_code == 401
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_password_change_revokes_earlier_tokens(db_session: Session):
+    token = auth.create_access_token(FakeUser.user.email)
+    crud.update_user(FakeUser.user.email.upper(), db_session, password="changed")
+    later = auth.create_access_token(FakeUser.user.email)
+    assert not active(token)
+    assert active(later)
+
+    # and so does deleting the user
+    crud.delete_user(FakeUser.user.email, db_session)
+    assert not active(later)
+
+
+def test_prune_revocations(db_session: Session):
+    now = datetime.utcnow()
+    crud.revoke_access_token("expired", "a@b.com", now - timedelta(minutes=1), db_session)
+    crud.revoke_access_token("active", "a@b.com", now + timedelta(minutes=1), db_session)
+    assert crud.prune_revocations(db_session) == 1
+    jtis, watermarks = crud.get_active_revocations(db_session)
+    assert jtis == ["active"]
+    # the fixture promoting the admin is the only watermark
+    assert list(watermarks) == [FakeUser.admin.email]
+    with db_session:
+        assert db_session.get(RevokedToken, "expired") is None
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_revocations_reload_after_sync_interval(db_session: Session):
+    token = auth.create_access_token(FakeUser.user.email)
+    claims = auth.decode_access_token(token)
+
+    async def revoked() -> bool:
+        return await revocation_list.is_revoked(claims, db_session)
+
+    assert not asyncio.run(revoked())
+    # revoked elsewhere (another host), without this process noticing
+    with db_session:
+        db_session.add(
+            RevokedToken(
+                jti=claims["jti"],
+                email=claims["sub"],
+                expires=datetime.utcfromtimestamp(claims["exp"]),
+            )
+        )
+        db_session.commit()
+    assert not asyncio.run(revoked())
+    revocation_list.loaded = time.monotonic() - revocation_list.sync_seconds - 1
+    assert asyncio.run(revoked())
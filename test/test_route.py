@@ -1,7 +1,11 @@
-from test import test_client
-
-from api import app
-from api.auth import oauth_scheme
+import json
+from test import mock_settings, test_client
+from unittest import mock
+
+from api import app, auth
+from api.auth import require_admin
+from api.model import User
+from api.serialization import dumps
 from sqlmodel import Session
 
 from .conftest import FakeUser
@@ -35,7 +39,7 @@ def test_create_user(db_session: Session):
     assert response.status_code == 401
 
     # mock authentication
-    app.dependency_overrides[oauth_scheme] = lambda: "mock_token"
+    app.dependency_overrides[require_admin] = lambda: None
     # create a new user
     response = test_client.post("/user/", json=FakeUser.new.dict())
     data = response.json()
@@ -48,7 +52,7 @@ def test_create_user(db_session: Session):
     assert response.status_code == 409
     assert data == {"detail": f"User <{FakeUser.new.email}> already exists!"}
     # remove the mock authentication
-    app.dependency_overrides.pop(oauth_scheme)
+    app.dependency_overrides.pop(require_admin)
 
 
 def test_update_user(db_session: Session):
@@ -57,7 +61,7 @@ def test_update_user(db_session: Session):
     assert response.status_code == 401
 
     # mock authentication
-    app.dependency_overrides[oauth_scheme] = lambda: "mock_token"
+    app.dependency_overrides[require_admin] = lambda: None
 
     # update to a new email
     response = test_client.put(
@@ -79,7 +83,7 @@ def test_update_user(db_session: Session):
     response = test_client.put("/user/?email=random@mail.com")
     assert response.status_code == 404
     # remove the mock authentication
-    app.dependency_overrides.pop(oauth_scheme)
+    app.dependency_overrides.pop(require_admin)
 
 
 def test_delete_user(db_session: Session):
@@ -88,7 +92,7 @@ def test_delete_user(db_session: Session):
     assert response.status_code == 401
 
     # mock authentication
-    app.dependency_overrides[oauth_scheme] = lambda: "mock_token"
+    app.dependency_overrides[require_admin] = lambda: None
     # attempt to delete FakeUser.user
     response = test_client.delete(f"/user/?email={FakeUser.user.email}")
     assert response.status_code == 204
@@ -96,4 +100,89 @@ def test_delete_user(db_session: Session):
     response = test_client.delete(f"/user/?email={new_email}")
     assert response.status_code == 404
     # remove the mock authentication
-    app.dependency_overrides.pop(oauth_scheme)
+    app.dependency_overrides.pop(require_admin)
+
+
+def test_get_users_page(db_session: Session):
+    # a full page links to the next one
+    response = test_client.get(url="/users/?limit=1")
+    assert response.status_code == 200
+    assert response.json() == [{"email": FakeUser.user.email, "id": 1}]
+    assert response.headers["link"] == '</users/?after=1&limit=1>; rel="next"'
+
+    response = test_client.get(url="/users/?after=1&limit=1")
+    assert response.json() == [{"email": FakeUser.admin.email, "id": 2}]
+
+    # the last page has no link
+    response = test_client.get(url="/users/?after=2&limit=1")
+    assert response.json() == []
+    assert "link" not in response.headers
+
+    # out of range page size
+    response = test_client.get(url="/users/?limit=0")
+    assert response.status_code == 422
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_users_from_id_zero(db_session: Session):
+    # ids start at 0, like the admin of the shipped database
+    db_session.add(User(id=0, email="zero@email.com", hashed_password="x"))
+    db_session.commit()
+    zero = {"id": 0, "email": "zero@email.com"}
+
+    response = test_client.get(url="/users/?limit=1")
+    assert response.json() == [zero]
+    assert response.headers["link"] == '</users/?after=0&limit=1>; rel="next"'
+    response = test_client.get(url="/users/?after=0&limit=1")
+    assert response.json() == [{"email": FakeUser.user.email, "id": 1}]
+
+    admin = auth.create_access_token(FakeUser.admin.email, is_admin=True)
+    response = test_client.get(
+        url="/users/?stream=true", headers={"Authorization": f"Bearer {admin}"}
+    )
+    assert json.loads(response.text.splitlines()[0]) == zero
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_stream_users(db_session: Session):
+    # the whole table, admins only
+    response = test_client.get(url="/users/?stream=true")
+    assert response.status_code == 401
+    user = auth.create_access_token(FakeUser.user.email)
+    response = test_client.get(
+        url="/users/?stream=true", headers={"Authorization": f"Bearer {user}"}
+    )
+    assert response.status_code == 403
+
+    admin = auth.create_access_token(FakeUser.admin.email, is_admin=True)
+    test_client.headers["Authorization"] = f"Bearer {admin}"
+    try:
+        response = test_client.get(url="/users/?stream=true")
+        stream_after = test_client.get(url="/users/?stream=true&after=1")
+    finally:
+        del test_client.headers["Authorization"]
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {"id": 1, "email": FakeUser.user.email},
+        {"id": 2, "email": FakeUser.admin.email},
+    ]
+
+    # encoded like every other response
+    assert stream_after.text.splitlines() == [
+        dumps({"id": 2, "email": FakeUser.admin.email}).decode()
+    ]
+    assert stream_after.text == f'{{"id":2,"email":"{FakeUser.admin.email}"}}\n'
+
+    # served by GET /users/export/ and its require_admin dependency
+    response = test_client.get(
+        url="/users/?stream=true&after=1", follow_redirects=False
+    )
+    assert response.status_code == 307
+    assert response.headers["location"].endswith("/users/export/?after=1")
+    app.dependency_overrides[require_admin] = lambda: None
+    try:
+        response = test_client.get(url="/users/?stream=true")
+    finally:
+        app.dependency_overrides.pop(require_admin)
+    assert response.status_code == 200
@@ -0,0 +1,45 @@
+import json
+from datetime import datetime
+from test import mock_settings, test_client
+from unittest import mock
+
+import pytest
+from api import serialization
+from api.model import UserShow
+from sqlmodel import Session
+
+from .conftest import FakeUser
+
+
+def test_encoders_agree():
+    content = {"id": 1, "email": "ünï@example.com", "at": datetime(2024, 1, 2, 3, 4, 5)}
+    outputs = {name: dumps(content) for name, dumps in serialization.ENCODERS.items()}
+    assert outputs["json"] == b'{"id":1,"email":"\xc3\xbcn\xc3\xaf@example.com","at":"2024-01-02T03:04:05"}'
+    assert len(set(outputs.values())) == 1
+    # models are encoded through pydantic
+    user = UserShow(id=1, email="a@example.com")
+    for dumps in serialization.ENCODERS.values():
+        assert json.loads(dumps(user)) == {"id": 1, "email": "a@example.com"}
+
+
+def test_encoder_name():
+    assert serialization.encoder_name("json") == "json"
+    with pytest.raises(ValueError):
+        serialization.encoder_name("pickle")
+
+
+@mock.patch("api.auth.settings", mock_settings)
+def test_json_responses(db_session: Session):
+    response = test_client.post("/token/", json=FakeUser.user.dict())
+    assert response.headers["content-type"] == "application/json"
+    assert list(response.json()) == ["access_token", "refresh_token", "token_type"]
+
+    response = test_client.get(f"/user/?email={FakeUser.user.email}")
+    assert response.json() == {"id": 1, "email": FakeUser.user.email}
+    assert "etag" in response.headers
+
+    # malformed bodies are rejected whichever decoder reads them
+    response = test_client.post(
+        "/token/", content=b"{", headers={"Content-Type": "application/json"}
+    )
+    assert response.status_code == 422
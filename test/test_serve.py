@@ -0,0 +1,34 @@
+from unittest import mock
+
+from api import serve
+from api.cache import TTLCache
+from api.config import Settings
+from api.keys import KeyManager
+from api.ratelimit import LoginLimiter, MemoryLimitStore, SQLiteLimitStore
+
+
+def test_prepare_workers(tmp_path):
+    settings = Settings(
+        access_token_secret="secret",
+        refresh_token_secret="secret",
+        access_log_file=str(tmp_path / "access.log"),
+        database=str(tmp_path / "user.db"),
+    )
+    cache = TTLCache(maxsize=10, ttl=60)
+    limiter = LoginLimiter(MemoryLimitStore(), None, None, None)
+    manager = KeyManager("ES256")
+    with mock.patch.multiple(
+        serve, settings=settings, user_cache=cache, login_limiter=limiter, key_manager=manager
+    ), mock.patch("api.ratelimit.settings", settings):
+        temporary = serve.prepare_workers(4)
+
+    assert cache.shared is not None
+    assert isinstance(limiter.store, SQLiteLimitStore)
+    # next to the user database, not in it
+    assert limiter.store.database == f"{settings.database}.limits"
+    # keys only kept in memory move to a directory the workers share
+    assert temporary == [manager.key_dir]
+    assert len(list(manager.key_dir.glob("*.pem"))) == 1
+    assert settings.access_log_file == str(tmp_path / "access.{pid}.log")
+    for path in temporary:
+        serve.shutil.rmtree(path)